@@ -0,0 +1,133 @@
+import math
+from typing import List, Optional, Tuple
+
+from app.config import Logger, settings
+from app.progress import progress_key
+from app.redis_client import get_redis
+
+logger = Logger.get_logger(__name__)
+
+# Requests that may still have images queued, per tenant and across all tenants.
+# Members are pruned lazily by `admit` once their counters show nothing left to do.
+ACTIVE_KEY = "admission:active"
+
+
+def tenant_key(tenant: str) -> str:
+    return f"admission:tenant:{tenant}"
+
+
+def tenant_of(headers, client_host: Optional[str]) -> str:
+    """The caller's tenant: the TENANT_HEADER value, else the client address."""
+    return headers.get(settings.tenant_header) or client_host or "anonymous"
+
+
+def total_in_flight() -> int:
+    """Images dispatched but not finished across all tenants. Read-only: `admit` prunes finished requests."""
+    client = get_redis()
+    request_ids: List[bytes] = list(client.smembers(ACTIVE_KEY))
+    if not request_ids:
+        return 0
+    pipe = client.pipeline()
+    for request_id in request_ids:
+        pipe.hmget(progress_key(request_id.decode()), "total", "completed", "failed")
+    return sum(
+        max(int(total) - int(completed or 0) - int(failed or 0), 0)
+        for total, completed, failed in pipe.execute() if total is not None
+    )
+
+
+# Checks the limits and registers the upload in one step, so concurrent uploads of a
+# tenant cannot all pass the same check. Sums what is left of the requests in the
+# tenant's (and, with a total limit, the service's) set, pruning those that are
+# finished or expired. Returns {admitted, tenant pending, total pending}.
+_ADMIT = """
+local function pending(key)
+    local sum = 0
+    for _, id in ipairs(redis.call('SMEMBERS', key)) do
+        local counters = redis.call('HMGET', string.format(ARGV[5], id), 'total', 'completed', 'failed', 'open')
+        local left = 0
+        if counters[1] then
+            left = tonumber(counters[1]) - tonumber(counters[2] or 0) - tonumber(counters[3] or 0)
+        end
+        if not counters[1] or (left <= 0 and not counters[4]) then
+            redis.call('SREM', key, id)
+        else
+            sum = sum + math.max(left, 0)
+        end
+    end
+    return sum
+end
+local tenant_limit = tonumber(ARGV[1])
+local total_limit = tonumber(ARGV[2])
+local tenant = pending(KEYS[1])
+if tenant_limit > 0 and tenant >= tenant_limit then
+    return {0, tenant, -1}
+end
+local total = -1
+if total_limit > 0 then
+    total = pending(KEYS[2])
+    if total >= total_limit then
+        return {0, tenant, total}
+    end
+end
+for i = 1, 2 do
+    redis.call('SADD', KEYS[i], ARGV[3])
+    redis.call('EXPIRE', KEYS[i], ARGV[4])
+end
+redis.call('HSET', KEYS[3], 'total', 0, 'completed', 0, 'failed', 0, 'open', 1)
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+return {1, tenant, total}
+"""
+
+_admit_script = None
+
+
+def admit(tenant: str, request_id: str) -> Tuple[Optional[int], int]:
+    """
+    Decide whether `tenant` may start upload `request_id` and, if so, count it against
+    the tenant until its images are done and the upload closed. This creates the
+    request's progress counters.
+
+    Returns `(retry_after, tenant_in_flight)`: `retry_after` is None when admitted,
+    otherwise the seconds the caller should wait (sent as Retry-After with a 429).
+    """
+    global _admit_script
+    client = get_redis()
+    if _admit_script is None or _admit_script.registered_client is not client:
+        _admit_script = client.register_script(_ADMIT)
+    admitted, tenant_pending, total_pending = _admit_script(
+        keys=[tenant_key(tenant), ACTIVE_KEY, progress_key(request_id)],
+        args=[
+            settings.admission_max_inflight_per_tenant, settings.admission_max_inflight_total,
+            request_id, settings.progress_ttl, progress_key("%s"),
+        ],
+    )
+    if admitted:
+        return None, tenant_pending
+    if total_pending < 0:
+        logger.warning(f"Rejecting upload from {tenant}: {tenant_pending} images in flight")
+    else:
+        logger.warning(f"Rejecting upload from {tenant}: {total_pending} images in flight overall")
+    return settings.admission_retry_after, tenant_pending
+
+
+def close(request_id: str):
+    """Mark the upload of `request_id` as fully dispatched, so it can leave the active sets once drained."""
+    get_redis().hdel(progress_key(request_id), "open")
+
+
+def request_in_flight(request_id: str) -> int:
+    total, completed, failed = get_redis().hmget(progress_key(request_id), "total", "completed", "failed")
+    return int(total or 0) - int(completed or 0) - int(failed or 0)
+
+
+def fair_priority(in_flight_images: int) -> int:
+    """
+    Broker priority (0 = first) for work whose tenant already has `in_flight_images`
+    queued. The first FAIR_SHARE_IMAGES go at the top; every doubling beyond that
+    drops one step, so a small upload overtakes the tail of a 100k-row one.
+    """
+    if in_flight_images < settings.fair_share_images:
+        return 0
+    return min(9, 1 + int(math.log2(in_flight_images / settings.fair_share_images)))
+
@@ -0,0 +1,48 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from app.config import settings
+from app.profiling import active_profiler
+
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Bounded pool for blocking work issued from request handlers (sized by API_BLOCKING_THREADS)."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.api_blocking_threads, thread_name_prefix="api-blocking")
+    return _executor
+
+
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run `func` on the bounded pool without blocking the event loop, in a copy of the caller's context."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    if context.get(active_profiler) is not None:
+        func = functools.partial(_profiled, func)
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, func, *args, **kwargs))
+
+
+def _profiled(func: Callable[..., T], *args, **kwargs) -> T:
+    """Sample this pool thread with the calling upload's profiler while it runs `func`."""
+    profiler, thread_id = active_profiler.get(), threading.get_ident()
+    profiler.attach(thread_id)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.detach(thread_id)
+
+
+def shutdown_executor():
+    """Stop the pool; called on application shutdown."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -2,12 +2,14 @@ from pydantic import (
     AmqpDsn,
     Field,
     PostgresDsn,
-    SecretStr
+    SecretStr,
+    field_validator
 )
 from pydantic_settings import BaseSettings
+from typing import Dict, List, Literal, Optional
 from dotenv import load_dotenv, find_dotenv
+import importlib.util
 import logging
-from logging.handlers import RotatingFileHandler
 
 load_dotenv(find_dotenv())
 
@@ -19,6 +21,7 @@ class Settings(BaseSettings):
     db_user: str = Field(..., env='DB_USER')
     db_password: SecretStr = Field(..., env='DB_PASSWORD')
     db_name: str = Field(..., env='DB_NAME')
+    db_async_driver: str = Field('postgresql+asyncpg', env='DB_ASYNC_DRIVER')
 
     rabbitmq_host: str = Field(..., env='RABBITMQ_HOST')
     rabbitmq_port: int = Field(..., env='RABBITMQ_PORT')
@@ -29,6 +32,202 @@ class Settings(BaseSettings):
     redis_port: int = Field(..., env='REDIS_PORT')
     redis_db: int = Field(..., env='REDIS_DB')
 
+    # Connection pool sizing. The API process shares one engine across all
+    # request handlers; each Celery worker process builds its own engine after
+    # fork, sized from `worker_queue_pool_sizes` for the queues it consumes.
+    db_pool_size: int = Field(25, env='DB_POOL_SIZE')
+    db_max_overflow: int = Field(10, env='DB_MAX_OVERFLOW')
+    db_pool_timeout: int = Field(30, env='DB_POOL_TIMEOUT')
+    db_pool_recycle: int = Field(300, env='DB_POOL_RECYCLE')
+    worker_db_pool_size: int = Field(2, env='WORKER_DB_POOL_SIZE')
+    worker_db_max_overflow: int = Field(2, env='WORKER_DB_MAX_OVERFLOW')
+    worker_queue_pool_sizes: Dict[str, int] = Field(default_factory=dict, env='WORKER_QUEUE_POOL_SIZES')
+
+    # Bounded thread pool the API uses for CSV parsing, broker publishing and file writes
+    api_blocking_threads: int = Field(8, env='API_BLOCKING_THREADS')
+
+    # Image download/transform pipeline inside a product task
+    image_download_concurrency: int = Field(8, env='IMAGE_DOWNLOAD_CONCURRENCY')
+    image_transform_threads: int = Field(0, env='IMAGE_TRANSFORM_THREADS')  # 0 = one per CPU
+    image_max_bytes: int = Field(25 * 1024 * 1024, env='IMAGE_MAX_BYTES')
+    http_connect_timeout: float = Field(5.0, env='HTTP_CONNECT_TIMEOUT')
+    http_read_timeout: float = Field(30.0, env='HTTP_READ_TIMEOUT')
+    http_max_retries: int = Field(3, env='HTTP_MAX_RETRIES')
+    http_retry_backoff: float = Field(0.5, env='HTTP_RETRY_BACKOFF')
+    http_pool_hosts: int = Field(32, env='HTTP_POOL_HOSTS')
+    http_pool_maxsize_per_host: int = Field(4, env='HTTP_POOL_MAXSIZE_PER_HOST')
+
+    # Transform: downscale factor, Pillow reducing_gap and JPEG encoder settings
+    resize_scale: float = Field(0.5, env='RESIZE_SCALE')
+    resize_reducing_gap: float = Field(3.0, env='RESIZE_REDUCING_GAP')
+    jpeg_quality: int = Field(75, env='JPEG_QUALITY')
+    jpeg_progressive: bool = Field(True, env='JPEG_PROGRESSIVE')
+    jpeg_optimize: bool = Field(False, env='JPEG_OPTIMIZE')
+
+    # Output storage: "local" writes under `output_dir`, "s3" to an S3-compatible bucket.
+    # `storage_public_base_url` is the URL prefix other nodes and clients use to read outputs.
+    storage_backend: Literal["local", "s3"] = Field("local", env='STORAGE_BACKEND')
+    output_dir: str = Field("/path/to/output/directory", env='OUTPUT_DIR')
+    storage_public_base_url: Optional[str] = Field(None, env='STORAGE_PUBLIC_BASE_URL')
+    s3_bucket: Optional[str] = Field(None, env='S3_BUCKET')
+    s3_endpoint_url: Optional[str] = Field(None, env='S3_ENDPOINT_URL')
+    s3_region: Optional[str] = Field(None, env='S3_REGION')
+    s3_access_key_id: Optional[str] = Field(None, env='S3_ACCESS_KEY_ID')
+    s3_secret_access_key: Optional[SecretStr] = Field(None, env='S3_SECRET_ACCESS_KEY')
+    s3_max_pool_connections: int = Field(32, env='S3_MAX_POOL_CONNECTIONS')
+    s3_part_size: int = Field(8 * 1024 * 1024, env='S3_PART_SIZE')
+    s3_upload_concurrency: int = Field(4, env='S3_UPLOAD_CONCURRENCY')
+
+    # Content-addressed result cache (Redis index + LRU of outputs kept in the storage backend)
+    image_cache_enabled: bool = Field(True, env='IMAGE_CACHE_ENABLED')
+    image_cache_prefix: str = Field("cache", env='IMAGE_CACHE_PREFIX')
+    image_cache_max_bytes: int = Field(10 * 1024 ** 3, env='IMAGE_CACHE_MAX_BYTES')
+    image_cache_ttl: int = Field(7 * 24 * 60 * 60, env='IMAGE_CACHE_TTL')
+    image_cache_fresh_seconds: int = Field(60 * 60, env='IMAGE_CACHE_FRESH_SECONDS')
+
+    # Lifetime of the Redis progress counters behind /v1/status, in seconds
+    progress_ttl: int = Field(7 * 24 * 60 * 60, env='PROGRESS_TTL')
+
+    # Progress streams (/v1/status/stream, /v1/status/ws): seconds between keepalives, and events
+    # held per client before the oldest are dropped
+    progress_stream_keepalive: float = Field(15.0, env='PROGRESS_STREAM_KEEPALIVE')
+    progress_stream_queue_size: int = Field(100, env='PROGRESS_STREAM_QUEUE_SIZE')
+
+    # Per-image status updates are buffered and written in batches of this size
+    image_status_flush_size: int = Field(20, env='IMAGE_STATUS_FLUSH_SIZE')
+
+    # Streaming CSV ingestion: bytes read from the upload per chunk, and product
+    # tasks published to the broker per batch while the file is still being parsed.
+    # A record longer than `csv_max_record_size` characters (0 = unlimited) ends the
+    # upload's rows, so an unbalanced quote cannot buffer the rest of the file
+    csv_chunk_size: int = Field(64 * 1024, env='CSV_CHUNK_SIZE')
+    csv_dispatch_batch_size: int = Field(100, env='CSV_DISPATCH_BATCH_SIZE')
+    csv_max_record_size: int = Field(1024 * 1024, env='CSV_MAX_RECORD_SIZE')
+    # Scheduling granularity: "product" sends one task per CSV row, "image" persists
+    # rows at upload and spreads their images over chunks of `image_chunk_size`
+    task_granularity: Literal["product", "image"] = Field("product", env='TASK_GRANULARITY')
+    image_chunk_size: int = Field(10, env='IMAGE_CHUNK_SIZE')
+    # "inline" downloads and transforms in one image_process task; "staged" splits them into a fetch
+    # stage (image_fetch queue, eventlet/gevent pool) and a transform stage (image_transform queue,
+    # prefork pool). Downloaded bytes wait in Redis for up to `fetch_blob_ttl` seconds, and the
+    # fetch stage pauses while `fetch_max_staged_bytes` are waiting (0 = no limit)
+    pipeline_mode: Literal["inline", "staged"] = Field("inline", env='PIPELINE_MODE')
+    fetch_blob_ttl: int = Field(15 * 60, env='FETCH_BLOB_TTL')
+    fetch_max_staged_bytes: int = Field(512 * 1024 * 1024, env='FETCH_MAX_STAGED_BYTES')
+    # Completion barrier: requests finalize off their Redis counters. The DB poll (every
+    # `barrier_poll_interval` seconds) only runs when Redis was unavailable at the end of the upload,
+    # and requests still unfinished after `barrier_timeout` seconds are finalized by the sweeper
+    barrier_poll_interval: int = Field(5, env='BARRIER_POLL_INTERVAL')
+    barrier_timeout: int = Field(6 * 60 * 60, env='BARRIER_TIMEOUT')
+
+    # Celery messaging. Broker and result backend default to the REDIS_HOST/REDIS_PORT/REDIS_DB
+    # instance. Messages are msgpack; those carrying image lists are compressed with
+    # `celery_bulk_compression` ("zlib", "gzip", "bzip2" or "none"). Results are only kept for
+    # the health check tasks, for `celery_result_expires` seconds
+    celery_broker_url: Optional[str] = Field(None, env='CELERY_BROKER_URL')
+    celery_result_backend: Optional[str] = Field(None, env='CELERY_RESULT_BACKEND')
+    celery_broker_pool_limit: int = Field(10, env='CELERY_BROKER_POOL_LIMIT')
+    celery_backend_max_connections: int = Field(20, env='CELERY_BACKEND_MAX_CONNECTIONS')
+    celery_serializer: Literal["msgpack", "json"] = Field("msgpack", env='CELERY_SERIALIZER')
+    celery_bulk_compression: Literal["zlib", "gzip", "bzip2", "none"] = Field("zlib", env='CELERY_BULK_COMPRESSION')
+    celery_result_expires: int = Field(60 * 60, env='CELERY_RESULT_EXPIRES')
+
+    # Admission control: uploads get 429 + Retry-After while the tenant (TENANT_HEADER, else the
+    # client address) or the whole service has this many images in flight (0 = unlimited). A
+    # running upload pauses while its own backlog reaches `admission_max_inflight_per_request`.
+    tenant_header: str = Field("X-Tenant-ID", env='TENANT_HEADER')
+    admission_max_inflight_per_tenant: int = Field(50000, env='ADMISSION_MAX_INFLIGHT_PER_TENANT')
+    admission_max_inflight_total: int = Field(0, env='ADMISSION_MAX_INFLIGHT_TOTAL')
+    admission_max_inflight_per_request: int = Field(10000, env='ADMISSION_MAX_INFLIGHT_PER_REQUEST')
+    admission_poll_interval: float = Field(1.0, env='ADMISSION_POLL_INTERVAL')
+    admission_retry_after: int = Field(30, env='ADMISSION_RETRY_AFTER')
+    # Fair scheduling: a tenant's first `fair_share_images` queued images get the top broker
+    # priority, each doubling beyond that one step less
+    fair_share_images: int = Field(500, env='FAIR_SHARE_IMAGES')
+    # Per-origin-host token buckets shared by all workers through Redis, in requests per second
+    # (0 = unlimited); `host_rate_limits` overrides the rate for individual hosts
+    host_rate_limit: float = Field(0, env='HOST_RATE_LIMIT')
+    host_rate_burst: int = Field(10, env='HOST_RATE_BURST')
+    host_rate_limits: Dict[str, float] = Field(default_factory=dict, env='HOST_RATE_LIMITS')
+    # Recovery: images failing with a transient error (connection, timeout, 429/5xx) are retried
+    # on their own after `image_retry_backoff` * 2^n seconds (capped at `image_retry_backoff_max`),
+    # and failed after `image_max_attempts`. Tasks are acknowledged only once done, so a killed
+    # worker's message is redelivered after `broker_visibility_timeout`. Every `sweep_interval`
+    # seconds, up to `sweep_batch_size` images 'processing' for `stuck_image_timeout` are requeued
+    image_max_attempts: int = Field(5, env='IMAGE_MAX_ATTEMPTS')
+    image_retry_backoff: float = Field(2.0, env='IMAGE_RETRY_BACKOFF')
+    image_retry_backoff_max: float = Field(300.0, env='IMAGE_RETRY_BACKOFF_MAX')
+    broker_visibility_timeout: int = Field(3600, env='BROKER_VISIBILITY_TIMEOUT')
+    stuck_image_timeout: int = Field(1800, env='STUCK_IMAGE_TIMEOUT')
+    sweep_interval: int = Field(300, env='SWEEP_INTERVAL')
+    sweep_batch_size: int = Field(1000, env='SWEEP_BATCH_SIZE')
+
+    # Broker messages reserved per worker process; the autoscaler keeps this proportional to the pool
+    worker_prefetch_multiplier: int = Field(1, env='WORKER_PREFETCH_MULTIPLIER')
+
+    # Result export: streamed from a server-side cursor in batches of `export_batch_size` rows,
+    # either POSTed to `webhook_url` with chunked transfer encoding or written to the storage backend
+    webhook_url: Optional[str] = Field("http://127.0.0.1:8003/webhook", env='WEBHOOK_URL')
+    export_target: Literal["webhook", "storage"] = Field("webhook", env='EXPORT_TARGET')
+    export_format: Literal["csv", "jsonl", "parquet"] = Field("csv", env='EXPORT_FORMAT')
+    export_gzip: bool = Field(False, env='EXPORT_GZIP')
+    export_batch_size: int = Field(1000, env='EXPORT_BATCH_SIZE')
+
+    # Webhook delivery: calls are written to an outbox and sent from the `webhooks` queue with their
+    # own keep-alive pool and timeouts. Failures are retried with jittered exponential backoff
+    # (`webhook_retry_backoff` * 2^n seconds, capped) and dead-lettered after `webhook_max_attempts`.
+    # A claimed call is not retried for `webhook_lease` seconds. Completion notices to one URL that are
+    # due within `webhook_batch_window` seconds go out as one call of up to `webhook_batch_size`
+    webhook_connect_timeout: float = Field(5.0, env='WEBHOOK_CONNECT_TIMEOUT')
+    webhook_read_timeout: float = Field(30.0, env='WEBHOOK_READ_TIMEOUT')
+    webhook_pool_maxsize: int = Field(10, env='WEBHOOK_POOL_MAXSIZE')
+    webhook_max_attempts: int = Field(10, env='WEBHOOK_MAX_ATTEMPTS')
+    webhook_retry_backoff: float = Field(30.0, env='WEBHOOK_RETRY_BACKOFF')
+    webhook_retry_backoff_max: float = Field(3600.0, env='WEBHOOK_RETRY_BACKOFF_MAX')
+    webhook_lease: int = Field(900, env='WEBHOOK_LEASE')
+    webhook_batch_window: float = Field(2.0, env='WEBHOOK_BATCH_WINDOW')
+    webhook_batch_size: int = Field(100, env='WEBHOOK_BATCH_SIZE')
+    webhook_drain_interval: int = Field(30, env='WEBHOOK_DRAIN_INTERVAL')
+    webhook_gzip: bool = Field(False, env='WEBHOOK_GZIP')
+
+    # Table maintenance, scheduled by celery beat at `maintenance_hour`: monthly partitions are
+    # created `partition_premake_months` ahead; with `retention_days` > 0, finished requests older
+    # than that are archived under `archive_prefix` in the storage backend and their months dropped
+    maintenance_hour: int = Field(3, env='MAINTENANCE_HOUR')
+    partition_premake_months: int = Field(3, env='PARTITION_PREMAKE_MONTHS')
+    retention_days: int = Field(0, env='RETENTION_DAYS')
+    retention_batch_size: int = Field(500, env='RETENTION_BATCH_SIZE')
+    archive_prefix: str = Field("archive", env='ARCHIVE_PREFIX')
+
+    # Prometheus: distinct source hosts labelled per process before the rest count as "other",
+    # and the port of each Celery worker's /metrics exporter (0 = off)
+    metrics_max_hosts: int = Field(100, env='METRICS_MAX_HOSTS')
+    worker_metrics_port: int = Field(9808, env='WORKER_METRICS_PORT')
+
+    # Logging: records are queued and written by a background thread as JSON lines ("json") or
+    # plain text to stderr and, if `log_file` is set, a rotating file. `log_levels` overrides
+    # LOG_LEVEL per logger name, e.g. {"app.crud": "DEBUG"}. Per-image events are kept at
+    # `log_sample_rate`; records arriving while `log_queue_size` are waiting are dropped
+    log_level: str = Field("INFO", env='LOG_LEVEL')
+    log_levels: Dict[str, str] = Field({}, env='LOG_LEVELS')
+    log_format: Literal["json", "text"] = Field("json", env='LOG_FORMAT')
+    log_file: str = Field("app.log", env='LOG_FILE')
+    log_file_max_bytes: int = Field(5 * 1024 * 1024, env='LOG_FILE_MAX_BYTES')
+    log_file_backups: int = Field(3, env='LOG_FILE_BACKUPS')
+    log_sample_rate: float = Field(0.01, env='LOG_SAMPLE_RATE')
+    log_queue_size: int = Field(10000, env='LOG_QUEUE_SIZE')
+
+    # Opt-in profiling: uploads sent with the `profile_header` header or `profile=true`, plus a
+    # `profile_sample_rate` fraction of all uploads, are sampled every `profile_interval` seconds
+    # in the upload handler and in their `profile_tasks`. Stacks, run times and (with
+    # `profile_tracemalloc`) allocation peaks are kept in Redis for `profile_ttl` seconds
+    profile_sample_rate: float = Field(0.0, env='PROFILE_SAMPLE_RATE')
+    profile_header: str = Field("X-Profile", env='PROFILE_HEADER')
+    profile_interval: float = Field(0.005, env='PROFILE_INTERVAL')
+    profile_tasks: List[str] = Field(["process_product", "process_image_chunk", "finalize_request"], env='PROFILE_TASKS')
+    profile_tracemalloc: bool = Field(True, env='PROFILE_TRACEMALLOC')
+    profile_ttl: int = Field(24 * 60 * 60, env='PROFILE_TTL')
+
     secret_key: SecretStr = Field(..., env='SECRET_KEY')
     debug: bool = Field(False, env='DEBUG')
 
@@ -43,6 +242,25 @@ class Settings(BaseSettings):
             path=f"{self.db_name}"
         )
 
+    @field_validator('export_format')
+    @classmethod
+    def _export_format_installed(cls, value: str) -> str:
+        # Fail at startup, not when the first export is delivered (and dead-lettered)
+        if value == "parquet" and importlib.util.find_spec("pyarrow") is None:
+            raise ValueError("EXPORT_FORMAT=parquet needs the 'pyarrow' package (pip install pyarrow)")
+        return value
+
+    @property
+    def async_database_url(self) -> PostgresDsn:
+        return PostgresDsn.build(
+            scheme=self.db_async_driver,
+            username=self.db_user,
+            password=self.db_password.get_secret_value(),
+            host=self.db_host,
+            port=self.db_port,
+            path=f"{self.db_name}"
+        )
+
     @property
     def amqp_dsn(self) -> str:
         return f"amqp://{self.rabbitmq_user}:{self.rabbitmq_password}@{self.rabbitmq_host}:{self.rabbitmq_port}//"
@@ -54,24 +272,16 @@ class Settings(BaseSettings):
 
 class Logger:
     @classmethod
-    def get_logger(cls, name: str = __name__, log_file: str = "app.log", level: int = logging.INFO) -> logging.Logger:
-        # Create a logger
-        logger = logging.getLogger(name)
-        logger.setLevel(level)
-
-        # Create handlers
-        console_handler = logging.StreamHandler()
-        file_handler = RotatingFileHandler(log_file, maxBytes=5 * 1024 * 1024, backupCount=3)  # 5 MB per file
+    def get_logger(cls, name: str = __name__, level: Optional[str] = None) -> logging.Logger:
+        # Records go through one queue handler per process; a background thread formats and
+        # writes them (see app.log), so logging never blocks the event loop or a task on I/O
+        from app.log import get_handler
 
-        # Create formatters and add it to handlers
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        console_handler.setFormatter(formatter)
-        file_handler.setFormatter(formatter)
-
-        # Add handlers to the logger
+        logger = logging.getLogger(name)
+        logger.setLevel((level or settings.log_levels.get(name, settings.log_level)).upper())
         if not logger.handlers:  # Avoid adding handlers multiple times
-            logger.addHandler(console_handler)
-            logger.addHandler(file_handler)
+            logger.addHandler(get_handler())
+            logger.propagate = False
 
         return logger
 
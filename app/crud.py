@@ -0,0 +1,229 @@
+import uuid
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from redis.exceptions import RedisError
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.config import Logger
+from app.model import ImageStatus, ImageUrl, Product, Request
+from app.progress import add_finished
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = Logger.get_logger(__name__)
+
+FINAL_STATUSES = (ImageStatus.completed, ImageStatus.failed)
+
+# Namespace of the derived row ids below
+ROW_NAMESPACE = uuid.UUID("5f0c3d52-8b0e-4d8e-9a53-2a4c54d1f0b7")
+
+
+def product_key(request_id: str, serial_number, row: Optional[int] = None) -> str:
+    """
+    Product id derived from the request, the serial number and the CSV row, so a
+    redelivered task writes the same rows again. Without a row number it is random.
+    """
+    if row is None:
+        return uuid.uuid4().hex
+    return uuid.uuid5(ROW_NAMESPACE, f"{request_id}:{serial_number}:{row}").hex
+
+
+def image_key(product_id: str, url: str, occurrence: int = 0) -> str:
+    """Image id derived from its product and URL; `occurrence` tells repeats of one URL apart."""
+    return uuid.uuid5(ROW_NAMESPACE, f"{uuid.UUID(str(product_id)).hex}:{occurrence}:{url}").hex
+
+
+def as_hex(image_id) -> str:
+    """Ids come back from the database dashed; the code passes them around as hex."""
+    return uuid.UUID(str(image_id)).hex
+
+
+def build_product_rows(products: Sequence[Dict], image_status: ImageStatus = ImageStatus.pending) -> Tuple[List[Dict], List[Dict], Dict[str, List[Dict]]]:
+    """
+    Build INSERT parameter lists for products and their image rows.
+
+    Each entry in `products` needs `product_id`, `request_id`, `request_created_at`
+    (the partition key), `serial_number`, `product_name` and `images` (a list of
+    input URLs). Image ids are derived from the product id and URL client side, so no
+    row has to be re-fetched after the insert and inserting twice is a no-op.
+    Returns the product rows, the image rows, and the image rows grouped by product_id.
+    """
+    product_rows = []
+    image_rows = []
+    images_by_product: Dict[str, List[Dict]] = {}
+    for product in products:
+        product_rows.append({
+            "product_id": product["product_id"],
+            "request_id": product["request_id"],
+            "request_created_at": product["request_created_at"],
+            "serial_number": product["serial_number"],
+            "product_name": product["product_name"],
+        })
+        seen: Counter = Counter()
+        rows = []
+        for url in product.get("images") or []:
+            rows.append({
+                "image_id": image_key(product["product_id"], url, seen[url]),
+                "product_id": product["product_id"],
+                "request_id": product["request_id"],
+                "request_created_at": product["request_created_at"],
+                "input_image_url": url,
+                "status": image_status,
+            })
+            seen[url] += 1
+        image_rows.extend(rows)
+        images_by_product[product["product_id"]] = rows
+    return product_rows, image_rows, images_by_product
+
+
+def bulk_insert_products(db: Session, products: Sequence[Dict], image_status: ImageStatus = ImageStatus.pending) -> Dict[str, List[Dict]]:
+    """
+    Insert products and all of their image rows with one multi-row INSERT per table.
+    Returns a mapping of product_id to its image rows. The caller owns the transaction.
+
+    Rows that already exist (a redelivered task inserting the same products again) are
+    left as they are, and only those not finished yet are returned with the new ones.
+    """
+    product_rows, image_rows, images_by_product = build_product_rows(products, image_status)
+    if product_rows:
+        db.execute(pg_insert(Product).on_conflict_do_nothing(), product_rows)
+    if image_rows:
+        inserted = {as_hex(image_id) for image_id in db.execute(
+            pg_insert(ImageUrl).on_conflict_do_nothing().returning(ImageUrl.image_id), image_rows
+        ).scalars()}
+        if len(inserted) < len(image_rows):
+            existing = [row["image_id"] for row in image_rows if row["image_id"] not in inserted]
+            todo = inserted | unfinished_image_ids(db, existing)
+            images_by_product = {
+                product_id: [row for row in rows if row["image_id"] in todo]
+                for product_id, rows in images_by_product.items()
+            }
+    return images_by_product
+
+
+async def bulk_insert_products_async(db: "AsyncSession", products: Sequence[Dict], image_status: ImageStatus = ImageStatus.pending) -> Dict[str, List[Dict]]:
+    """Async counterpart of `bulk_insert_products` for the API's request path."""
+    product_rows, image_rows, images_by_product = build_product_rows(products, image_status)
+    if product_rows:
+        await db.execute(insert(Product), product_rows)
+    if image_rows:
+        await db.execute(insert(ImageUrl), image_rows)
+    return images_by_product
+
+
+def unfinished_image_ids(db: Session, image_ids: Iterable[str]) -> Set[str]:
+    """The ids in `image_ids` (hex) whose images are neither completed nor failed."""
+    image_ids = list(image_ids)
+    if not image_ids:
+        return set()
+    rows = db.execute(
+        select(ImageUrl.image_id)
+        .where(ImageUrl.image_id.in_(image_ids), ImageUrl.status.notin_(FINAL_STATUSES))
+    ).scalars()
+    return {as_hex(image_id) for image_id in rows}
+
+
+def claim_images(db: Session, image_ids: Iterable[str]) -> Set[str]:
+    """
+    Move the unfinished images in `image_ids` to 'processing' and return their ids (hex).
+    Finished ones are left alone, so a redelivered task only redoes what is missing.
+    """
+    image_ids = list(image_ids)
+    if not image_ids:
+        return set()
+    rows = db.execute(
+        update(ImageUrl)
+        .where(ImageUrl.image_id.in_(image_ids), ImageUrl.status.notin_(FINAL_STATUSES))
+        .values(status=ImageStatus.processing)
+        .returning(ImageUrl.image_id)
+        .execution_options(synchronize_session=False)
+    ).scalars()
+    return {as_hex(image_id) for image_id in rows}
+
+
+class ImageResultBuffer:
+    """
+    Collects per-image completion updates and writes them in micro-batches.
+
+    Every `flush_size` results (and on `flush()`), pending rows are written with one
+    executemany UPDATE per status keyed by image_id and committed together. With a
+    `request_id`, the request's completed/failed counters are bumped in the same
+    transaction and mirrored to the Redis progress counters after commit, which also
+    publishes the batch to the request's progress streams. `request_done` turns true
+    when a flush finished the request and the caller has to finalize it.
+    """
+    def __init__(self, db: Session, flush_size: int = 20, request_id: Optional[str] = None):
+        self.db = db
+        self.flush_size = max(1, flush_size)
+        self.request_id = request_id
+        self._pending: List[Dict] = []
+        self.flushed_ids: List[str] = []
+        self.request_done = False
+
+    def add(self, image_id: str, status: ImageStatus, output_image_url: Optional[str] = None,
+            output_variants: Optional[Dict[str, str]] = None):
+        self._pending.append({
+            "image_id": image_id,
+            "status": status,
+            "output_image_url": output_image_url,
+            "output_variants": output_variants,
+        })
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        # Keyed by image_id alone: the table's primary key also holds the partition key, which callers don't carry.
+        # Rows already finished (by a duplicate delivery of the same work) are skipped, and one
+        # UPDATE per status gives the number of rows each status actually moved to.
+        statement = (
+            update(ImageUrl.__table__)
+            .where(
+                ImageUrl.image_id == bindparam("b_image_id"),
+                ImageUrl.status != ImageStatus.completed,
+                ImageUrl.status != ImageStatus.failed,
+            )
+            .values(
+                status=bindparam("b_status"),
+                output_image_url=bindparam("b_output_image_url"),
+                output_variants=bindparam("b_output_variants"),
+            )
+        )
+        moved = Counter()
+        for status in FINAL_STATUSES:
+            rows = [{f"b_{key}": value for key, value in row.items()} for row in self._pending if row["status"] == status]
+            if rows:
+                moved[status] = self.db.execute(statement, rows).rowcount
+        completed, failed = moved[ImageStatus.completed], moved[ImageStatus.failed]
+        if self.request_id and (completed or failed):
+            self.db.execute(
+                update(Request)
+                .where(Request.request_id == self.request_id)
+                .values(
+                    completed_images=Request.completed_images + completed,
+                    failed_images=Request.failed_images + failed,
+                )
+            )
+        self.db.commit()
+        flushed, self._pending = self._pending, []
+        self.flushed_ids.extend(row["image_id"] for row in flushed)
+        if self.request_id and (completed or failed):
+            try:
+                self.request_done |= add_finished(self.request_id, completed, failed, [
+                    {"image_id": row["image_id"], "status": row["status"].value, "output_image_url": row["output_image_url"]}
+                    for row in flushed
+                ])
+            except RedisError as e:
+                # The DB counters stay authoritative; /v1/status falls back to them
+                logger.warning(f"Could not update progress counters for request {self.request_id}: {e}")
+
+    def __enter__(self) -> "ImageResultBuffer":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
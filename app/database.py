@@ -1,52 +1,190 @@
-from sqlalchemy import create_engine
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from app.config import settings
+from app.metrics import DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUTS, DB_POOL_CONNECTS, DB_POOL_WAIT_SECONDS, DB_SECONDS, statement_label
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
 
 # Database URL from settings
 DATABASE_URL = settings.database_url.unicode_string()
 
-# Create a reusable database engine for global usage
-engine = create_engine(
-    DATABASE_URL,
-    pool_size=25,
-    max_overflow=10,
-    pool_recycle=300,
-    pool_pre_ping=True,
-    pool_use_lifo=True
-)
-
-# Create a configured "SessionLocal" class for the global engine
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
 # Base class for declarative models
 Base = declarative_base()
 
+# Async engine for the API request path; created on first use so worker
+# processes, which only use the sync engine, never load the asyncio extension
+# or the asyncpg driver.
+ASYNC_DATABASE_URL = settings.async_database_url.unicode_string()
+_async_engine: Optional["AsyncEngine"] = None
+_AsyncSessionLocal: Optional["async_sessionmaker"] = None
+
+
+def get_async_engine() -> "AsyncEngine":
+    """Return the API process's async engine, creating it on first use."""
+    global _async_engine, _AsyncSessionLocal
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        _async_engine = create_async_engine(
+            ASYNC_DATABASE_URL,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=True,
+            pool_use_lifo=True
+        )
+        _instrument(_async_engine.sync_engine)
+        _AsyncSessionLocal = async_sessionmaker(bind=_async_engine, autoflush=False, expire_on_commit=False)
+    return _async_engine
+
+
+async def dispose_async_engine():
+    """Close the async pool on application shutdown."""
+    global _async_engine, _AsyncSessionLocal
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        _AsyncSessionLocal = None
+
+
 # Dependency for FastAPI to get a database session
-def get_db():
-    """Dependency that provides a database session."""
-    db:Session = SessionLocal()
+async def get_db():
+    """Dependency that provides an async database session."""
+    get_async_engine()
+    db: "AsyncSession" = _AsyncSessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
+
+
+# Engines shared by every ConnectionManager in this process, keyed by URL.
+# The pid guard makes sure a forked child never reuses sockets opened by its parent.
+_engines: Dict[str, Engine] = {}
+_sessionmakers: Dict[str, sessionmaker] = {}
+_engines_pid: Optional[int] = None
+_engines_lock = threading.Lock()
+
+
+def _instrument(target: Engine):
+    """Feed the pool's connects, checkouts and connections in use to the `db_pool_*` metrics."""
+    def checkout(*_):
+        DB_POOL_CHECKOUTS.inc()
+        DB_POOL_CHECKED_OUT.inc()
+
+    event.listen(target, "connect", lambda *_: DB_POOL_CONNECTS.inc())
+    event.listen(target, "checkout", checkout)
+    event.listen(target, "checkin", lambda *_: DB_POOL_CHECKED_OUT.dec())
+    _time_statements(target)
+
+
+def _time_statements(target: Engine):
+    """Observe every statement's round trip in the `db_statement_seconds` histogram."""
+    # Statements on one connection run one at a time, so a single start mark per connection is enough
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info["statement_started"] = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("statement_started", None)
+        if started is not None:
+            DB_SECONDS.labels(statement_label(statement)).observe(time.perf_counter() - started)
+
+    event.listen(target, "before_cursor_execute", before)
+    event.listen(target, "after_cursor_execute", after)
+
+
+def _reset_after_fork():
+    global _engines_pid
+    if _engines_pid != os.getpid():
+        # Inherited connections belong to the parent; drop them without closing.
+        for inherited in _engines.values():
+            inherited.dispose(close=False)
+        _engines.clear()
+        _sessionmakers.clear()
+        _engines_pid = os.getpid()
+
+
+def get_engine(url: str = DATABASE_URL, pool_size: Optional[int] = None, max_overflow: Optional[int] = None) -> Engine:
+    """Return the process-wide engine for `url`, creating it on first use."""
+    with _engines_lock:
+        _reset_after_fork()
+        if url not in _engines:
+            _engines[url] = create_engine(
+                url,
+                pool_size=pool_size if pool_size is not None else settings.worker_db_pool_size,
+                max_overflow=max_overflow if max_overflow is not None else settings.worker_db_max_overflow,
+                pool_timeout=settings.db_pool_timeout,
+                pool_recycle=settings.db_pool_recycle,
+                pool_pre_ping=True,
+                pool_use_lifo=True
+            )
+            _instrument(_engines[url])
+            _sessionmakers[url] = sessionmaker(autocommit=False, autoflush=False, bind=_engines[url])
+        return _engines[url]
+
+
+def get_sessionmaker(url: str = DATABASE_URL) -> sessionmaker:
+    """Return the process-wide session factory bound to `get_engine(url)`."""
+    get_engine(url)
+    return _sessionmakers[url]
+
+
+def pool_size_for_queues(queues: Iterable[str]) -> int:
+    """Resolve the pool size for a worker consuming `queues` (largest configured size wins)."""
+    sizes = [settings.worker_queue_pool_sizes[q] for q in queues if q in settings.worker_queue_pool_sizes]
+    return max(sizes) if sizes else settings.worker_db_pool_size
+
+
+def init_worker_engine(queues: Iterable[str] = ()) -> Engine:
+    """
+    Build the shared engine for a freshly forked worker process.
+    Called from the `worker_process_init` signal so the pool is created once per child.
+    """
+    with _engines_lock:
+        _reset_after_fork()
+        stale = _engines.pop(DATABASE_URL, None)
+        _sessionmakers.pop(DATABASE_URL, None)
+    if stale is not None:
+        stale.dispose()
+    return get_engine(DATABASE_URL, pool_size=pool_size_for_queues(queues))
+
+
+def dispose_worker_engine():
+    """Close every pooled connection owned by this process."""
+    with _engines_lock:
+        for owned in _engines.values():
+            owned.dispose()
+        _engines.clear()
+        _sessionmakers.clear()
+
 
 class ConnectionManager:
     """
     Context manager to handle the creation and cleanup of a SQLAlchemy session.
-    Useful for operations that require a dedicated session with a specific DB URL.
+    Sessions are drawn from the process-wide engine for `url`, so connections are
+    pooled and reused across tasks instead of being opened for every instance.
     """
     def __init__(self, url: str = DATABASE_URL):
         self.url = url
-        # Create an engine specific to the provided URL
-        self.engine = create_engine(self.url, pool_pre_ping=True)
-        # Create a sessionmaker bound to the new engine
-        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.Session = get_sessionmaker(self.url)
         self.session = None
 
     def __enter__(self) -> Session:
         """Create and return a new session when entering the context."""
         self.session = self.Session()
+        # Check out the connection eagerly so pool wait time is measured in one place
+        started = time.perf_counter()
+        self.session.connection()
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
         return self.session
 
     def __exit__(self, exc_type, exc_value, tb):
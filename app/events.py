@@ -0,0 +1,99 @@
+import asyncio
+import json
+from typing import Dict, Optional, Set
+
+from redis.exceptions import RedisError
+
+from app.config import Logger, settings
+from app.progress import events_channel
+from app.redis_client import get_async_redis
+
+logger = Logger.get_logger(__name__)
+
+
+class ProgressHub:
+    """
+    One Redis pub/sub connection per API process, shared by every progress stream.
+
+    A request's channel is subscribed while at least one local client follows it, and
+    each event is handed to every such client's queue. Events carry cumulative counters,
+    so a client too slow to keep up loses intermediate events (oldest first), never the
+    current state.
+    """
+    def __init__(self):
+        self._listeners: Dict[str, Set[asyncio.Queue]] = {}
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self, request_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(settings.progress_stream_queue_size)
+        async with self._lock:
+            if self._pubsub is None:
+                self._pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+            listeners = self._listeners.setdefault(request_id, set())
+            if not listeners:
+                await self._pubsub.subscribe(events_channel(request_id))
+            listeners.add(queue)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+        return queue
+
+    async def unsubscribe(self, request_id: str, queue: asyncio.Queue):
+        async with self._lock:
+            listeners = self._listeners.get(request_id)
+            if not listeners:
+                return
+            listeners.discard(queue)
+            if not listeners:
+                del self._listeners[request_id]
+                try:
+                    await self._pubsub.unsubscribe(events_channel(request_id))
+                except RedisError as e:
+                    logger.warning(f"Could not unsubscribe from progress of request {request_id}: {e}")
+
+    async def _read(self):
+        while self._listeners:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except RedisError as e:
+                # The connection re-subscribes to every channel when it reconnects
+                logger.warning(f"Progress subscription interrupted, reconnecting: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            event = json.loads(message["data"])
+            for queue in self._listeners.get(event.get("request_id"), ()):
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(event)
+
+    async def close(self):
+        async with self._lock:
+            self._listeners.clear()
+            if self._reader is not None:
+                self._reader.cancel()
+                self._reader = None
+            if self._pubsub is not None:
+                await self._pubsub.aclose()
+                self._pubsub = None
+
+
+_hub: Optional[ProgressHub] = None
+
+
+def get_hub() -> ProgressHub:
+    """This process's hub, created on first use."""
+    global _hub
+    if _hub is None:
+        _hub = ProgressHub()
+    return _hub
+
+
+async def close_hub():
+    """Drop the shared subscription; called on application shutdown."""
+    global _hub
+    if _hub is not None:
+        await _hub.close()
+        _hub = None
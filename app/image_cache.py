@@ -0,0 +1,224 @@
+import hashlib
+import json
+import posixpath
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from app.config import settings
+from app.metrics import CACHE_EVENTS
+from app.redis_client import get_redis
+from app.storage import content_type_for, get_storage
+
+STATS_KEY = "imgcache:stats"
+LRU_KEY = "imgcache:lru"
+BYTES_KEY = "imgcache:bytes"
+ENTRIES_KEY = "imgcache:entries"
+CONTENT_PREFIX = "imgcache:content:"
+
+# Registers a stored entry: its content key, LRU member, entry and size in one step, so an
+# evictor never sees the member without its size. Only the writer that adds the member
+# accounts for the bytes. Returns 1 if this call added it.
+_REGISTER = """
+redis.call('SET', KEYS[4], ARGV[3], 'EX', ARGV[5])
+if redis.call('ZADD', KEYS[1], 'NX', ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[4])
+redis.call('INCRBY', KEYS[3], cjson.decode(ARGV[4])['size'])
+return 1
+"""
+
+# Unregisters one entry, the member ARGV[1] or else the least recently used one, and
+# returns {member, entry}; nil if there is nothing (left) to evict. The caller deletes
+# the entry's objects afterwards.
+_UNREGISTER = """
+local member = ARGV[1]
+if member == '' then
+    local oldest = redis.call('ZPOPMIN', KEYS[1])
+    if #oldest == 0 then
+        return nil
+    end
+    member = oldest[1]
+elseif redis.call('ZREM', KEYS[1], member) == 0 then
+    return nil
+end
+local entry = redis.call('HGET', KEYS[2], member) or '{"size": 0, "keys": []}'
+redis.call('HDEL', KEYS[2], member)
+redis.call('DECRBY', KEYS[3], cjson.decode(entry)['size'])
+redis.call('DEL', ARGV[2] .. member)
+redis.call('HINCRBY', KEYS[4], 'evicted', 1)
+return {member, entry}
+"""
+
+_scripts: Dict[str, object] = {}
+
+
+def _script(source: str):
+    client = get_redis()
+    script = _scripts.get(source)
+    if script is None or script.registered_client is not client:
+        script = _scripts[source] = client.register_script(source)
+    return script
+
+
+def content_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def cache_stats() -> Dict[str, int]:
+    """Cluster-wide hit/miss/eviction counters."""
+    raw = get_redis().hgetall(STATS_KEY)
+    return {key.decode(): int(value) for key, value in raw.items()}
+
+
+class ImageCache:
+    """
+    Result cache for processed images, keyed two ways:
+
+    * by input URL, remembering the source's ETag/Last-Modified, so a repeated URL
+      is served without downloading (or with a conditional GET once the entry is
+      older than `image_cache_fresh_seconds`);
+    * by SHA-256 of the source bytes plus `transform_key`, so identical content
+      behind different URLs is transformed only once.
+
+    One source can have several outputs (variants). They are content-addressed objects
+    under `image_cache_prefix` in the storage backend, cached and evicted together.
+    Their last use is tracked in a Redis sorted set and the oldest are evicted once the
+    total exceeds `image_cache_max_bytes` or an entry is older than `image_cache_ttl`.
+
+    Lookups return the cached storage keys; `publish` copies them to the image's own
+    keys (`output_key(image_id, variant, extension)`), which rows and exports point to,
+    so evicting a cache entry never breaks a finished request's result URLs.
+    """
+    def __init__(self, transform_key: str, output_key: Callable[[str, str, str], str]):
+        self.transform_key = transform_key
+        self.output_key = output_key
+        self.redis = get_redis()
+        self.storage = get_storage()
+
+    def _url_key(self, url: str) -> str:
+        return f"imgcache:url:{hashlib.sha1(url.encode()).hexdigest()}:{self.transform_key}"
+
+    def _content_key(self, digest: str) -> str:
+        return f"{CONTENT_PREFIX}{self._member(digest)}"
+
+    def _member(self, digest: str) -> str:
+        return f"{digest}:{self.transform_key}"
+
+    def cache_key(self, digest: str, name: str, extension: str) -> str:
+        """Content-addressed storage key of variant `name` for `digest`."""
+        safe_key = self.transform_key.replace(":", "_").replace("/", "_")
+        return f"{settings.image_cache_prefix}/{digest}-{safe_key}-{name}.{extension}"
+
+    def publish(self, image: Dict, keys: Dict[str, str]) -> Optional[Dict[str, str]]:
+        """
+        Copy cached outputs (variant name to cache key) to `image`'s own keys and return their URLs.
+        None if a concurrent eviction deleted one of them first; the caller treats that as a miss.
+        """
+        outputs = {}
+        for name, key in keys.items():
+            extension = posixpath.splitext(key)[1].lstrip(".")
+            try:
+                outputs[name] = self.storage.copy(key, self.output_key(image["image_id"], name, extension))
+            except FileNotFoundError:
+                return None
+        return outputs
+
+    def record(self, event: str):
+        self.redis.hincrby(STATS_KEY, event, 1)
+        CACHE_EVENTS.labels(event).inc()
+
+    def lookup_url(self, url: str) -> Optional[Dict[str, str]]:
+        """Cached entry for `url` whose outputs all still exist in storage, else None. `outputs` holds cache keys."""
+        raw = self.redis.hgetall(self._url_key(url))
+        if not raw:
+            return None
+        entry = {key.decode(): value.decode() for key, value in raw.items()}
+        keys = json.loads(entry.get("outputs") or "{}")
+        if not keys or not all(self.storage.exists(key) for key in keys.values()):
+            self.redis.delete(self._url_key(url))
+            return None
+        entry["outputs"] = keys
+        return entry
+
+    @staticmethod
+    def is_fresh(entry: Dict[str, str]) -> bool:
+        return time.time() - float(entry.get("checked_at", 0)) < settings.image_cache_fresh_seconds
+
+    def remember_url(self, url: str, digest: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        """Point `url` at the cached outputs of `digest`."""
+        keys = self.redis.get(self._content_key(digest))
+        if keys is None:
+            return
+        key = self._url_key(url)
+        mapping = {"digest": digest, "outputs": keys.decode(), "checked_at": time.time()}
+        if etag:
+            mapping["etag"] = etag
+        if last_modified:
+            mapping["last_modified"] = last_modified
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, settings.image_cache_ttl)
+        pipe.execute()
+
+    def revalidated(self, url: str, entry: Dict[str, str]):
+        """The source answered 304: extend the URL entry and the outputs' LRU position."""
+        key = self._url_key(url)
+        pipe = self.redis.pipeline()
+        pipe.hset(key, "checked_at", time.time())
+        pipe.expire(key, settings.image_cache_ttl)
+        pipe.execute()
+        self.touch(entry["digest"])
+
+    def lookup_content(self, digest: str) -> Optional[Dict[str, str]]:
+        """Cache keys of the outputs for `digest`, else None."""
+        raw = self.redis.get(self._content_key(digest))
+        if raw is None:
+            return None
+        keys = json.loads(raw)
+        if not all(self.storage.exists(key) for key in keys.values()):
+            self.redis.delete(self._content_key(digest))
+            return None
+        self.touch(digest)
+        return keys
+
+    def touch(self, digest: str):
+        self.redis.zadd(LRU_KEY, {self._member(digest): time.time()}, xx=True)
+
+    def store_outputs(self, digest: str, variants: Iterable[Tuple[str, bytes, str]]) -> Dict[str, str]:
+        """Write every variant for `digest` to storage, register them, evict if over budget and return their cache keys."""
+        keys = {}
+        size = 0
+        for name, data, extension in variants:
+            key = self.cache_key(digest, name, extension)
+            self.storage.put(key, data, content_type_for(key))
+            keys[name] = key
+            size += len(data)
+
+        entry = json.dumps({"size": size, "keys": list(keys.values())})
+        added = _script(_REGISTER)(
+            keys=[LRU_KEY, ENTRIES_KEY, BYTES_KEY, self._content_key(digest)],
+            args=[time.time(), self._member(digest), json.dumps(keys), entry, settings.image_cache_ttl],
+        )
+        if added:
+            self.evict()
+        return keys
+
+    def evict(self):
+        """Drop entries past their TTL, then least recently used ones until under the size budget."""
+        expired = self.redis.zrangebyscore(LRU_KEY, 0, time.time() - settings.image_cache_ttl)
+        for member in expired:
+            self._evict_member(member.decode())
+        while int(self.redis.get(BYTES_KEY) or 0) > settings.image_cache_max_bytes:
+            if not self._evict_member(""):
+                break
+
+    def _evict_member(self, member: str) -> bool:
+        """Evict `member`, or the least recently used entry if empty; False if another worker got there first."""
+        evicted = _script(_UNREGISTER)(keys=[LRU_KEY, ENTRIES_KEY, BYTES_KEY, STATS_KEY], args=[member, CONTENT_PREFIX])
+        if evicted is None:
+            return False
+        for key in json.loads(evicted[1])["keys"]:
+            self.storage.delete(key)
+        return True
@@ -0,0 +1,118 @@
+import codecs
+import csv
+from typing import AsyncIterator, Dict, List, Tuple
+
+from fastapi import UploadFile
+
+from app.concurrency import run_blocking
+
+REQUIRED_COLUMNS = {'SerialNumber', 'ProductName', 'InputImageUrls'}
+
+
+class CSVFormatError(ValueError):
+    """Raised when the uploaded CSV cannot be used (bad encoding, missing header columns, oversized record)."""
+
+
+class RecordSplitter:
+    """
+    Split decoded text, fed chunk by chunk, into complete CSV records.
+
+    A record ends at a newline outside of quotes, so quoted fields spanning
+    several lines are kept together. Only "\n" ends a line: `str.splitlines`
+    would also break at characters such as U+2028 or \x1c, which the csv
+    module reads as ordinary field content. The unterminated remainder is kept
+    in `pending` together with its quote count, so each character is scanned
+    once however many chunks a record spans. Records longer than
+    `max_record_size` characters (0 = unlimited) raise CSVFormatError, which
+    also bounds what an unbalanced quote can make the splitter hold.
+    """
+    def __init__(self, max_record_size: int = 0):
+        self.max_record_size = max_record_size
+        self.pending = ""
+        self.quotes = 0
+
+    def _check_size(self, size: int):
+        if self.max_record_size and size > self.max_record_size:
+            raise CSVFormatError(
+                f"CSV record longer than {self.max_record_size} characters; check for an unbalanced quote"
+            )
+
+    def feed(self, text: str, final: bool) -> List[str]:
+        """Return the records completed by `text`; with `final`, the unterminated rest as well."""
+        line_start = len(self.pending)
+        text = self.pending + text
+        records = []
+        record_start = 0
+        quotes = self.quotes
+        while True:
+            line_end = text.find("\n", line_start)
+            if line_end == -1:
+                break
+            line_end += 1
+            quotes += text.count('"', line_start, line_end)
+            line_start = line_end
+            if quotes % 2 == 0:
+                self._check_size(line_end - record_start)
+                records.append(text[record_start:line_end])
+                record_start = line_end
+                quotes = 0
+        if final and record_start < len(text):
+            self._check_size(len(text) - record_start)
+            records.append(text[record_start:])
+            record_start = len(text)
+        self.pending = text[record_start:]
+        self.quotes = quotes + text.count('"', line_start) if self.pending else 0
+        self._check_size(len(self.pending))
+        return records
+
+
+def parse_record(record: str) -> List[str]:
+    """Parse a single complete CSV record into its fields."""
+    return next(csv.reader([record]), [])
+
+
+def parse_chunk(decoder: codecs.IncrementalDecoder, splitter: RecordSplitter, chunk: bytes, final: bool) -> List[List[str]]:
+    """Decode one chunk and parse every record it completes. CPU-bound; runs on the blocking pool."""
+    try:
+        text = decoder.decode(chunk, final=final)
+    except UnicodeDecodeError as e:
+        raise CSVFormatError(f"Error reading CSV file: {e}") from e
+    return [parse_record(record) for record in splitter.feed(text, final)]
+
+
+async def iter_csv_records(file: UploadFile, chunk_size: int, max_record_size: int = 0) -> AsyncIterator[List[str]]:
+    """Read `file` in `chunk_size` byte chunks and yield parsed CSV records as they become available."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    splitter = RecordSplitter(max_record_size)
+    while True:
+        chunk = await file.read(chunk_size)
+        final = not chunk
+        records = await run_blocking(parse_chunk, decoder, splitter, chunk, final)
+        for fields in records:
+            yield fields
+        if final:
+            return
+
+
+async def iter_csv_rows(file: UploadFile, chunk_size: int, max_record_size: int = 0) -> AsyncIterator[Tuple[int, Dict[str, str]]]:
+    """
+    Yield `(row_number, row)` pairs from an uploaded CSV without buffering the file.
+
+    The header is validated once, before any row is produced. Blank lines are skipped.
+    """
+    header = None
+    row_number = 0
+    async for fields in iter_csv_records(file, chunk_size, max_record_size):
+        if not fields or fields == ['']:
+            continue
+        if header is None:
+            header = [column.strip() for column in fields]
+            missing = REQUIRED_COLUMNS - set(header)
+            if missing:
+                raise CSVFormatError(f"CSV file is missing required columns: {', '.join(sorted(missing))}")
+            continue
+        row_number += 1
+        yield row_number, dict(zip(header, fields))
+    if header is None:
+        raise CSVFormatError("CSV file is empty.")
+
@@ -0,0 +1,122 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+from app.config import settings
+
+# Correlation fields stamped on every record emitted while they are set: the upload's
+# request id (set by the API, carried into Celery tasks in a message header) and the task
+request_id_var: ContextVar[Optional[str]] = ContextVar("log_request_id", default=None)
+task_var: ContextVar[Optional[dict]] = ContextVar("log_task", default=None)
+
+# Pass as `extra=SAMPLED` on per-image events: they are kept at LOG_SAMPLE_RATE
+SAMPLED = {"sampled": True}
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
+
+# Attributes every LogRecord has; anything else on a record came in through `extra`
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sampled"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, correlation ids and any `extra` fields."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Runs on the emitting thread: drops unsampled per-image events and stamps the correlation ids."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if (getattr(record, "sampled", False) and record.levelno < logging.WARNING
+                and random.random() >= settings.log_sample_rate):
+            return False
+        record.request_id = request_id_var.get()
+        task = task_var.get()
+        if task:
+            record.task_id, record.task_name = task["id"], task["name"]
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the background listener without ever waiting: the message and
+    traceback are rendered here (the arguments may change once we return), and records
+    are dropped and counted when the bounded queue is full.
+    """
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+_lock = threading.Lock()
+_handler: Optional[NonBlockingQueueHandler] = None
+_listener: Optional[QueueListener] = None
+
+
+def _output_handlers():
+    formatter = JsonFormatter() if settings.log_format == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if settings.log_file:
+        handlers.append(RotatingFileHandler(
+            settings.log_file, maxBytes=settings.log_file_max_bytes, backupCount=settings.log_file_backups
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def _start_listener():
+    """(Re)start the writer thread. Forked children (the Celery pool) get a fresh queue and thread."""
+    global _listener
+    _handler.queue = queue.Queue(settings.log_queue_size)
+    _listener = QueueListener(_handler.queue, *_output_handlers(), respect_handler_level=False)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def get_handler() -> NonBlockingQueueHandler:
+    """The process-wide queue handler, with its background writer started on first use."""
+    global _handler
+    with _lock:
+        if _handler is None:
+            _handler = NonBlockingQueueHandler(queue.Queue(settings.log_queue_size))
+            _handler.addFilter(ContextFilter())
+            _start_listener()
+            os.register_at_fork(after_in_child=_start_listener)
+            atexit.register(_stop_listener)
+    return _handler
@@ -0,0 +1,118 @@
+import os
+from typing import Iterable
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from redis.exceptions import RedisError
+
+from app.admission import total_in_flight
+from app.config import settings
+from app.redis_client import get_redis
+
+# Metric values live in the process that records them. With PROMETHEUS_MULTIPROC_DIR set
+# (uvicorn --workers, Celery prefork) every process writes its samples to files in that
+# directory and a scrape merges them, so the directory must be emptied when the service starts.
+
+# Celery queues reported by the queue depth gauge
+QUEUES = ("image_process", "image_fetch", "image_transform", "fast", "slow", "webhooks")
+PRIORITY_STEPS = range(1, 10)
+
+_SECONDS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+_BYTES = tuple(2 ** exponent for exponent in range(10, 26, 2))
+
+CSV_PARSE_SECONDS = Histogram("csv_parse_seconds", "Time spent reading and parsing one uploaded CSV", buckets=_SECONDS)
+ENQUEUE_SECONDS = Histogram("enqueue_seconds", "Time to publish one batch of tasks to the broker", ["task"], buckets=_SECONDS)
+DOWNLOAD_SECONDS = Histogram("image_download_seconds", "Source image download latency", ["host"], buckets=_SECONDS)
+DOWNLOAD_BYTES = Histogram("image_download_bytes", "Source image size", ["host"], buckets=_BYTES)
+TRANSFORM_SECONDS = Histogram("image_transform_seconds", "Image transform time by phase", ["phase"], buckets=_SECONDS)
+DB_SECONDS = Histogram("db_statement_seconds", "Database round trip per statement", ["statement"], buckets=_SECONDS)
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Time a worker session waited for a pooled connection", buckets=_SECONDS)
+WEBHOOK_SECONDS = Histogram("webhook_seconds", "Results webhook delivery latency", ["outcome"], buckets=_SECONDS)
+TASK_SECONDS = Histogram("celery_task_seconds", "Celery task run time", ["task", "state"], buckets=_SECONDS)
+
+CACHE_EVENTS = Counter("image_cache_events", "Image result cache lookups by outcome", ["event"])
+IMAGES_PROCESSED = Counter("images_processed", "Images that reached a final state", ["task", "status"])
+TASK_FAILURES = Counter("celery_task_failures", "Celery tasks that raised", ["task"])
+DB_POOL_CONNECTS = Counter("db_pool_connects", "Database connections opened by the pool")
+DB_POOL_CHECKOUTS = Counter("db_pool_checkouts", "Connections checked out of the pool")
+
+# Summed over the live processes in multiprocess mode
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Pooled connections currently in use", multiprocess_mode="livesum")
+
+
+class QueueCollector:
+    """
+    Gauges read from Redis at scrape time: broker queue depth (summed over the
+    priority sub-queues) and the images in flight across all open requests. A scrape
+    only reads; finished requests are pruned by admission.
+    """
+    def __init__(self, queues: Iterable[str] = QUEUES):
+        self.queues = tuple(queues)
+
+    def collect(self):
+        depth = GaugeMetricFamily("celery_queue_depth", "Messages waiting in a broker queue", labels=["queue"])
+        in_flight = GaugeMetricFamily("images_in_flight", "Images dispatched but not finished")
+        try:
+            pipe = get_redis().pipeline()
+            for queue in self.queues:
+                pipe.llen(queue)
+                for step in PRIORITY_STEPS:
+                    pipe.llen(f"{queue}:{step}")
+            lengths = pipe.execute()
+            per_queue = len(PRIORITY_STEPS) + 1
+            for index, queue in enumerate(self.queues):
+                depth.add_metric([queue], sum(lengths[index * per_queue:(index + 1) * per_queue]))
+            in_flight.add_metric([], total_in_flight())
+        except RedisError:
+            return
+        yield depth
+        yield in_flight
+
+
+def statement_label(statement: str) -> str:
+    """First SQL keyword (SELECT, INSERT, ...) so the label set stays small."""
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+
+
+# Hosts given their own label in this process
+_hosts = set()
+
+
+def host_label(host: str) -> str:
+    """Per-host label, collapsed to "other" once a process has seen METRICS_MAX_HOSTS distinct hosts."""
+    if host in _hosts or len(_hosts) < settings.metrics_max_hosts:
+        _hosts.add(host)
+        return host
+    return "other"
+
+
+class _ProcessRegistry:
+    """Adapter that puts this process's default registry into a per-scrape registry."""
+    def collect(self):
+        return REGISTRY.collect()
+
+
+def scrape_registry(include_queues: bool = False) -> CollectorRegistry:
+    """
+    Registry to expose: merged over all processes in multiprocess mode, else this
+    process's own metrics; `include_queues` adds the Redis-backed gauges.
+    """
+    target = CollectorRegistry()
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.MultiProcessCollector(target)
+    else:
+        target.register(_ProcessRegistry())
+    if include_queues:
+        target.register(QueueCollector())
+    return target
+
+
+def render(include_queues: bool = False):
+    """`(body, content_type)` of a scrape."""
+    return generate_latest(scrape_registry(include_queues)), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int):
+    """Drop a finished process's live gauge files (multiprocess mode only)."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)
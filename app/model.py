@@ -1,12 +1,19 @@
 from sqlalchemy import (
     create_engine,
+    BigInteger,
     Column,
     String,
     Integer,
     Enum,
     ForeignKey,
+    ForeignKeyConstraint,
     Text,
     DateTime,
+    JSON,
+    Index,
+    Uuid,
+    func,
+    text,
 )
 from sqlalchemy.orm import relationship
 import uuid
@@ -29,37 +36,113 @@ class ImageStatus(enum.Enum):
     failed = "failed"
 
 
+class DeliveryKind(enum.Enum):
+    # The request's results file, streamed to WEBHOOK_URL
+    results = "results"
+    # A completion notice to the request's callback URL; notices to one URL are sent in batches
+    notice = "notice"
+
+
+class DeliveryStatus(enum.Enum):
+    pending = "pending"
+    delivered = "delivered"
+    # Attempts exhausted or rejected by the receiver; kept for inspection and manual retry
+    dead = "dead"
+
+
 class Request(Base):
     __tablename__ = "requests"
 
-    request_id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    request_id = Column(Uuid(as_uuid=False), primary_key=True, default=lambda: str(uuid.uuid4()))
     status = Column(Enum(RequestStatus), default=RequestStatus.pending)
-    created_at = Column(DateTime, default=datetime.now())
-    updated_at = Column(DateTime, default=datetime.now(), onupdate=datetime.now())
+    # Callables, so every row gets its own timestamp (not the time this module was imported)
+    created_at = Column(DateTime, default=datetime.now, server_default=func.now(), nullable=False, index=True)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    # Set once the request's rows have been written to the archive by the retention job
+    archived_at = Column(DateTime, nullable=True)
     
     total_images= Column(Integer)
+    # Maintained by workers in the same transaction as the image status updates
+    completed_images = Column(Integer, nullable=False, default=0, server_default="0")
+    failed_images = Column(Integer, nullable=False, default=0, server_default="0")
+    # TransformSpec the request was uploaded with; null means the default 50% resize
+    transform = Column(JSON, nullable=True)
+    # Receives a completion notice once the request is finalized
+    callback_url = Column(Text, nullable=True)
     products = relationship("Product", back_populates="request")
 
 
 class Product(Base):
     __tablename__ = "products"
 
-    product_id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    request_id = Column(String, ForeignKey("requests.request_id"))
+    product_id = Column(Uuid(as_uuid=False), primary_key=True, default=lambda: str(uuid.uuid4()))
+    request_id = Column(Uuid(as_uuid=False), ForeignKey("requests.request_id"), index=True)
+    # Partition key: the owning request's created_at, so all rows of a request share a partition
+    request_created_at = Column(DateTime, primary_key=True, nullable=False, server_default=func.now())
     serial_number = Column(Integer)
     product_name = Column(String)
 
     request = relationship("Request", back_populates="products")
     image_urls = relationship("ImageUrl", back_populates="product")
 
+    __table_args__ = {"postgresql_partition_by": "RANGE (request_created_at)"}
+    # The partition key is part of the table's primary key only because PostgreSQL requires it
+    __mapper_args__ = {"primary_key": [product_id]}
+
 
 class ImageUrl(Base):
     __tablename__ = "image_urls"
 
-    image_id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    product_id = Column(String, ForeignKey("products.product_id"))
+    image_id = Column(Uuid(as_uuid=False), primary_key=True, default=lambda: str(uuid.uuid4()))
+    product_id = Column(Uuid(as_uuid=False))
+    # Copied from the product so per-request queries stay on this table
+    request_id = Column(Uuid(as_uuid=False), ForeignKey("requests.request_id"))
+    # Partition key, as on products
+    request_created_at = Column(DateTime, primary_key=True, nullable=False, server_default=func.now())
     input_image_url = Column(Text)
     output_image_url = Column(Text, nullable=True)
+    # Variant name (longest-edge size) -> output location, for requests with a TransformSpec
+    output_variants = Column(JSON, nullable=True)
     status = Column(Enum(ImageStatus), default=ImageStatus.pending)
+    # Times the image was handed out again after a transient error or a lost worker
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    # Last status change; the sweeper requeues rows left 'processing' for too long
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
 
     product = relationship("Product", back_populates="image_urls")
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["product_id", "request_created_at"], ["products.product_id", "products.request_created_at"],
+            name="image_urls_product_id_fkey"
+        ),
+        Index("ix_image_urls_product_id_status", "product_id", "status"),
+        Index("ix_image_urls_request_id_status", "request_id", "status"),
+        Index("ix_image_urls_processing_updated_at", "updated_at", postgresql_where=text("status = 'processing'")),
+        {"postgresql_partition_by": "RANGE (request_created_at)"},
+    )
+    __mapper_args__ = {"primary_key": [image_id]}
+
+
+class WebhookDelivery(Base):
+    """Outbox of outgoing webhook calls, written with the request's final status and drained by the webhooks queue."""
+    __tablename__ = "webhook_deliveries"
+
+    delivery_id = Column(BigInteger, primary_key=True, autoincrement=True)
+    request_id = Column(Uuid(as_uuid=False), nullable=False, index=True)
+    kind = Column(Enum(DeliveryKind), nullable=False)
+    url = Column(Text, nullable=False)
+    # Notice body; results deliveries stream the export instead
+    payload = Column(JSON, nullable=True)
+    status = Column(Enum(DeliveryStatus), nullable=False, default=DeliveryStatus.pending)
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    # When the delivery is next due; a claimed delivery is pushed out by the lease, so one whose
+    # worker died becomes due again by itself
+    next_attempt_at = Column(DateTime, nullable=False, server_default=func.now())
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    delivered_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_webhook_deliveries_due", "next_attempt_at", postgresql_where=text("status = 'pending'")),
+    )
@@ -0,0 +1,77 @@
+import re
+from datetime import date, datetime
+from typing import List, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+# Range-partitioned by the owning request's created_at, one partition per month,
+# plus a DEFAULT partition for rows outside every pre-made range
+PARTITIONED_TABLES = ("products", "image_urls")
+# Referencing table first: image_urls partitions must go before the products partitions they point at
+DROP_ORDER = ("image_urls", "products")
+
+_PARTITION_NAME = re.compile(r"^(?P<table>\w+)_y(?P<year>\d{4})m(?P<month>\d{2})$")
+
+
+def month_start(value: Union[date, datetime]) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+
+def is_partition_name(name: str) -> bool:
+    """True for tables created by this module (monthly and default partitions), which are not in the ORM metadata."""
+    return bool(_PARTITION_NAME.match(name)) or any(name == f"{table}_default" for table in PARTITIONED_TABLES)
+
+
+def ensure_partitions(conn: Connection, first: Union[date, datetime], last: Union[date, datetime]) -> List[str]:
+    """Create the monthly partitions of every partitioned table from `first` through `last`. Returns the new ones."""
+    created = []
+    month, last = month_start(first), month_start(last)
+    while month <= last:
+        for table in PARTITIONED_TABLES:
+            name = partition_name(table, month)
+            exists = conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+            if not exists:
+                conn.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+                ))
+                created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def list_partitions(conn: Connection, table: str) -> List[Tuple[str, date]]:
+    """Monthly partitions of `table` as (name, first day of month), oldest first."""
+    names = conn.execute(
+        text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+             "WHERE i.inhparent = CAST(:table AS regclass)"),
+        {"table": table},
+    ).scalars()
+    partitions = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions.append((name, date(int(match["year"]), int(match["month"]), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def drop_month(conn: Connection, month: date):
+    """
+    Drop one month from every partitioned table. Detaching first releases the
+    foreign keys between partitions; dropping is a catalog change, not a DELETE.
+    """
+    for table in DROP_ORDER:
+        name = partition_name(table, month)
+        if conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar():
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
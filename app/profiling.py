@@ -0,0 +1,198 @@
+import json
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from app.config import settings
+from app.redis_client import get_redis
+
+# Set while handling a profiled upload or task; carried into the tasks it publishes in a
+# message header, the same way as the log request id
+profile_requested: ContextVar[bool] = ContextVar("profile_requested", default=False)
+# The profiler of the current upload, which blocking calls (run_blocking) attach their thread to
+active_profiler: ContextVar[Optional["SamplingProfiler"]] = ContextVar("active_profiler", default=None)
+
+PROFILE_MESSAGE_HEADER = "profile"
+
+
+def stacks_key(request_id: str) -> str:
+    return f"request:{request_id}:profile:stacks"
+
+
+def runs_key(request_id: str) -> str:
+    return f"request:{request_id}:profile:runs"
+
+
+def wants_profile(flag: bool = False) -> bool:
+    """Whether to profile an upload: asked for explicitly, or picked at PROFILE_SAMPLE_RATE."""
+    return flag or (settings.profile_sample_rate > 0 and random.random() < settings.profile_sample_rate)
+
+
+def _frame_name(frame) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+
+def collapse(frame) -> str:
+    """The frame's stack, outermost call first, in collapsed-stack notation (`a;b;c`)."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Records the stacks of a set of threads every `interval` seconds from a background thread.
+
+    The profiled code runs untouched: no tracing hook is installed, so the cost is one
+    `sys._current_frames()` walk per interval while sampling and nothing otherwise. With
+    `threads=None` every thread of the process but the sampler is recorded.
+    """
+    def __init__(self, interval: float, threads: Optional[Iterable[int]] = None):
+        self.interval = interval
+        self.threads: Optional[Set[int]] = set(threads) if threads is not None else None
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def attach(self, thread_id: int):
+        with self._lock:
+            if self.threads is not None:
+                self.threads.add(thread_id)
+
+    def detach(self, thread_id: int):
+        with self._lock:
+            if self.threads is not None:
+                self.threads.discard(thread_id)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                threads = None if self.threads is None else set(self.threads)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own and (threads is None or thread_id in threads):
+                    self.stacks[collapse(frame)] += 1
+            self.samples += 1
+
+
+# tracemalloc is process-wide: it runs while any profiled run does
+_tracing_lock = threading.Lock()
+_tracing_runs = 0
+
+
+def _start_tracing():
+    global _tracing_runs
+    with _tracing_lock:
+        if _tracing_runs == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing_runs += 1
+        # Python 3.9+; before that the peak counts from when tracing started
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+
+def _stop_tracing() -> int:
+    global _tracing_runs
+    with _tracing_lock:
+        _, peak = tracemalloc.get_traced_memory()
+        _tracing_runs -= 1
+        if _tracing_runs == 0:
+            tracemalloc.stop()
+    return peak
+
+
+class ProfileRun:
+    """One profiled unit of work (the upload handler or one task): its stacks, wall time and allocation peak."""
+    def __init__(self, name: str, threads: Optional[Iterable[int]] = None):
+        self.name = name
+        self.profiler = SamplingProfiler(settings.profile_interval, threads)
+        self.tracemalloc = settings.profile_tracemalloc
+        self.seconds = 0.0
+        self.alloc_peak: Optional[int] = None
+        self._started = 0.0
+
+    def start(self) -> "ProfileRun":
+        if self.tracemalloc:
+            _start_tracing()
+        self._started = time.perf_counter()
+        self.profiler.start()
+        return self
+
+    def stop(self):
+        self.profiler.stop()
+        self.seconds = time.perf_counter() - self._started
+        if self.tracemalloc:
+            self.alloc_peak = _stop_tracing()
+
+    def save(self, request_id: str, task_id: Optional[str] = None):
+        """Merge the stacks into the request's profile and add this run to its list."""
+        run = {
+            "name": self.name,
+            "task_id": task_id,
+            "seconds": round(self.seconds, 6),
+            "samples": self.profiler.samples,
+            "alloc_peak_bytes": self.alloc_peak,
+        }
+        pipe = get_redis().pipeline()
+        for stack, count in self.profiler.stacks.items():
+            pipe.hincrby(stacks_key(request_id), stack, count)
+        pipe.rpush(runs_key(request_id), json.dumps(run))
+        pipe.expire(stacks_key(request_id), settings.profile_ttl)
+        pipe.expire(runs_key(request_id), settings.profile_ttl)
+        pipe.execute()
+
+
+def load_profile(request_id: str) -> Tuple[Dict[str, int], List[Dict]]:
+    """The request's merged stacks (stack to sample count) and its runs; both empty if it was not profiled."""
+    pipe = get_redis().pipeline()
+    pipe.hgetall(stacks_key(request_id))
+    pipe.lrange(runs_key(request_id), 0, -1)
+    stacks, runs = pipe.execute()
+    return {stack.decode(): int(count) for stack, count in stacks.items()}, [json.loads(run) for run in runs]
+
+
+def to_collapsed(stacks: Mapping[str, int]) -> str:
+    """Brendan Gregg's folded format (`a;b;c 12` per line), as read by flamegraph.pl and speedscope."""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+def to_speedscope(name: str, stacks: Mapping[str, int], interval: float) -> Dict:
+    """A speedscope "sampled" profile; each sample weighs `interval` seconds."""
+    frames: Dict[str, int] = {}
+    samples, weights = [], []
+    for stack, count in sorted(stacks.items()):
+        samples.append([frames.setdefault(frame, len(frames)) for frame in stack.split(";")])
+        weights.append(count * interval)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "image-processing-service",
+        "shared": {"frames": [{"name": frame} for frame in frames]},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
@@ -0,0 +1,179 @@
+import json
+from typing import Dict, List, Optional
+
+from app.config import settings
+from app.redis_client import get_redis
+
+
+def progress_key(request_id: str) -> str:
+    return f"request:{request_id}:progress"
+
+
+def events_channel(request_id: str) -> str:
+    """Pub/sub channel of the request's progress events, fanned out by the API (app.events)."""
+    return f"request:{request_id}:events"
+
+
+def _counters(raw: Dict) -> Dict[str, int]:
+    return {key.decode() if isinstance(key, bytes) else key: int(value) for key, value in raw.items()}
+
+
+def publish_event(request_id: str, event: Dict):
+    """Publish one event to whoever streams the request's progress; nothing is kept if nobody listens."""
+    get_redis().publish(events_channel(request_id), json.dumps({"request_id": request_id, **event}, default=str))
+
+
+def init_progress(request_id: str):
+    """Create the counters for a new request."""
+    key = progress_key(request_id)
+    pipe = get_redis().pipeline()
+    pipe.hset(key, mapping={"total": 0, "completed": 0, "failed": 0})
+    pipe.expire(key, settings.progress_ttl)
+    pipe.execute()
+
+
+def add_total(request_id: str, images: int):
+    """Account for newly dispatched images."""
+    key = progress_key(request_id)
+    pipe = get_redis().pipeline()
+    pipe.hincrby(key, "total", images)
+    pipe.expire(key, settings.progress_ttl)
+    pipe.execute()
+
+
+def add_finished(request_id: str, completed: int = 0, failed: int = 0, images: Optional[List[Dict]] = None) -> bool:
+    """
+    Account for images that reached a final state, and publish a `progress` event with
+    the updated counters and, when given, the finished `images` (id, status, output URL).
+    True if the request is now done and this caller is the one to finalize it.
+    """
+    key = progress_key(request_id)
+    pipe = get_redis().pipeline()
+    if completed:
+        pipe.hincrby(key, "completed", completed)
+    if failed:
+        pipe.hincrby(key, "failed", failed)
+    pipe.expire(key, settings.progress_ttl)
+    pipe.hgetall(key)
+    counters = _counters(pipe.execute()[-1])
+    event = {"type": "progress", **to_progress(counters.get("total", 0), counters.get("completed", 0), counters.get("failed", 0))}
+    if images:
+        event["images"] = images
+    publish_event(request_id, event)
+    return _claim_if_done(key, counters)
+
+
+# Seals the counters only if they still hold a total: a hash that expired or was evicted
+# would otherwise come back as {sealed: 1} and read as done. Returns the counters, or nil
+_SEAL = """
+if redis.call('HEXISTS', KEYS[1], 'total') == 0 then
+    return nil
+end
+redis.call('HSET', KEYS[1], 'sealed', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('HGETALL', KEYS[1])
+"""
+
+_seal_script = None
+
+
+def seal(request_id: str) -> Optional[bool]:
+    """
+    Record that every image of the request has been dispatched, so its total is final.
+    True if its images are all finished already and this caller is the one to finalize it.
+    None if the counters are gone (expired or evicted): they cannot tell when the request
+    is done, so the caller must fall back to the database barrier.
+    """
+    global _seal_script
+    client = get_redis()
+    if _seal_script is None or _seal_script.registered_client is not client:
+        _seal_script = client.register_script(_SEAL)
+    key = progress_key(request_id)
+    flat = _seal_script(keys=[key], args=[settings.progress_ttl])
+    if flat is None:
+        return None
+    return _claim_if_done(key, _counters(dict(zip(flat[::2], flat[1::2]))))
+
+
+def claim_finalization(request_id: str) -> bool:
+    """Take the request's finalization whatever its counters say; False if someone already has."""
+    return bool(get_redis().hsetnx(progress_key(request_id), "finalizing", 1))
+
+
+def _claim_if_done(key: str, counters: Dict[str, int]) -> bool:
+    """
+    The request barrier. Counter updates and `seal` each read the hash in the transaction
+    that changed it, so whichever change completes a sealed request sees it done; HSETNX
+    then lets exactly one of the callers that saw it done finalize.
+    """
+    if not counters.get("sealed") or counters.get("finalizing"):
+        return False
+    if counters.get("completed", 0) + counters.get("failed", 0) < counters.get("total", 0):
+        return False
+    return bool(get_redis().hsetnx(key, "finalizing", 1))
+
+
+def mark_finished(request_id: str):
+    """Record that the request is finalized and tell its streams, which end with this `completed` event."""
+    key = progress_key(request_id)
+    pipe = get_redis().pipeline()
+    pipe.hset(key, "finished", 1)
+    pipe.expire(key, settings.progress_ttl)
+    pipe.hgetall(key)
+    counters = _counters(pipe.execute()[-1])
+    publish_event(request_id, {
+        "type": "completed",
+        **to_progress(counters.get("total", 0), counters.get("completed", 0), counters.get("failed", 0)),
+    })
+
+
+def to_progress(total: int, completed: int, failed: int) -> Dict[str, float]:
+    done = completed + failed
+    return {
+        "total": total,
+        "completed": completed,
+        "failed": failed,
+        "percent": (done / total) * 100 if total else 0,
+    }
+
+
+def get_progress(request_ids: List[str]) -> Dict[str, Optional[Dict[str, float]]]:
+    """Counters for every id in one round trip; None where Redis has no entry."""
+    pipe = get_redis().pipeline()
+    for request_id in request_ids:
+        pipe.hgetall(progress_key(request_id))
+    progress = {}
+    for request_id, raw in zip(request_ids, pipe.execute()):
+        if not raw:
+            progress[request_id] = None
+            continue
+        counters = _counters(raw)
+        progress[request_id] = to_progress(counters.get("total", 0), counters.get("completed", 0), counters.get("failed", 0))
+    return progress
+
+
+def mark_reopened(request_id: str) -> bool:
+    """
+    Undo `mark_finished` for a request that was reopened to process images again, and
+    open its barrier for another finalization. True if it is done again already (nothing
+    was left to process) and this caller is the one to finalize it.
+    """
+    key = progress_key(request_id)
+    pipe = get_redis().pipeline()
+    pipe.hdel(key, "finished", "finalizing")
+    pipe.hgetall(key)
+    counters = _counters(pipe.execute()[-1])
+    publish_event(request_id, {"type": "reopened"})
+    return _claim_if_done(key, counters)
+
+
+def get_snapshot(request_id: str) -> Optional[Dict]:
+    """The request's counters and whether it is finalized, from Redis; None if Redis has no entry."""
+    raw = get_redis().hgetall(progress_key(request_id))
+    if not raw:
+        return None
+    counters = _counters(raw)
+    return {
+        **to_progress(counters.get("total", 0), counters.get("completed", 0), counters.get("failed", 0)),
+        "finished": bool(counters.get("finished")),
+    }
@@ -0,0 +1,77 @@
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from redis.exceptions import RedisError
+
+from app.config import Logger, settings
+from app.redis_client import get_redis
+
+logger = Logger.get_logger(__name__)
+
+# Token bucket kept in a Redis hash so every worker process shares one budget per key.
+# Uses the server clock, so hosts with skewed clocks still agree. Returns "0" when a
+# token was taken, otherwise the seconds until one is available (nothing is consumed).
+_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+_script = None
+
+
+def _bucket():
+    global _script
+    client = get_redis()
+    if _script is None or _script.registered_client is not client:
+        _script = client.register_script(_TOKEN_BUCKET)
+    return _script
+
+
+def host_rate(host: str) -> float:
+    """Requests per second allowed to `host`: a HOST_RATE_LIMITS entry, else HOST_RATE_LIMIT (0 = unlimited)."""
+    return settings.host_rate_limits.get(host, settings.host_rate_limit)
+
+
+def acquire(key: str, rate: float, burst: int) -> float:
+    """Take one token from bucket `key`; returns 0 on success or the seconds to wait before retrying."""
+    return float(_bucket()(keys=[f"ratelimit:{key}"], args=[rate, max(1, burst)]))
+
+
+def wait_for_host(url: str, max_sleep: float = 5.0) -> Optional[float]:
+    """
+    Block until the origin host of `url` has a token, sleeping in steps of at most
+    `max_sleep` seconds. Returns the time spent waiting, or None when the host is
+    unlimited. Fails open if Redis is unavailable.
+    """
+    host = (urlsplit(url).hostname or "").lower()
+    rate = host_rate(host)
+    if rate <= 0:
+        return None
+    waited = 0.0
+    while True:
+        try:
+            delay = acquire(f"host:{host}", rate, settings.host_rate_burst)
+        except RedisError as e:
+            logger.warning(f"Rate limiter unavailable, not throttling {host}: {e}")
+            return waited
+        if delay <= 0:
+            return waited
+        delay = min(delay, max_sleep)
+        time.sleep(delay)
+        waited += delay
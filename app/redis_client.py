@@ -0,0 +1,32 @@
+import os
+from typing import TYPE_CHECKING, Optional
+
+import redis
+
+from app.config import settings
+
+if TYPE_CHECKING:
+    import redis.asyncio
+
+_client: Optional[redis.Redis] = None
+_client_pid: Optional[int] = None
+_async_client: Optional["redis.asyncio.Redis"] = None
+
+
+def get_redis() -> redis.Redis:
+    """Process-wide Redis client for the configured host/port/db; rebuilt after fork."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = redis.Redis(host=settings.redis_host, port=settings.redis_port, db=settings.redis_db)
+        _client_pid = os.getpid()
+    return _client
+
+
+def get_async_redis() -> "redis.asyncio.Redis":
+    """Asyncio Redis client for the API's event loop, created on first use (workers never load redis.asyncio)."""
+    global _async_client
+    if _async_client is None:
+        import redis.asyncio
+
+        _async_client = redis.asyncio.Redis(host=settings.redis_host, port=settings.redis_port, db=settings.redis_db)
+    return _async_client
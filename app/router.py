@@ -1,32 +1,55 @@
+import asyncio
+import contextlib
 from datetime import datetime
-import io
 import json
+import threading
+import time
 import traceback
-import uuid, ast
-from fastapi import APIRouter, Depends, UploadFile, HTTPException, status
-from fastapi.responses import JSONResponse
+import uuid
+from fastapi import APIRouter, Depends, Form, UploadFile, HTTPException, Request as HTTPRequest, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from celery import Signature, group
 from celery.result import AsyncResult
-from celery import chord
-import pandas as pd
-from typing import List
-from sqlalchemy import text, update
-from sqlalchemy.orm import Session
+from typing import Dict, List, Literal, Optional
+from pydantic import AnyHttpUrl, TypeAdapter, ValidationError
+from redis.exceptions import RedisError
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.config import Logger
+from app.admission import admit, close as close_admission, fair_priority, request_in_flight, tenant_of
+from app.concurrency import run_blocking
+from app.crud import bulk_insert_products_async, product_key
+from app.config import Logger, settings
 from app.database import get_db
-from app.model import ImageUrl, Request, ImageStatus, Product
-from app.schema import ProductAdd
-from celery_worker.task import add, finalize_request, process_product, simulate_long_task
+from app.events import get_hub
+from app.image_cache import cache_stats
+from app.ingest import CSVFormatError, iter_csv_rows
+from app.log import request_id_var
+from app.metrics import CSV_PARSE_SECONDS, ENQUEUE_SECONDS
+from app.model import DeliveryStatus, Request, RequestStatus, WebhookDelivery
+from app.profiling import ProfileRun, active_profiler, load_profile, profile_requested, to_collapsed, to_speedscope, wants_profile
+from app.progress import add_total, get_progress, get_snapshot, init_progress, seal, to_progress
+from app.schema import ProductAdd, StatusBatchQuery, TransformSpec
+from celery_worker.worker import BULK_COMPRESSION, celery_app
 
 router = APIRouter()
-logger = Logger.get_logger()
+logger = Logger.get_logger(__name__)
 
-@router.get("/health_check")
-async def health_check():
+
+def _task(name: str, *args, **options) -> Signature:
+    """
+    Signature of the worker task registered as `name`. Tasks are published by name (queues
+    come from `task_routes`), so the API never imports celery_worker.task and what it loads.
+    """
+    return celery_app.signature(name, args=args, **options)
+
+_http_url = TypeAdapter(AnyHttpUrl)
+
+def _enqueue_health_tasks() -> dict:
     # Add tasks to the queue
     task_ids = []
     for i in range(5, 10):
-        result = simulate_long_task.apply_async(args=[i])
+        result = _task('simulate_long_task_for_a_while', i).apply_async()
         task_ids.append(result.id)
     
     # Check the status of the tasks
@@ -34,6 +57,13 @@ async def health_check():
     for task_id in task_ids:
         result = AsyncResult(task_id)
         task_statuses[task_id] = result.status
+    return task_statuses
+
+
+@router.get("/health_check")
+async def health_check():
+    # Broker round trips are blocking; keep them off the event loop
+    task_statuses = await run_blocking(_enqueue_health_tasks)
     
     return {
         "status": "Tasks have been added to the queue.",
@@ -41,112 +71,370 @@ async def health_check():
         "task_statuses": task_statuses
     }
 
+def _publish_products(products: List[ProductAdd], priority: int = 0):
+    with ENQUEUE_SECONDS.labels('process_product').time():
+        # JSON-compatible values (request_created_at as ISO text), which every task serializer can carry
+        group(_task('process_product', product.model_dump(mode="json")) for product in products).apply_async(priority=priority)
+
+
+def _publish_image_chunks(request_id: str, images: List[dict], chunk_size: int, transform_spec: Optional[dict], priority: int = 0):
+    # PIPELINE_MODE=staged sends chunks to the fetch stage, which hands them on to the transform stage
+    name = 'fetch_images' if settings.pipeline_mode == "staged" else 'process_image_chunk'
+    with ENQUEUE_SECONDS.labels(name).time():
+        group(
+            _task(name, images[start:start + chunk_size], transform_spec, request_id, compression=BULK_COMPRESSION)
+            for start in range(0, len(images), chunk_size)
+        ).apply_async(priority=priority)
+
+
+async def _dispatch_products(db: AsyncSession, request_id: str, products: List[ProductAdd], priority: int = 0) -> int:
+    """
+    Publish one batch of work and add its images to the request total.
+
+    With TASK_GRANULARITY=product each row becomes one process_product task. With
+    TASK_GRANULARITY=image the rows are persisted here and their images are spread
+    over process_image_chunk tasks of IMAGE_CHUNK_SIZE, so one heavy row cannot
+    pin a single worker. `priority` is the broker priority from `fair_priority`.
+    """
+    image_count = sum(len(product.images) for product in products)
+    await db.execute(
+        update(Request).
+        where(Request.request_id == request_id).
+        values(total_images=Request.total_images + image_count)
+    )
+    if settings.task_granularity == "image":
+        images_by_product = await bulk_insert_products_async(db, [
+            {
+                "product_id": product_key(request_id, product.product_id, product.row),
+                "request_id": request_id,
+                "request_created_at": product.request_created_at,
+                # asyncpg, unlike psycopg2, does not coerce strings for the integer column
+                "serial_number": int(product.product_id),
+                "product_name": product.name,
+                "images": product.images,
+            }
+            for product in products
+        ])
+        await db.commit()
+        images = [
+            {"image_id": row["image_id"], "input_image_url": row["input_image_url"]}
+            for rows in images_by_product.values()
+            for row in rows
+        ]
+        if images:
+            transform_spec = products[0].transform.model_dump() if products[0].transform else None
+            await run_blocking(_publish_image_chunks, request_id, images, settings.image_chunk_size, transform_spec, priority)
+    else:
+        await db.commit()
+        await run_blocking(_publish_products, products, priority)
+    return image_count
+
+
+async def _close_admission(request_id: str):
+    """The upload dispatched all it will: let the request leave the admission sets once drained."""
+    try:
+        await run_blocking(close_admission, request_id)
+    except RedisError as e:
+        logger.warning(f"Could not close request {request_id} for admission control: {e}")
+
+
+async def _wait_for_capacity(request_id: str):
+    """
+    Hold the upload while this request has ADMISSION_MAX_INFLIGHT_PER_REQUEST images
+    queued. The body is not read meanwhile, so the backpressure reaches the client.
+    """
+    limit = settings.admission_max_inflight_per_request
+    if not limit:
+        return
+    try:
+        while await run_blocking(request_in_flight, request_id) >= limit:
+            await asyncio.sleep(settings.admission_poll_interval)
+    except RedisError as e:
+        logger.warning(f"Admission counters unavailable, not pausing request {request_id}: {e}")
+
+
+@contextlib.asynccontextmanager
+async def _profiled(name: str, http_request: HTTPRequest, asked: bool):
+    """
+    Profile the block when the client asks for it (PROFILE_HEADER or `profile=true`) or
+    the upload is sampled at PROFILE_SAMPLE_RATE. The flag travels on to the request's
+    tasks, and the profile is stored under the request id the block assigned.
+    """
+    asked = asked or http_request.headers.get(settings.profile_header, "").lower() in ("1", "true")
+    if not wants_profile(asked):
+        yield
+        return
+    # The event loop thread, plus every pool thread while it runs this upload's run_blocking calls
+    run = ProfileRun(name, threads=[threading.get_ident()]).start()
+    tokens = profile_requested.set(True), active_profiler.set(run.profiler)
+    try:
+        yield
+    finally:
+        run.stop()
+        profile_requested.reset(tokens[0])
+        active_profiler.reset(tokens[1])
+        request_id = request_id_var.get()
+        if request_id:
+            try:
+                await run_blocking(run.save, request_id)
+            except RedisError as e:
+                logger.warning(f"Could not store the profile of request {request_id}: {e}")
+
+
 @router.post("/upload")
-async def upload_csv_file(file: UploadFile, db: Session = Depends(get_db)):
+async def upload_csv_file(
+    http_request: HTTPRequest,
+    file: UploadFile,
+    transform: Optional[str] = Form(None),
+    callback_url: Optional[str] = Form(None),
+    profile: bool = Form(False),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Accept a product CSV. `transform` is an optional JSON TransformSpec, e.g.
+    {"sizes": [1024, 256], "format": "WEBP", "quality": 80}; without it every
+    image gets the default 50% JPEG resize. `callback_url` is an optional http(s)
+    URL that receives a completion notice once every image is final. `profile=true`
+    (or the PROFILE_HEADER header) profiles the upload and its tasks; see GET /v1/profile.
+
+    Uploads are refused with 429 and Retry-After while the caller's tenant (the
+    TENANT_HEADER value, else the client address) has too many images in flight.
+    """
+    async with _profiled("upload_csv_file", http_request, profile):
+        return await _upload(http_request, file, transform, callback_url, db)
+
+
+async def _upload(
+    http_request: HTTPRequest,
+    file: UploadFile,
+    transform: Optional[str],
+    callback_url: Optional[str],
+    db: AsyncSession,
+):
     try:
         if not file.filename.endswith('.csv'):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Only CSV files are allowed.")
-        
-        content = await file.read()
-        try:
-            data = io.StringIO(content.decode('utf-8'))
-            df = pd.read_csv(data, sep=",")
-            
-            print(df.head())
-        except Exception as e:
-            return JSONResponse(content={"message": f"Error reading CSV file: {e}"}, status_code=status.HTTP_400_BAD_REQUEST)
-
-        required_columns = {'SerialNumber', 'ProductName', 'InputImageUrls'}
-        
-        if not required_columns.issubset(df.columns):
-            missing = required_columns - set(df.columns)
-            return JSONResponse(content={"message": f"CSV file is missing required columns: {', '.join(missing)}"}, status_code=status.HTTP_400_BAD_REQUEST)
-            
+
+        transform_spec = None
+        if transform:
+            try:
+                transform_spec = TransformSpec.model_validate_json(transform)
+            except ValidationError as e:
+                return JSONResponse(content={"message": f"Invalid transform: {e}"}, status_code=status.HTTP_400_BAD_REQUEST)
+
+        if callback_url:
+            try:
+                _http_url.validate_python(callback_url)
+            except ValidationError:
+                return JSONResponse(content={"message": "callback_url must be an http(s) URL."}, status_code=status.HTTP_400_BAD_REQUEST)
+
         unique_request_id = uuid.uuid4().hex
+        # Stamped on this handler's log records and carried into every task it publishes
+        request_id_var.set(unique_request_id)
+
+        tenant = tenant_of(http_request.headers, http_request.client.host if http_request.client else None)
+        try:
+            retry_after, tenant_in_flight = await run_blocking(admit, tenant, unique_request_id)
+        except RedisError as e:
+            logger.warning(f"Admission counters unavailable, admitting upload from {tenant}: {e}")
+            retry_after, tenant_in_flight = None, 0
+        if retry_after is not None:
+            return JSONResponse(
+                content={"message": "Too many images in flight, retry later."},
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={"Retry-After": str(retry_after)}
+            )
+
+        rows = iter_csv_rows(file, settings.csv_chunk_size, settings.csv_max_record_size)
+        try:
+            # Reading the first row validates the header before anything is persisted
+            first_row = await rows.__anext__()
+        except StopAsyncIteration:
+            first_row = None
+        except CSVFormatError as e:
+            await _close_admission(unique_request_id)
+            return JSONResponse(content={"message": str(e)}, status_code=status.HTTP_400_BAD_REQUEST)
+
+        # Kept in hand: it is also the partition key of every product and image row of the request
+        created_at = datetime.now()
 
         new_request = Request(
             request_id=unique_request_id,
-            total_images=df.__len__()
+            created_at=created_at,
+            total_images=0,
+            transform=transform_spec.model_dump() if transform_spec else None,
+            callback_url=callback_url or None,
         )
         db.add(new_request)
-        db.commit()  
-        
-        tasks= []
-        csv_total_images= 0
-        for index, product_row in df.iterrows():
+        await db.commit()
+        # Whether the request's Redis counters are complete, so the Redis barrier can decide
+        # when it is done; once any counter update fails it falls back to polling the database
+        redis_barrier = True
+        try:
+            await run_blocking(init_progress, unique_request_id)
+        except RedisError as e:
+            logger.warning(f"Could not create progress counters of request {unique_request_id}, using the database barrier: {e}")
+            redis_barrier = False
+
+        # Rows are parsed as the upload is read and handed to the broker in bounded
+        # batches, so memory stays flat and workers start before parsing finishes.
+        batch: List[ProductAdd] = []
+        product_count = 0
+        # Images dispatched so far; with the tenant's backlog this sets the batch priority
+        image_count = 0
+        skipped_rows = []
+        stream_error = None
+        # Upload time minus dispatch time is what reading and parsing the CSV cost
+        parse_started = time.perf_counter()
+        dispatch_seconds = 0.0
+
+        async def _rows():
+            if first_row is not None:
+                yield first_row
+            async for row in rows:
+                yield row
+
+        async def _dispatch(products: List[ProductAdd]):
+            nonlocal image_count, product_count, dispatch_seconds, redis_barrier
+            started = time.perf_counter()
+            await _wait_for_capacity(unique_request_id)
+            dispatched = await _dispatch_products(
+                db, unique_request_id, products, fair_priority(tenant_in_flight + image_count)
+            )
+            image_count += dispatched
+            product_count += len(products)
+            if redis_barrier:
+                try:
+                    await run_blocking(add_total, unique_request_id, dispatched)
+                except RedisError as e:
+                    logger.warning(f"Could not count images of request {unique_request_id}, using the database barrier: {e}")
+                    redis_barrier = False
+            dispatch_seconds += time.perf_counter() - started
+
+        try:
+            async for index, product_row in _rows():
+                try:
+                    input_image_urls = [url.strip() for url in product_row['InputImageUrls'].split(',') if url.strip()]
+                    batch.append(ProductAdd(
+                        request_id=unique_request_id,
+                        # products.serial_number is an integer column; other values skip the row
+                        product_id=str(int(product_row['SerialNumber'])),
+                        name=product_row['ProductName'],
+                        images=input_image_urls,
+                        transform=transform_spec,
+                        request_created_at=created_at,
+                        row=index
+                    ))
+                except (AttributeError, KeyError, ValueError) as e:
+                    logger.warning(f"Skipping row {index} of {file.filename} for request {unique_request_id}: {e}")
+                    skipped_rows.append(index)
+                    continue
+
+                if len(batch) >= settings.csv_dispatch_batch_size:
+                    await _dispatch(batch)
+                    batch = []
+        except CSVFormatError as e:
+            logger.warning(f"CSV stream for request {unique_request_id} ended early: {e}")
+            stream_error = str(e)
+
+        if batch:
+            await _dispatch(batch)
+        CSV_PARSE_SECONDS.observe(time.perf_counter() - parse_started - dispatch_seconds)
+        await _close_admission(unique_request_id)
+
+        # Every image is dispatched and counted: from here the request's Redis counters decide
+        # when it is done, and the flush that finishes its last image publishes finalize_request.
+        # Unsealed counters never finalize, so a request that fell back is left to the database
+        if redis_barrier:
             try:
-                # Print the entire row
-                print(product_row)
-
-                # Access the data directly from the product_row Series
-                serial_number = str(product_row['SerialNumber'])
-                product_name = product_row['ProductName']
-                input_image_urls = input_image_urls = product_row['InputImageUrls'].split(',')
-                csv_total_images+= len(input_image_urls)
-                
-                # Print to verify values
-                print(f"Product Name: {product_name}")
-
-                # Create a product object
-                product = ProductAdd(
-                    request_id=unique_request_id,
-                    product_id=serial_number,
-                    name=product_name,
-                    images=input_image_urls
-                )
-                
-                print(product)
-                tasks.append(process_product.s(product.model_dump()))
-            
-            except (ValueError, SyntaxError) as e:
-                raise HTTPException(status_code=400, detail=f"Error processing row {index + 1}: {str(e)}")
-            
-        stmt = (
-            update(Request).
-            where(Request.request_id == unique_request_id).
-            values(total_images=csv_total_images)
-        )
-        
-        db.execute(stmt)
-        db.commit()
-        
-        task_callback = chord(tasks)(finalize_request.s(unique_request_id))
-        
+                sealed = await run_blocking(seal, unique_request_id)
+                if sealed is None:
+                    logger.warning(f"Progress counters of request {unique_request_id} are gone, using the database barrier")
+                    redis_barrier = False
+                elif sealed:
+                    await run_blocking(_task('finalize_request', unique_request_id).apply_async)
+            except RedisError as e:
+                logger.warning(f"Could not seal request {unique_request_id}, using the database barrier: {e}")
+                redis_barrier = False
+        if not redis_barrier:
+            await run_blocking(
+                _task('await_request_completion', unique_request_id, product_count, countdown=settings.barrier_poll_interval).apply_async
+            )
+
         # Return the unique request ID as JSON
-        return JSONResponse(content={"request_id": unique_request_id}, status_code=status.HTTP_200_OK)
-    
+        content = {"request_id": unique_request_id}
+        if skipped_rows:
+            content["skipped_rows"] = skipped_rows
+        if stream_error:
+            content["message"] = f"Upload truncated: {stream_error}"
+        return JSONResponse(content=content, status_code=status.HTTP_200_OK)
+
     except HTTPException as http_exc:
         logger.warning(f"HTTP exception for file {file.filename}: {http_exc.detail}")
         raise http_exc
-    
+
     except Exception as exception:
         logger.error(f"An error occurred while uploading file {file.filename}: {traceback.format_exc()}")
         return JSONResponse(content={"message": "An error occurred while processing the file."}, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """Image result cache counters: url_hit, revalidated_hit, content_hit, miss and evicted."""
+    return await run_blocking(cache_stats)
+
+
+@router.get("/pipeline/stats")
+async def get_pipeline_stats():
+    """
+    Counters of the two stages of PIPELINE_MODE=staged: images, errors, bytes and busy
+    seconds per stage, and the bytes parked between them.
+    """
+    from celery_worker.staging import pipeline_stats
+
+    return await run_blocking(pipeline_stats)
+
+
+async def _load_progress(db: AsyncSession, request_ids: List[str]) -> Dict[str, Optional[dict]]:
+    """
+    Progress counters for `request_ids`: one Redis round trip, with a primary-key
+    lookup on `requests` for ids whose counters are missing or Redis is unavailable.
+    """
+    try:
+        progress = await run_blocking(get_progress, request_ids)
+    except RedisError as e:
+        logger.warning(f"Progress counters unavailable, reading from the database: {e}")
+        progress = dict.fromkeys(request_ids)
+
+    # Request ids are native UUIDs in the database: skip strings that cannot be one, and
+    # map rows back to the caller's spelling (hex vs dashed)
+    missing: Dict[uuid.UUID, List[str]] = {}
+    for request_id, counters in progress.items():
+        if counters is None:
+            try:
+                missing.setdefault(uuid.UUID(request_id), []).append(request_id)
+            except ValueError:
+                continue
+    if missing:
+        rows = await db.execute(
+            select(Request.request_id, Request.total_images, Request.completed_images, Request.failed_images)
+            .where(Request.request_id.in_([str(request_uuid) for request_uuid in missing]))
+        )
+        for row in rows:
+            for request_id in missing[uuid.UUID(row.request_id)]:
+                progress[request_id] = to_progress(row.total_images or 0, row.completed_images, row.failed_images)
+    return progress
+
+
 @router.get("/status")
-async def get_status(_request_id: str, db: Session = Depends(get_db)):
+async def get_status(_request_id: str, db: AsyncSession = Depends(get_db)):
     try:
-        # Fetch the request from the database
-        request = db.query(Request).filter(Request.request_id == _request_id).first()
+        progress = (await _load_progress(db, [_request_id]))[_request_id]
         
-        if not request:
+        if not progress:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Request not found")
-        
-        query_result = (
-            db.query(Request)
-            .join(Product, Request.request_id == Product.request_id)
-            .join(ImageUrl, Product.product_id == ImageUrl.product_id)
-            .filter(
-                Request.request_id == _request_id,
-                ImageUrl.status.in_([ImageStatus.completed, ImageStatus.failed])
-            )
-            .count()
-        )
-        print(query_result)      
-        
-        return (query_result / request.total_images) * 100
-        
+
+        return progress["percent"]
 
     except HTTPException as http_exc:
         logger.warning(f"HTTP exception for request_id {_request_id}: {http_exc.detail}")
@@ -154,4 +442,210 @@ async def get_status(_request_id: str, db: Session = Depends(get_db)):
 
     except Exception as exception:
         logger.error(f"An error occurred while fetching status for request_id {_request_id}: {traceback.format_exc()}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while fetching the status.")
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while fetching the status.")
+
+
+@router.post("/resume")
+async def resume(_request_id: str, include_failed: bool = False, db: AsyncSession = Depends(get_db)):
+    """
+    Reprocess only the images of a request that never finished (with `include_failed`,
+    the failed ones too) and deliver its results again once they are done.
+    """
+    try:
+        try:
+            request = await db.get(Request, str(uuid.UUID(_request_id)))
+        except ValueError:
+            request = None
+        if request is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Request not found")
+        if request.archived_at is not None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Request has been archived")
+
+        await run_blocking(_task('resume_request', uuid.UUID(_request_id).hex, include_failed).apply_async)
+        return JSONResponse(
+            content={"request_id": _request_id, "status": "resuming"}, status_code=status.HTTP_202_ACCEPTED
+        )
+
+    except HTTPException as http_exc:
+        logger.warning(f"HTTP exception for request_id {_request_id}: {http_exc.detail}")
+        raise http_exc
+
+    except Exception as exception:
+        logger.error(f"An error occurred while resuming request_id {_request_id}: {traceback.format_exc()}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while resuming the request.")
+
+
+@router.get("/webhooks/dead")
+async def get_dead_webhooks(limit: int = 100, db: AsyncSession = Depends(get_db)):
+    """Webhook calls that ran out of attempts or were refused by the receiver, newest first."""
+    rows = await db.execute(
+        select(
+            WebhookDelivery.delivery_id, WebhookDelivery.request_id, WebhookDelivery.kind, WebhookDelivery.url,
+            WebhookDelivery.attempts, WebhookDelivery.last_error, WebhookDelivery.created_at,
+        )
+        .where(WebhookDelivery.status == DeliveryStatus.dead)
+        .order_by(WebhookDelivery.delivery_id.desc())
+        .limit(min(limit, 1000))
+    )
+    return [
+        {**row._asdict(), "kind": row.kind.value, "created_at": row.created_at.isoformat()}
+        for row in rows
+    ]
+
+
+@router.post("/webhooks/retry")
+async def retry_dead_webhook(delivery_id: int, db: AsyncSession = Depends(get_db)):
+    """Put a dead-lettered webhook call back in the outbox with a fresh attempt budget."""
+    result = await db.execute(
+        update(WebhookDelivery)
+        .where(WebhookDelivery.delivery_id == delivery_id, WebhookDelivery.status == DeliveryStatus.dead)
+        .values(status=DeliveryStatus.pending, attempts=0, next_attempt_at=func.now())
+    )
+    await db.commit()
+    if not result.rowcount:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No dead-lettered delivery with this id")
+    return JSONResponse(content={"delivery_id": delivery_id, "status": "pending"}, status_code=status.HTTP_202_ACCEPTED)
+
+
+@router.get("/profile")
+async def get_profile(_request_id: str, format: Literal["summary", "collapsed", "speedscope"] = "summary"):
+    """
+    Profile of a profiled request: its runs (upload handler and tasks: wall time, samples,
+    allocation peak) with the hottest stacks, or all stacks as collapsed text or a speedscope file.
+    """
+    request_hex = _request_hex(_request_id)
+    stacks, runs = await run_blocking(load_profile, request_hex)
+    if not runs:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No profile for this request")
+
+    if format == "collapsed":
+        return PlainTextResponse(to_collapsed(stacks))
+    if format == "speedscope":
+        return JSONResponse(
+            content=to_speedscope(f"request {request_hex}", stacks, settings.profile_interval),
+            headers={"Content-Disposition": f'attachment; filename="{request_hex}.speedscope.json"'},
+        )
+    hottest = sorted(stacks.items(), key=lambda item: item[1], reverse=True)[:20]
+    return {
+        "request_id": request_hex,
+        "interval": settings.profile_interval,
+        "runs": runs,
+        "hottest_stacks": [{"stack": stack, "samples": samples} for stack, samples in hottest],
+    }
+
+
+async def _snapshot(db: AsyncSession, request_id: str) -> Optional[dict]:
+    """Counters and finalized flag for a new stream: from Redis, else one primary-key lookup."""
+    try:
+        snapshot = await run_blocking(get_snapshot, request_id)
+    except RedisError as e:
+        logger.warning(f"Progress counters unavailable, reading from the database: {e}")
+        snapshot = None
+    if snapshot is None:
+        request = await db.get(Request, str(uuid.UUID(request_id)))
+        if request is None:
+            return None
+        snapshot = {
+            **to_progress(request.total_images or 0, request.completed_images, request.failed_images),
+            "finished": request.status == RequestStatus.completed,
+        }
+    return {"type": "snapshot", "request_id": request_id, **snapshot}
+
+
+async def _follow(db: AsyncSession, request_id: str):
+    """
+    Subscribe to the request's events, then take the snapshot, so nothing that happens
+    in between is missed. Returns `(queue, snapshot)`; the snapshot is None for unknown requests.
+    """
+    hub = get_hub()
+    queue = await hub.subscribe(request_id)
+    try:
+        snapshot = await _snapshot(db, request_id)
+    except BaseException:
+        await hub.unsubscribe(request_id, queue)
+        raise
+    if snapshot is None:
+        await hub.unsubscribe(request_id, queue)
+    return queue, snapshot
+
+
+async def _events(request_id: str, queue: asyncio.Queue, snapshot: dict):
+    """The snapshot, then the request's events until it is finalized; None marks a keepalive."""
+    try:
+        yield snapshot
+        if snapshot["finished"]:
+            return
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), settings.progress_stream_keepalive)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            yield event
+            if event["type"] == "completed":
+                return
+    finally:
+        await get_hub().unsubscribe(request_id, queue)
+
+
+def _request_hex(request_id: str) -> str:
+    try:
+        return uuid.UUID(request_id).hex
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Request not found")
+
+
+@router.get("/status/stream")
+async def stream_status(_request_id: str, db: AsyncSession = Depends(get_db)):
+    """
+    Server-sent events for one request: a `snapshot` of its counters, a `progress`
+    event per batch of finished images, and `completed` once it is finalized, which
+    ends the stream. Comments are sent every PROGRESS_STREAM_KEEPALIVE seconds.
+    """
+    request_id = _request_hex(_request_id)
+    queue, snapshot = await _follow(db, request_id)
+    if snapshot is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Request not found")
+
+    async def body():
+        async for event in _events(request_id, queue, snapshot):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    # No buffering in front of the stream (nginx honours X-Accel-Buffering)
+    return StreamingResponse(
+        body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.websocket("/status/ws")
+async def status_websocket(websocket: WebSocket, _request_id: str, db: AsyncSession = Depends(get_db)):
+    """The events of `/v1/status/stream` as JSON messages; the socket is closed after `completed`."""
+    try:
+        request_id = _request_hex(_request_id)
+        queue, snapshot = await _follow(db, request_id)
+    except HTTPException:
+        snapshot = None
+    if snapshot is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Request not found")
+        return
+    await websocket.accept()
+    try:
+        async for event in _events(request_id, queue, snapshot):
+            await websocket.send_json(event or {"type": "keepalive"})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
+@router.post("/status/batch")
+async def get_status_batch(query: StatusBatchQuery, db: AsyncSession = Depends(get_db)):
+    """Counters (total/completed/failed/percent) for many requests at once; unknown ids map to null."""
+    try:
+        return await _load_progress(db, list(dict.fromkeys(query.request_ids)))
+
+    except Exception as exception:
+        logger.error(f"An error occurred while fetching batch status: {traceback.format_exc()}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while fetching the status.")
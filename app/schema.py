@@ -1,5 +1,27 @@
-from typing import List
-from pydantic import BaseModel, AnyHttpUrl
+from datetime import datetime
+from typing import List, Literal, Optional
+from pydantic import BaseModel, AnyHttpUrl, Field, field_validator
+
+
+class TransformSpec(BaseModel):
+    """ schema for the per-request transform: every size is produced from one decode of the source """
+    sizes: List[int] = Field(..., min_length=1, max_length=10, description="Longest-edge pixel sizes of the variants")
+    format: Literal["JPEG", "WEBP", "AVIF"] = "JPEG"
+    quality: int = Field(75, ge=1, le=100)
+    strip_metadata: bool = True
+
+    @field_validator("sizes")
+    @classmethod
+    def _distinct_descending(cls, sizes: List[int]) -> List[int]:
+        if any(size < 1 or size > 10000 for size in sizes):
+            raise ValueError("sizes must be between 1 and 10000 pixels")
+        return sorted(set(sizes), reverse=True)
+
+    @property
+    def key(self) -> str:
+        """Fingerprint used in cache keys."""
+        sizes = "x".join(str(size) for size in self.sizes)
+        return f"fit-{sizes}-{self.format.lower()}-q{self.quality}{'-s' if self.strip_metadata else ''}"
 
 
 class ProductAdd(BaseModel):
@@ -7,4 +29,14 @@ class ProductAdd(BaseModel):
     request_id: str
     product_id: str
     name: str
-    images: List[str]
\ No newline at end of file
+    images: List[str]
+    transform: Optional[TransformSpec] = None
+    # The request's created_at, which selects the partition the product's rows go to
+    request_created_at: Optional[datetime] = None
+    # CSV row number; with the request id and serial number it keys the product's rows
+    row: Optional[int] = None
+
+
+class StatusBatchQuery(BaseModel):
+    """ schema for a batch status lookup """
+    request_ids: List[str] = Field(..., min_length=1, max_length=1000)
@@ -0,0 +1,332 @@
+import errno
+import mimetypes
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import BinaryIO, Dict, List, Optional
+
+from app.config import Logger, settings
+
+logger = Logger.get_logger(__name__)
+
+_CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+    "avif": "image/avif",
+    "csv": "text/csv",
+}
+
+
+def content_type_for(key: str) -> Optional[str]:
+    """MIME type for a storage key, by extension."""
+    extension = posixpath.splitext(key)[1].lstrip(".").lower()
+    return _CONTENT_TYPES.get(extension) or mimetypes.guess_type(key)[0]
+
+
+class StorageWriter(ABC):
+    """Writable, file-like sink for one object. The object becomes visible only on a successful `close()`."""
+    @abstractmethod
+    def write(self, data: bytes) -> int:
+        ...
+
+    @abstractmethod
+    def close(self):
+        ...
+
+    @abstractmethod
+    def abort(self):
+        ...
+
+    def __enter__(self) -> "StorageWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class StorageBackend(ABC):
+    """Where processed images, cached outputs and exported results are kept."""
+    @abstractmethod
+    def open_write(self, key: str, content_type: Optional[str] = None) -> StorageWriter:
+        ...
+
+    def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> str:
+        """Store `data` under `key` and return its URL."""
+        with self.open_write(key, content_type) as writer:
+            writer.write(data)
+        return self.url(key)
+
+    def put_stream(self, key: str, source: BinaryIO, content_type: Optional[str] = None, chunk_size: int = 1024 * 1024) -> str:
+        """Copy a file-like object into `key` chunk by chunk and return its URL."""
+        with self.open_write(key, content_type) as writer:
+            for chunk in iter(lambda: source.read(chunk_size), b""):
+                writer.write(chunk)
+        return self.url(key)
+
+    @abstractmethod
+    def copy(self, source_key: str, key: str) -> str:
+        """
+        Copy the object at `source_key` to `key` inside the backend and return the copy's URL.
+        Raises FileNotFoundError if there is no object at `source_key`.
+        """
+
+    @abstractmethod
+    def url(self, key: str) -> str:
+        ...
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+
+class _LocalWriter(StorageWriter):
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes) -> int:
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        # Same-directory rename is atomic: readers see the old object or the whole new one
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Files under `root`, sharded by the first two characters of the file name so no
+    directory grows unbounded. URLs are `public_base_url`-relative when configured
+    (e.g. a shared volume served over HTTP), otherwise absolute paths.
+    """
+    def __init__(self, root: str, public_base_url: Optional[str] = None):
+        self.root = root
+        self.public_base_url = public_base_url.rstrip("/") if public_base_url else None
+
+    @staticmethod
+    def _relative(key: str) -> str:
+        directory, name = posixpath.split(key)
+        return posixpath.join(directory, name[:2], name)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *self._relative(key).split("/"))
+
+    def open_write(self, key: str, content_type: Optional[str] = None) -> StorageWriter:
+        return _LocalWriter(self._path(key))
+
+    def copy(self, source_key: str, key: str) -> str:
+        # A hard link costs no space and survives the source's deletion; copy across file systems
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        os.unlink(tmp_path)
+        try:
+            try:
+                os.link(self._path(source_key), tmp_path)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                shutil.copyfile(self._path(source_key), tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return self.url(key)
+
+    def url(self, key: str) -> str:
+        if self.public_base_url:
+            return f"{self.public_base_url}/{self._relative(key)}"
+        return self._path(key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def delete(self, key: str):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class _S3MultipartWriter(StorageWriter):
+    """
+    Buffers up to one part in memory and uploads full parts in parallel while the
+    caller keeps writing, so an encoder or request body can stream straight into S3
+    without temp files. At most `max_in_flight` parts are uploading at once.
+    Objects smaller than one part are sent with a single PutObject.
+    """
+    def __init__(self, client, bucket: str, key: str, content_type: Optional[str], part_size: int,
+                 executor: ThreadPoolExecutor, max_in_flight: int):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.extra = {"ContentType": content_type} if content_type else {}
+        self.part_size = part_size
+        self.executor = executor
+        self.max_in_flight = max(1, max_in_flight)
+        self.buffer = BytesIO()
+        self.upload_id = None
+        self.futures: List[Future] = []
+
+    def write(self, data: bytes) -> int:
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            self._submit_part()
+        return len(data)
+
+    def _upload_part(self, number: int, body: bytes) -> Dict:
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=number, Body=body
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def _submit_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra)["UploadId"]
+        in_flight = [future for future in self.futures if not future.done()]
+        if len(in_flight) >= self.max_in_flight:
+            wait(in_flight, return_when=FIRST_COMPLETED)
+        self.futures.append(self.executor.submit(self._upload_part, len(self.futures) + 1, self.buffer.getvalue()))
+        self.buffer = BytesIO()
+
+    def close(self):
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=self.buffer.getvalue(), **self.extra)
+            return
+        try:
+            if self.buffer.tell():
+                self._submit_part()
+            parts = [future.result() for future in self.futures]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+        except BaseException:
+            # Uploaded parts are billed until the upload is completed or aborted
+            try:
+                self.abort()
+            except Exception as e:
+                logger.warning(f"Could not abort multipart upload {self.upload_id} of {self.key}: {e}")
+            raise
+
+    def abort(self):
+        if self.upload_id is not None:
+            wait(self.futures)
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class S3Storage(StorageBackend):
+    """
+    S3-compatible object storage (AWS, MinIO, or moto for local testing).
+    One pooled, thread-safe client per process is shared by all transform threads;
+    multipart parts are uploaded on a small per-process thread pool.
+    """
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, region: Optional[str] = None,
+                 access_key_id: Optional[str] = None, secret_access_key: Optional[str] = None,
+                 public_base_url: Optional[str] = None, max_pool_connections: int = 32, part_size: int = 8 * 1024 * 1024,
+                 upload_concurrency: int = 4):
+        import boto3
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.part_size = max(part_size, 5 * 1024 * 1024)  # S3 minimum for all but the last part
+        self.public_base_url = public_base_url.rstrip("/") if public_base_url else None
+        self.upload_concurrency = upload_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max(1, upload_concurrency), thread_name_prefix="s3-part-upload")
+        self.client = boto3.session.Session().client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            config=Config(max_pool_connections=max_pool_connections, retries={"max_attempts": 5, "mode": "adaptive"}),
+        )
+
+    def open_write(self, key: str, content_type: Optional[str] = None) -> StorageWriter:
+        return _S3MultipartWriter(
+            self.client, self.bucket, key, content_type, self.part_size, self.executor, self.upload_concurrency
+        )
+
+    def copy(self, source_key: str, key: str) -> str:
+        from botocore.exceptions import ClientError
+
+        # Server-side; metadata, including the content type, is copied along
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=key, CopySource={"Bucket": self.bucket, "Key": source_key})
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                raise FileNotFoundError(source_key) from e
+            raise
+        return self.url(key)
+
+    def url(self, key: str) -> str:
+        if self.public_base_url:
+            return f"{self.public_base_url}/{key}"
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{key}"
+        return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+_storage: Optional[StorageBackend] = None
+_storage_pid: Optional[int] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> StorageBackend:
+    """The configured backend for this process (STORAGE_BACKEND=local|s3); rebuilt after fork."""
+    global _storage, _storage_pid
+    with _storage_lock:
+        if _storage is None or _storage_pid != os.getpid():
+            if settings.storage_backend == "s3":
+                _storage = S3Storage(
+                    bucket=settings.s3_bucket,
+                    endpoint_url=settings.s3_endpoint_url,
+                    region=settings.s3_region,
+                    access_key_id=settings.s3_access_key_id,
+                    secret_access_key=settings.s3_secret_access_key.get_secret_value() if settings.s3_secret_access_key else None,
+                    public_base_url=settings.storage_public_base_url,
+                    max_pool_connections=settings.s3_max_pool_connections,
+                    part_size=settings.s3_part_size,
+                    upload_concurrency=settings.s3_upload_concurrency,
+                )
+            else:
+                _storage = LocalStorage(settings.output_dir, settings.storage_public_base_url)
+            _storage_pid = os.getpid()
+        return _storage
@@ -0,0 +1,278 @@
+"""
+End-to-end load benchmark: drive POST /v1/upload against local stand-ins.
+
+    alembic upgrade head    # on a scratch database named by the DB_* settings
+    python -m benchmarks.bench_e2e --rows 1000 --images-per-row 3 --image-size 1600x1200 --latency-ms 20
+
+The API runs in this process under uvicorn, with Celery in eager mode, so every task
+runs inside the upload request on the API's worker threads and this process is the
+only worker. A local HTTP server serves synthetic images (JPEG or PNG, in one or more
+sizes, with a configurable latency). Each URL gets unique bytes so the result cache
+cannot skip work. A local sink receives the results webhook. CSVs of any size (1k-1M
+rows) are generated to a temporary file and streamed to the upload.
+
+Reported: throughput, p50/p99 per-image latency (from the image server receiving the
+download to the result being recorded), peak RSS of the process and SQL statements
+per image. PostgreSQL is required since the schema uses range partitions and native
+UUIDs; --fake-redis uses fakeredis instead of the configured Redis.
+"""
+import argparse
+import os
+import random
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict, List, Tuple
+
+import requests
+from PIL import Image
+
+from benchmarks.bench_persistence import StatementCounter
+from benchmarks.bench_transform import _peak_rss_kib, _reset_peak_rss, make_jpeg
+
+
+def make_image(width: int, height: int, fmt: str) -> bytes:
+    content = make_jpeg(width, height)
+    if fmt == "JPEG":
+        return content
+    buffer = BytesIO()
+    Image.open(BytesIO(content)).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+class ImageServer(ThreadingHTTPServer):
+    """Serves /img/<index>.<ext>: the source for `index` (sizes round-robin) plus unique trailing bytes."""
+    daemon_threads = True
+
+    def __init__(self, sources: List[bytes], content_type: str, latency: float, jitter: float):
+        super().__init__(("127.0.0.1", 0), _ImageHandler)
+        self.sources = sources
+        self.content_type = content_type
+        self.latency = latency
+        self.jitter = jitter
+        # Path -> when it was first requested
+        self.requested: Dict[str, float] = {}
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server: ImageServer = self.server
+        server.requested.setdefault(self.path, time.perf_counter())
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        index = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+        # Decoders stop at the end-of-image marker, so the suffix only changes the digest
+        body = server.sources[index % len(server.sources)] + str(index).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", server.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookSink(ThreadingHTTPServer):
+    """Accepts the results upload (chunked or not) and records its size and arrival."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _WebhookHandler)
+        self.received: List[Tuple[float, int]] = []
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        size = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                length = int(self.rfile.readline().split(b";")[0], 16)
+                size += len(self.rfile.read(length))
+                self.rfile.readline()
+                if length == 0:
+                    break
+        else:
+            size = len(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        self.server.received.append((time.perf_counter(), size))
+        body = b'{"status": "success"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server: ThreadingHTTPServer) -> str:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def write_csv(path: str, rows: int, images_per_row: int, image_base_url: str, extension: str):
+    with open(path, "w", newline="") as handle:
+        handle.write("SerialNumber,ProductName,InputImageUrls\n")
+        for row in range(rows):
+            urls = ",".join(f"{image_base_url}/img/{row * images_per_row + image}.{extension}" for image in range(images_per_row))
+            handle.write(f'{row + 1},Product {row + 1},"{urls}"\n')
+
+
+def file_chunks(path: str, size: int = 1024 * 1024):
+    with open(path, "rb") as handle:
+        while True:
+            chunk = handle.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def start_api(port: int):
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def record_completions() -> Dict[str, float]:
+    """When each image's result was recorded, keyed by hex image id."""
+    from app.crud import ImageResultBuffer
+
+    completed: Dict[str, float] = {}
+    add = ImageResultBuffer.add
+
+    def timed_add(self, image_id, *args, **kwargs):
+        completed.setdefault(uuid.UUID(str(image_id)).hex, time.perf_counter())
+        return add(self, image_id, *args, **kwargs)
+
+    ImageResultBuffer.add = timed_add
+    return completed
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000, help="CSV rows (products)")
+    parser.add_argument("--images-per-row", type=int, default=3)
+    parser.add_argument("--image-size", action="append", default=None,
+                        help="WIDTHxHEIGHT of the served images; repeat for a mix (default 1600x1200)")
+    parser.add_argument("--format", choices=("JPEG", "PNG"), default="JPEG")
+    parser.add_argument("--latency-ms", type=float, default=0, help="image server delay per request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="extra random delay per request, up to this much")
+    parser.add_argument("--granularity", choices=("product", "image"), default=None, help="override TASK_GRANULARITY")
+    parser.add_argument("--transform", help="TransformSpec JSON sent with the upload")
+    parser.add_argument("--fake-redis", action="store_true", help="use fakeredis instead of the configured Redis")
+    args = parser.parse_args()
+
+    from app.config import settings
+
+    output_dir = tempfile.mkdtemp(prefix="bench-e2e-")
+    sizes = [tuple(int(part) for part in size.split("x")) for size in (args.image_size or ["1600x1200"])]
+    images = ImageServer(
+        [make_image(width, height, args.format) for width, height in sizes],
+        f"image/{args.format.lower()}", args.latency_ms / 1000, args.jitter_ms / 1000,
+    )
+    image_base_url = serve(images)
+    sink = WebhookSink()
+    settings.webhook_url = f"{serve(sink)}/webhook"
+    settings.export_target = "webhook"
+    settings.storage_backend = "local"
+    settings.output_dir = output_dir
+    settings.admission_max_inflight_per_tenant = 0
+    settings.admission_max_inflight_total = 0
+    if args.granularity:
+        settings.task_granularity = args.granularity
+    if args.fake_redis:
+        import fakeredis
+        import app.redis_client as redis_client
+
+        redis_client._client, redis_client._client_pid = fakeredis.FakeRedis(), os.getpid()
+
+    from celery_worker.worker import celery_app
+    # The API publishes tasks by name; registering them here makes this process their eager worker
+    import celery_worker.task  # noqa: F401
+
+    celery_app.conf.task_always_eager = True
+    celery_app.conf.task_eager_propagates = True
+    completed = record_completions()
+    port = free_port()
+    api = start_api(port)
+
+    csv_path = os.path.join(output_dir, "upload.csv")
+    write_csv(csv_path, args.rows, args.images_per_row, image_base_url, "jpg" if args.format == "JPEG" else "png")
+    total_images = args.rows * args.images_per_row
+    print(f"{args.rows} rows, {total_images} images of {', '.join(f'{w}x{h}' for w, h in sizes)} {args.format}, "
+          f"latency {args.latency_ms:g}+{args.jitter_ms:g} ms, granularity {settings.task_granularity}")
+
+    from celery_worker.export import multipart_stream
+
+    fields = {"transform": args.transform} if args.transform else {}
+    content_type, body = multipart_stream(fields, "file", "bench.csv", "text/csv", file_chunks(csv_path))
+    _reset_peak_rss()
+    with StatementCounter() as statements:
+        started = time.perf_counter()
+        response = requests.post(f"http://127.0.0.1:{port}/v1/upload", data=body, headers={"Content-Type": content_type})
+        elapsed = time.perf_counter() - started
+    response.raise_for_status()
+    request_id = response.json()["request_id"]
+    api.should_exit = True
+
+    from sqlalchemy import select
+    from app.database import ConnectionManager
+    from app.model import ImageStatus, ImageUrl
+
+    with ConnectionManager() as db:
+        rows = db.execute(
+            select(ImageUrl.image_id, ImageUrl.input_image_url, ImageUrl.status).where(ImageUrl.request_id == request_id)
+        ).all()
+    latencies = []
+    for row in rows:
+        path = "/" + row.input_image_url.split("/", 3)[-1]
+        done = completed.get(uuid.UUID(str(row.image_id)).hex)
+        if done is not None and path in images.requested:
+            latencies.append(done - images.requested[path])
+    statuses = {status: sum(1 for row in rows if row.status == status) for status in ImageStatus}
+
+    print(f"request {request_id}: {statuses[ImageStatus.completed]} completed, {statuses[ImageStatus.failed]} failed")
+    print(f"wall time        {elapsed:10.2f} s")
+    print(f"throughput       {total_images / elapsed:10.1f} images/s  ({args.rows / elapsed:.1f} rows/s)")
+    print(f"latency p50      {percentile(latencies, 0.50) * 1000:10.1f} ms")
+    print(f"latency p99      {percentile(latencies, 0.99) * 1000:10.1f} ms")
+    if latencies:
+        print(f"latency mean     {statistics.mean(latencies) * 1000:10.1f} ms")
+    print(f"peak RSS         {_peak_rss_kib() / 1024:10.1f} MiB  (API and eager worker in one process)")
+    print(f"SQL statements   {statements.total / max(1, total_images):10.2f} per image  "
+          f"({', '.join(f'{name} {count}' for name, count in statements.counts.most_common())})")
+    if sink.received:
+        arrived, size = sink.received[-1]
+        print(f"webhook          {size / 1024:10.1f} KiB, delivered {arrived - started:.2f} s after upload start")
+    else:
+        print("webhook          not delivered")
+
+
+if __name__ == "__main__":
+    main()
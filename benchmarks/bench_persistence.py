@@ -0,0 +1,142 @@
+"""
+Compare row-at-a-time persistence with the batched paths in app.crud.
+
+    python -m benchmarks.bench_persistence --products 2000 --images-per-product 3 --flush-size 20
+
+Runs against the database named by the DB_* settings (apply `alembic upgrade head`
+to a scratch database first). Each path inserts the same products and image rows,
+then records one result per image; the rows are deleted afterwards. Reported per
+stage: wall time, rows per second and SQL statements per image.
+"""
+import argparse
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from functools import partial
+from typing import Dict, Iterator, List, Tuple
+
+from sqlalchemy import delete, event, update
+from sqlalchemy.engine import Engine
+
+from app.crud import ImageResultBuffer, bulk_insert_products
+from app.database import ConnectionManager
+from app.metrics import statement_label
+from app.model import ImageStatus, ImageUrl, Product, Request
+
+
+class StatementCounter:
+    """Counts SQL statements (executemany counts once) on every engine in the process, by first keyword."""
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.counts[statement_label(statement)] += 1
+
+    def __enter__(self):
+        event.listen(Engine, "before_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, "before_cursor_execute", self)
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+def make_products(request_id: str, created_at: datetime, products: int, images_per_product: int) -> List[Dict]:
+    return [
+        {
+            "product_id": uuid.uuid4().hex,
+            "request_id": request_id,
+            "request_created_at": created_at,
+            "serial_number": index,
+            "product_name": f"product {index}",
+            "images": [f"http://images.invalid/{index}-{image}.jpg" for image in range(images_per_product)],
+        }
+        for index in range(products)
+    ]
+
+
+def row_at_a_time(db, products: List[Dict]) -> Iterator[Tuple[str, int]]:
+    """The original path: one INSERT and commit per product and per image, one UPDATE and commit per result."""
+    image_ids = []
+    for product in products:
+        db.add(Product(
+            product_id=product["product_id"], request_id=product["request_id"],
+            request_created_at=product["request_created_at"], serial_number=product["serial_number"],
+            product_name=product["product_name"],
+        ))
+        db.commit()
+        for url in product["images"]:
+            image = ImageUrl(
+                product_id=product["product_id"], request_id=product["request_id"],
+                request_created_at=product["request_created_at"], input_image_url=url, status=ImageStatus.pending,
+            )
+            db.add(image)
+            db.commit()
+            image_ids.append(image.image_id)
+    yield "insert", len(image_ids)
+    for image_id in image_ids:
+        db.execute(
+            update(ImageUrl).where(ImageUrl.image_id == image_id)
+            .values(status=ImageStatus.completed, output_image_url=f"/outputs/{image_id}.jpg")
+        )
+        db.commit()
+    yield "update", len(image_ids)
+
+
+def batched(db, products: List[Dict], flush_size: int) -> Iterator[Tuple[str, int]]:
+    """The current path: multi-row INSERTs per batch of products, results buffered into executemany UPDATEs."""
+    images = []
+    for start in range(0, len(products), 100):
+        for rows in bulk_insert_products(db, products[start:start + 100]).values():
+            images.extend(rows)
+        db.commit()
+    yield "insert", len(images)
+    with ImageResultBuffer(db, flush_size=flush_size) as results:
+        for image in images:
+            results.add(image["image_id"], ImageStatus.completed, f"/outputs/{image['image_id']}.jpg")
+    yield "update", len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--images-per-product", type=int, default=3)
+    parser.add_argument("--flush-size", type=int, default=20)
+    args = parser.parse_args()
+
+    paths = {"row-at-a-time": row_at_a_time, "batched": partial(batched, flush_size=args.flush_size)}
+    print(f"{'path':<15} {'stage':<7} {'seconds':>8} {'rows/s':>9} {'stmts/image':>12}")
+    for name, path in paths.items():
+        request_id, created_at = uuid.uuid4().hex, datetime.now()
+        with ConnectionManager() as db:
+            db.add(Request(request_id=request_id, created_at=created_at, total_images=0))
+            db.commit()
+            try:
+                products = make_products(request_id, created_at, args.products, args.images_per_product)
+                stages = path(db, products)
+                while True:
+                    with StatementCounter() as statements:
+                        started = time.perf_counter()
+                        try:
+                            stage, rows = next(stages)
+                        except StopIteration:
+                            break
+                        elapsed = time.perf_counter() - started
+                    print(f"{name:<15} {stage:<7} {elapsed:8.2f} {rows / elapsed:9.0f} {statements.total / max(1, rows):12.2f}")
+            finally:
+                db.rollback()
+                db.execute(delete(ImageUrl).where(ImageUrl.request_id == request_id))
+                db.execute(delete(Product).where(Product.request_id == request_id))
+                db.execute(delete(Request).where(Request.request_id == request_id))
+                db.commit()
+
+
+if __name__ == "__main__":
+    main()
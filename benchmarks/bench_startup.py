@@ -0,0 +1,102 @@
+"""
+Cold-start report for the API and worker processes.
+
+    python -m benchmarks.bench_startup --runs 5 --top 15 --serve
+
+Each run imports the process's entry module in a fresh interpreter: `main` for the API,
+`celery_worker.task` for a Celery worker (what `celery -A celery_worker.task.celery_app`
+loads before it connects to the broker). Reported per entry point: median and best import
+time, the slowest modules by cumulative import time (`python -X importtime`), and any
+worker-only module (task code, Pillow, requests) the API pulled in. With --serve, uvicorn
+is started as well and the time until GET /ready answers is measured.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import List, Tuple
+
+ENTRY_POINTS = {"api": "main", "worker": "celery_worker.task"}
+# Modules only Celery workers need; the API publishes tasks by name instead of importing them
+WORKER_ONLY = ("celery_worker.task", "celery_worker.pipeline", "celery_worker.transform", "PIL", "requests")
+
+
+def import_seconds(module: str) -> float:
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def import_profile(module: str) -> List[Tuple[int, str]]:
+    """(cumulative microseconds, module) for every module imported by `module`, slowest first."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], check=True, capture_output=True, text=True
+    ).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), name.strip()))
+    return sorted(modules, reverse=True)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_ready(timeout: float = 30.0) -> float:
+    """Seconds from spawning uvicorn until GET /ready answers."""
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError(f"uvicorn did not answer /ready within {timeout:.0f}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules listed per entry point")
+    parser.add_argument("--serve", action="store_true", help="also time uvicorn until /ready answers")
+    args = parser.parse_args()
+    # Children must not write the log file of whoever runs the report
+    os.environ.setdefault("LOG_FILE", "")
+
+    for process, module in ENTRY_POINTS.items():
+        timings = [import_seconds(module) for _ in range(args.runs)]
+        profile = import_profile(module)
+        print(f"{process} (import {module}): median {statistics.median(timings) * 1000:.0f} ms, "
+              f"best {min(timings) * 1000:.0f} ms over {args.runs} runs")
+        for cumulative, name in profile[:args.top]:
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+        if process == "api":
+            loaded = sorted({name for _, name in profile if name.split(".")[0] in WORKER_ONLY or name in WORKER_ONLY})
+            print(f"  worker-only modules loaded: {', '.join(loaded) or 'none'}")
+
+    if args.serve:
+        timings = [time_to_ready() for _ in range(args.runs)]
+        print(f"uvicorn ready: median {statistics.median(timings) * 1000:.0f} ms, best {min(timings) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Compare the original resize path with celery_worker.transform.scale_image.
+
+    python -m benchmarks.bench_transform --width 4000 --height 3000 --scale 0.5 --runs 10
+
+Each path runs in a fresh child process so RSS growth is measured per path.
+"""
+import argparse
+import multiprocessing
+import resource
+import statistics
+import time
+from io import BytesIO
+
+from PIL import Image
+
+
+def make_jpeg(width: int, height: int, quality: int = 90) -> bytes:
+    """Synthetic photo-like JPEG: a noisy gradient, which compresses like real photos."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def legacy_resize(content: bytes, scale: float) -> bytes:
+    """The pre-transform-engine path: full decode, default filter, default encoder."""
+    img = Image.open(BytesIO(content))
+    img = img.resize((int(img.width * scale), int(img.height * scale)))
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def engine_resize(content: bytes, scale: float) -> bytes:
+    from celery_worker.transform import EncodeOptions, scale_image
+
+    return scale_image(content, scale, EncodeOptions(quality=75, progressive=True))
+
+
+PATHS = {"legacy": legacy_resize, "engine": engine_resize}
+
+
+def _reset_peak_rss():
+    """Reset the kernel's peak-RSS watermark for this process (Linux); no-op elsewhere."""
+    try:
+        with open("/proc/self/clear_refs", "w") as handle:
+            handle.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_kib() -> int:
+    try:
+        with open("/proc/self/status") as handle:
+            for line in handle:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run(name: str, content: bytes, scale: float, runs: int, queue):
+    func = PATHS[name]
+    _reset_peak_rss()
+    baseline = _peak_rss_kib()
+    func(content, scale)  # warm-up
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = func(content, scale)
+        timings.append(time.perf_counter() - started)
+    peak = _peak_rss_kib()
+    queue.put((name, timings, peak, peak - baseline, len(output)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--scale", type=float, default=0.5)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    content = make_jpeg(args.width, args.height)
+    print(f"source: {args.width}x{args.height} JPEG, {len(content) / 1024:.0f} KiB, scale {args.scale}, {args.runs} runs")
+    print(f"{'path':<8} {'mean ms':>9} {'p50 ms':>9} {'min ms':>9} {'RSS growth MiB':>15} {'output KiB':>11}")
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for name in PATHS:
+        queue = ctx.Queue()
+        child = ctx.Process(target=_run, args=(name, content, args.scale, args.runs, queue))
+        child.start()
+        name, timings, _, growth, output_size = queue.get()
+        child.join()
+        results[name] = statistics.mean(timings)
+        print(
+            f"{name:<8} {statistics.mean(timings) * 1000:9.1f} {statistics.median(timings) * 1000:9.1f} "
+            f"{min(timings) * 1000:9.1f} {growth / 1024:15.1f} {output_size / 1024:11.0f}"
+        )
+    print(f"speedup: {results['legacy'] / results['engine']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import math
+import os
+from time import monotonic
+from typing import Dict, List
+
+from celery.utils.log import get_logger
+from celery.worker import state
+from celery.worker.autoscale import Autoscaler
+
+logger = get_logger(__name__)
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _cpu_seconds(pid: int) -> float:
+    """User + system CPU time of `pid` from /proc (Linux); 0 where unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat") as handle:
+            # Fields after the parenthesised command name; utime and stime are the 12th and 13th
+            fields = handle.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+class CpuAwareAutoscaler(Autoscaler):
+    """
+    Autoscaler (``celery worker --autoscale=MAX,MIN``) that sizes the pool from the
+    observed CPU share of its tasks instead of queue length alone.
+
+    Every second it samples the pool children's CPU time from /proc and how many of
+    them are busy. Over each `keepalive` window this gives the cores a busy child
+    actually uses: close to 1 for resize-heavy work, far below 1 while it waits on
+    downloads. Concurrency is capped at ``cpu_count / cores_per_busy_child`` (within
+    MIN..MAX), so I/O-bound phases run more children and CPU-bound phases stop
+    oversubscribing cores. The broker prefetch count follows the live process count.
+    """
+    # Floor for the measured cores per busy child, so one idle window cannot ask for MAX processes
+    MIN_CPU_SHARE = 0.05
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cpu_count = os.cpu_count() or 1
+        self.target = self.max_concurrency
+        self._cpu: Dict[int, float] = {}
+        self._window_started = monotonic()
+        self._last_sample = self._window_started
+        self._busy_seconds = 0.0
+        self._cpu_used = 0.0
+        self._prefetch_processes = self.max_concurrency
+
+    def _pids(self) -> List[int]:
+        try:
+            return list(self.pool.info.get("processes", []))
+        except Exception:
+            return []
+
+    def _sample(self):
+        now = monotonic()
+        self._busy_seconds += len(state.active_requests) * (now - self._last_sample)
+        self._last_sample = now
+        for pid in self._pids():
+            used = _cpu_seconds(pid)
+            # New children start from their first sample; exited ones simply drop out
+            self._cpu_used += max(0.0, used - self._cpu.get(pid, used))
+            self._cpu[pid] = used
+        if now - self._window_started >= self.keepalive:
+            if self._busy_seconds > 0:
+                share = max(self.MIN_CPU_SHARE, self._cpu_used / self._busy_seconds)
+                target = min(self.max_concurrency, max(self.min_concurrency or 1, math.ceil(self.cpu_count / share)))
+                if target != self.target:
+                    logger.info(f"Autotune: {share:.2f} cores per busy process, concurrency target {self.target} -> {target}")
+                    self.target = target
+            self._window_started = now
+            self._busy_seconds = 0.0
+            self._cpu_used = 0.0
+
+    def _maybe_scale(self, req=None):
+        self._sample()
+        self._sync_prefetch()
+        procs = self.processes
+        wanted = min(self.qty, self.target)
+        if wanted > procs:
+            self.scale_up(wanted - procs)
+            return True
+        wanted = max(wanted, self.min_concurrency)
+        if wanted < procs:
+            self.scale_down(procs - wanted)
+            return True
+
+    def _sync_prefetch(self):
+        """Move the consumer's prefetch count to live processes x multiplier (it starts at MAX x multiplier)."""
+        diff = self.processes - self._prefetch_processes
+        if diff and self.worker is not None:
+            self.worker.consumer._update_prefetch_count(diff)
+            self._prefetch_processes = self.processes
+
+    def _update_consumer_prefetch_count(self, new_max):
+        # `update()` (the autoscale remote control) calls this when MAX changes; prefetch tracks live processes instead
+        pass
@@ -0,0 +1,168 @@
+import csv
+import io
+import json
+import uuid
+import zlib
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.model import ImageUrl, Product
+
+EXPORT_COLUMNS = ['Product ID', 'Serial Number', 'Product Name', 'Input Image URLs', 'Output Image URLs']
+
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def iter_result_rows(db: Session, request_id: str, batch_size: int) -> Iterator[Dict[str, object]]:
+    """
+    Stream one aggregated row per product through a server-side cursor,
+    holding at most `batch_size` rows in memory.
+    """
+    query = (
+        db.query(
+            Product.product_id,
+            Product.serial_number,
+            Product.product_name,
+            func.string_agg(ImageUrl.input_image_url, ', ').label('input_image_urls'),
+            func.string_agg(ImageUrl.output_image_url, ', ').label('output_image_urls')
+        )
+        .join(Product, Product.product_id == ImageUrl.product_id)
+        # Filtering both sides lets each table use its request_id index
+        .filter(ImageUrl.request_id == request_id, Product.request_id == request_id)
+        .group_by(Product.product_id, Product.serial_number, Product.product_name)
+        .execution_options(yield_per=batch_size)
+    )
+    for row in query:
+        yield {
+            'Product ID': row.product_id,
+            'Serial Number': row.serial_number,
+            'Product Name': row.product_name,
+            'Input Image URLs': row.input_image_urls,
+            'Output Image URLs': row.output_image_urls,
+        }
+
+
+def _batched(rows: Iterable[Dict], size: int) -> Iterator[List[Dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _csv_chunks(rows: Iterable[Dict], batch_size: int) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for batch in _batched(rows, batch_size):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _jsonl_chunks(rows: Iterable[Dict], batch_size: int) -> Iterator[bytes]:
+    for batch in _batched(rows, batch_size):
+        yield "".join(json.dumps(row, default=str) + "\n" for row in batch).encode("utf-8")
+
+
+class _DrainableSink(io.RawIOBase):
+    """Write-only file object whose contents are handed out and discarded as they are produced."""
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _parquet_chunks(rows: Iterable[Dict], batch_size: int) -> Iterator[bytes]:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet export requires the 'pyarrow' package") from e
+
+    schema = pa.schema([
+        ('Product ID', pa.string()),
+        ('Serial Number', pa.int64()),
+        ('Product Name', pa.string()),
+        ('Input Image URLs', pa.string()),
+        ('Output Image URLs', pa.string()),
+    ])
+    sink = _DrainableSink()
+    # One row group per batch; the footer is written on close
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in _batched(rows, batch_size):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+_ENCODERS = {"csv": _csv_chunks, "jsonl": _jsonl_chunks, "parquet": _parquet_chunks}
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_chunks(rows: Iterable[Dict], fmt: str = "csv", gzip: bool = False, batch_size: int = 1000) -> Iterator[bytes]:
+    """Encode `rows` as `fmt` (csv, jsonl or parquet), optionally gzipped, yielding bytes as each batch is ready."""
+    chunks = _ENCODERS[fmt](rows, batch_size)
+    return gzip_chunks(chunks) if gzip else (chunk for chunk in chunks if chunk)
+
+
+def export_filename(fmt: str, gzip: bool) -> str:
+    return f"results.{fmt}{'.gz' if gzip else ''}"
+
+
+def multipart_stream(fields: Dict[str, str], file_field: str, filename: str, content_type: str,
+                     chunks: Iterable[bytes]) -> Tuple[str, Iterator[bytes]]:
+    """
+    Build a multipart/form-data body as a generator, so the file part can be sent with
+    chunked transfer encoding without materialising it. Returns the Content-Type header and the body.
+    """
+    boundary = uuid.uuid4().hex
+
+    def body() -> Iterator[bytes]:
+        for name, value in fields.items():
+            yield (
+                f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n"
+            ).encode("utf-8")
+        yield (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{file_field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        yield from chunks
+        yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    return f"multipart/form-data; boundary={boundary}", body()
@@ -0,0 +1,227 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+
+from app.config import settings
+from app.image_cache import ImageCache, content_digest
+from app.metrics import DOWNLOAD_BYTES, DOWNLOAD_SECONDS, host_label
+from app.ratelimit import wait_for_host
+from celery_worker.transform import Variant
+
+
+Outputs = Dict[str, str]
+
+
+class ImageTooLargeError(Exception):
+    """Raised when a source image exceeds `settings.image_max_bytes`."""
+
+
+class TransientError(Exception):
+    """A download that failed in a way worth retrying later, reported across the staged pipeline's handoff."""
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether a failed image should be retried later rather than marked failed: connection
+    errors, timeouts, and 429/5xx responses once the session's own quick retries are spent.
+    """
+    if isinstance(error, (TransientError, requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+_pools_lock = threading.Lock()
+_pools_pid: Optional[int] = None
+_download_pool: Optional[ThreadPoolExecutor] = None
+_transform_pool: Optional[ThreadPoolExecutor] = None
+_http_session: Optional[requests.Session] = None
+
+
+def _build_http_session() -> requests.Session:
+    retry = Retry(
+        total=settings.http_max_retries,
+        backoff_factor=settings.http_retry_backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+    )
+    # pool_block caps concurrent connections per host at pool_maxsize; keep-alive
+    # connections are reused across images and tasks in this process.
+    adapter = HTTPAdapter(
+        pool_connections=settings.http_pool_hosts,
+        pool_maxsize=settings.http_pool_maxsize_per_host,
+        pool_block=True,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """Per-process pooled HTTP session shared by all download threads."""
+    _ensure_pools()
+    return _http_session
+
+
+def _ensure_pools():
+    global _pools_pid, _download_pool, _transform_pool, _http_session
+    with _pools_lock:
+        if _pools_pid == os.getpid():
+            return
+        # Pools and sockets inherited through fork are unusable in the child
+        _http_session = _build_http_session()
+        _download_pool = ThreadPoolExecutor(
+            max_workers=settings.image_download_concurrency, thread_name_prefix="image-download"
+        )
+        _transform_pool = ThreadPoolExecutor(
+            max_workers=settings.image_transform_threads or os.cpu_count() or 1, thread_name_prefix="image-transform"
+        )
+        _pools_pid = os.getpid()
+
+
+def submit_download(image: Dict, cache: Optional[ImageCache]) -> Future:
+    """Run `download_stage` for `image` on this process's download pool."""
+    _ensure_pools()
+    return _download_pool.submit(download_stage, image, cache)
+
+
+def fetch(url: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> Tuple[Optional[bytes], Dict[str, Optional[str]]]:
+    """
+    Fetch `url` with the pooled session, enforcing timeouts and the max-bytes guard.
+
+    When validators are given the request is conditional; a 304 returns `(None, {})`.
+    Otherwise returns the body and the response's ETag/Last-Modified.
+    """
+    # Shared per-host budget, so all workers together stay under the origin's limit
+    wait_for_host(url)
+    session = get_http_session()
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    host = host_label((urlsplit(url).hostname or "").lower())
+    started = time.perf_counter()
+    with session.get(
+        url,
+        headers=headers,
+        stream=True,
+        timeout=(settings.http_connect_timeout, settings.http_read_timeout),
+    ) as response:
+        if response.status_code == 304 and headers:
+            return None, {}
+        response.raise_for_status()
+        declared = response.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > settings.image_max_bytes:
+            raise ImageTooLargeError(f"{url} declares {declared} bytes (limit {settings.image_max_bytes})")
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            received += len(chunk)
+            if received > settings.image_max_bytes:
+                raise ImageTooLargeError(f"{url} exceeded {settings.image_max_bytes} bytes")
+            chunks.append(chunk)
+        DOWNLOAD_SECONDS.labels(host).observe(time.perf_counter() - started)
+        DOWNLOAD_BYTES.labels(host).observe(received)
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        return b"".join(chunks), validators
+
+
+def download_stage(image: Dict, cache: Optional[ImageCache]) -> Tuple[Optional[Outputs], Optional[bytes], Dict]:
+    """
+    Return `(cached_outputs, None, {})` on a URL cache hit, else `(None, content, validators)`.
+    A hit whose outputs were evicted before they could be published is downloaded afresh.
+    """
+    url = image["input_image_url"]
+    entry = cache.lookup_url(url) if cache else None
+    if entry and cache.is_fresh(entry):
+        cache.touch(entry["digest"])
+        outputs = cache.publish(image, entry["outputs"])
+        if outputs is not None:
+            cache.record("url_hit")
+            return outputs, None, {}
+        entry = None
+    content, validators = fetch(url, entry.get("etag") if entry else None, entry.get("last_modified") if entry else None)
+    if content is None:
+        cache.revalidated(url, entry)
+        outputs = cache.publish(image, entry["outputs"])
+        if outputs is not None:
+            cache.record("revalidated_hit")
+            return outputs, None, {}
+        content, validators = fetch(url)
+    return None, content, validators
+
+
+def transform_stage(image: Dict, content: bytes, validators: Dict, transform: Callable[[bytes], List[Variant]],
+                     save: Callable[[Dict, Variant], str], cache: Optional[ImageCache]) -> Outputs:
+    """Transform and store `content`, reusing cached outputs for identical bytes. Returns the image's output URLs."""
+    if cache is None:
+        return {variant.name: save(image, variant) for variant in transform(content)}
+    digest = content_digest(content)
+    keys = cache.lookup_content(digest)
+    outputs = cache.publish(image, keys) if keys else None
+    if outputs is not None:
+        cache.record("content_hit")
+        cache.remember_url(image["input_image_url"], digest, **validators)
+        return outputs
+    # A miss, or a hit evicted before it could be published
+    variants = transform(content)
+    keys = cache.store_outputs(digest, variants)
+    cache.record("miss")
+    cache.remember_url(image["input_image_url"], digest, **validators)
+    outputs = cache.publish(image, keys)
+    if outputs is None:
+        # Evicted again straight away (a budget smaller than this entry): save the image's own copies
+        outputs = {variant.name: save(image, variant) for variant in variants}
+    return outputs
+
+
+ImageResult = Tuple[Dict, Optional[Outputs], Optional[BaseException]]
+
+
+def process_images(images: List[Dict], transform: Callable[[bytes], List[Variant]], save: Callable[[Dict, Variant], str],
+                   cache: Optional[ImageCache] = None) -> Iterator[ImageResult]:
+    """
+    Download and transform `images` concurrently, yielding `(image, outputs, error)` as each finishes.
+
+    `transform` turns source bytes into one or more variants and `outputs` maps each
+    variant name to where it was stored.
+
+    Up to `image_download_concurrency` downloads run at once; each finished download is
+    handed to the transform pool, so decode/resize of one image overlaps with the
+    network time of the others. With a `cache`, URL and content hits skip the download
+    and/or the transform. Results are yielded on the calling thread so the caller can
+    use its (non thread-safe) DB session.
+    """
+    pending: Dict[Future, Tuple[str, Dict]] = {submit_download(image, cache): ("download", image) for image in images}
+
+    while pending:
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            stage, image = pending.pop(future)
+            error = future.exception()
+            if error is not None:
+                yield image, None, error
+            elif stage == "download":
+                cached_outputs, content, validators = future.result()
+                if cached_outputs:
+                    yield image, cached_outputs, None
+                else:
+                    future = _transform_pool.submit(transform_stage, image, content, validators, transform, save, cache)
+                    pending[future] = ("transform", image)
+            else:
+                yield image, future.result(), None
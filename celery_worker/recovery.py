@@ -0,0 +1,125 @@
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.crud import FINAL_STATUSES, as_hex
+from app.model import ImageStatus, ImageUrl, Request, RequestStatus
+
+
+def retry_countdown(attempts: int) -> float:
+    """
+    Seconds before handing an image out for the `attempts`-th time: exponential backoff
+    with jitter, capped so the delayed message is always taken by a worker well
+    within the broker's visibility timeout (after which Redis would deliver it twice).
+    """
+    ceiling = min(
+        settings.image_retry_backoff * 2 ** max(0, attempts - 1),
+        settings.image_retry_backoff_max,
+        settings.broker_visibility_timeout / 2,
+    )
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def claim_for_retry(db: Session, image_ids: Iterable[str]) -> List[Tuple[str, int]]:
+    """
+    Count one more attempt on each unfinished image in `image_ids` and keep it
+    'processing'. Returns `(image_id, attempts)` (hex ids); finished images are skipped.
+    """
+    image_ids = list(image_ids)
+    if not image_ids:
+        return []
+    rows = db.execute(
+        update(ImageUrl)
+        .where(ImageUrl.image_id.in_(image_ids), ImageUrl.status.notin_(FINAL_STATUSES))
+        .values(attempts=ImageUrl.attempts + 1, status=ImageStatus.processing)
+        .returning(ImageUrl.image_id, ImageUrl.attempts)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return [(as_hex(row.image_id), row.attempts) for row in rows]
+
+
+def stuck_images(db: Session, older_than: timedelta, limit: int) -> Dict[str, List[Dict]]:
+    """
+    Up to `limit` images that have been 'processing' for longer than `older_than`
+    (their worker died, or their message was lost), grouped by request id.
+    """
+    rows = db.execute(
+        select(ImageUrl.request_id, ImageUrl.image_id, ImageUrl.input_image_url)
+        .where(ImageUrl.status == ImageStatus.processing, ImageUrl.updated_at < func.now() - older_than)
+        .order_by(ImageUrl.updated_at)
+        .limit(limit)
+    )
+    by_request: Dict[str, List[Dict]] = {}
+    for row in rows:
+        by_request.setdefault(as_hex(row.request_id), []).append(
+            {"image_id": as_hex(row.image_id), "input_image_url": row.input_image_url}
+        )
+    return by_request
+
+
+def reset_for_resume(db: Session, request: Request, include_failed: bool) -> int:
+    """
+    Put the request's unfinished images (and with `include_failed`, its failed ones)
+    back to 'pending' with a fresh attempt budget. Failed images are taken off the
+    request's failed counter. Returns how many failed images were reset.
+    """
+    scope = (ImageUrl.request_id == request.request_id, ImageUrl.request_created_at == request.created_at)
+    reset_failed = 0
+    if include_failed:
+        reset_failed = db.execute(
+            update(ImageUrl.__table__)
+            .where(*scope, ImageUrl.status == ImageStatus.failed)
+            .values(status=ImageStatus.pending, attempts=0)
+        ).rowcount
+    db.execute(
+        update(ImageUrl.__table__)
+        .where(*scope, ImageUrl.status.in_([ImageStatus.pending, ImageStatus.processing]))
+        .values(status=ImageStatus.pending, attempts=0)
+    )
+    if reset_failed:
+        db.execute(
+            update(Request)
+            .where(Request.request_id == request.request_id)
+            .values(failed_images=Request.failed_images - reset_failed)
+        )
+    db.commit()
+    return reset_failed
+
+
+def iter_pending(db: Session, request: Request, batch_size: int) -> Iterator[List[Dict]]:
+    """The request's 'pending' images in lists of `batch_size`, read through a server-side cursor."""
+    rows = db.execute(
+        select(ImageUrl.image_id, ImageUrl.input_image_url)
+        .where(
+            ImageUrl.request_id == request.request_id,
+            ImageUrl.request_created_at == request.created_at,
+            ImageUrl.status == ImageStatus.pending,
+        )
+        .execution_options(yield_per=batch_size)
+    )
+    for partition in rows.partitions():
+        yield [{"image_id": as_hex(row.image_id), "input_image_url": row.input_image_url} for row in partition]
+
+
+def stalled_requests(db: Session, older_than: timedelta, limit: int) -> List[str]:
+    """
+    Up to `limit` unfinalized requests (hex ids) whose row has not changed for longer
+    than `older_than`: no image of theirs reached a final state in that time.
+    """
+    rows = db.execute(
+        select(Request.request_id)
+        .where(
+            Request.status.in_([RequestStatus.pending, RequestStatus.processing]),
+            Request.archived_at.is_(None),
+            # Both columns are stamped by the application clock
+            func.coalesce(Request.updated_at, Request.created_at) < datetime.now() - older_than,
+        )
+        .order_by(Request.created_at)
+        .limit(limit)
+    )
+    return [as_hex(row.request_id) for row in rows]
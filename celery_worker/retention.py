@@ -0,0 +1,127 @@
+import json
+from datetime import datetime
+from typing import Dict, Iterator
+
+from sqlalchemy import delete, exists, func, select, update
+from sqlalchemy.orm import Session
+
+from app.config import Logger, settings
+from app.model import ImageUrl, Product, Request, RequestStatus
+from app.partitions import add_months, drop_month, list_partitions
+from app.storage import StorageBackend
+from celery_worker.export import gzip_chunks
+
+logger = Logger.get_logger(__name__)
+
+FINISHED = (RequestStatus.completed, RequestStatus.failed)
+
+
+def archive_key(request: Request) -> str:
+    return f"{settings.archive_prefix}/{request.created_at:%Y-%m}/{request.request_id}.jsonl.gz"
+
+
+def _archive_lines(db: Session, request: Request, batch_size: int) -> Iterator[bytes]:
+    """The request as the first JSON line, then one line per image with its product's fields."""
+    yield (json.dumps({
+        "request_id": request.request_id,
+        "status": request.status.value if request.status else None,
+        "created_at": request.created_at.isoformat(),
+        "total_images": request.total_images,
+        "completed_images": request.completed_images,
+        "failed_images": request.failed_images,
+        "transform": request.transform,
+    }) + "\n").encode("utf-8")
+
+    rows = (
+        db.query(
+            Product.product_id, Product.serial_number, Product.product_name,
+            ImageUrl.image_id, ImageUrl.input_image_url, ImageUrl.output_image_url,
+            ImageUrl.output_variants, ImageUrl.status,
+        )
+        .join(Product, Product.product_id == ImageUrl.product_id)
+        # The partition key confines both scans to the request's month
+        .filter(
+            ImageUrl.request_id == request.request_id,
+            ImageUrl.request_created_at == request.created_at,
+            Product.request_created_at == request.created_at,
+        )
+        .execution_options(yield_per=batch_size)
+    )
+    for row in rows:
+        record: Dict = row._asdict()
+        record["status"] = row.status.value if row.status else None
+        yield (json.dumps(record) + "\n").encode("utf-8")
+
+
+def archive_request(db: Session, storage: StorageBackend, request: Request) -> str:
+    """Stream `request` and its rows to a gzipped JSON Lines object and return its URL."""
+    key = archive_key(request)
+    with storage.open_write(key, "application/gzip") as writer:
+        for chunk in gzip_chunks(_archive_lines(db, request, settings.export_batch_size)):
+            writer.write(chunk)
+    return storage.url(key)
+
+
+def fail_expired_requests(db: Session, cutoff: datetime) -> int:
+    """
+    Mark requests created before `cutoff` that never finished as failed, so they are
+    archived like the rest instead of holding their month's partitions forever. Their
+    images keep whatever status they had, which the archive records.
+    """
+    failed = db.execute(
+        update(Request)
+        .where(Request.created_at < cutoff, Request.archived_at.is_(None), Request.status.not_in(FINISHED))
+        .values(status=RequestStatus.failed, updated_at=datetime.now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    if failed:
+        logger.warning(f"Marked {failed} unfinished requests created before {cutoff:%Y-%m-%d} as failed")
+    return failed
+
+
+def archive_finished_requests(db: Session, storage: StorageBackend, cutoff: datetime, limit: int) -> int:
+    """Archive up to `limit` finished, not yet archived requests created before `cutoff`, oldest first."""
+    requests = (
+        db.query(Request)
+        .filter(Request.created_at < cutoff, Request.archived_at.is_(None), Request.status.in_(FINISHED))
+        .order_by(Request.created_at)
+        .limit(limit)
+        .all()
+    )
+    for request in requests:
+        location = archive_request(db, storage, request)
+        request.archived_at = datetime.now()
+        db.commit()
+        logger.info(f"Archived request {request.request_id} to {location}")
+    return len(requests)
+
+
+def drop_expired_months(db: Session, cutoff: datetime) -> int:
+    """
+    Drop every monthly partition that ends before `cutoff` and whose requests are all
+    archived, then delete those requests. Stops at the first month that still holds
+    unarchived requests so months are always released oldest first.
+    """
+    conn = db.connection()
+    dropped = 0
+    for _, month in list_partitions(conn, "products"):
+        end = add_months(month, 1)
+        if end > cutoff.date():
+            break
+        in_month = (Request.created_at >= month, Request.created_at < end)
+        unarchived = db.scalar(select(func.count()).where(*in_month, Request.archived_at.is_(None)))
+        if unarchived:
+            logger.warning(f"Keeping partitions for {month:%Y-%m}: {unarchived} requests are not archived yet")
+            break
+        drop_month(conn, month)
+        # Requests with rows left in the DEFAULT partition stay until those rows are gone
+        db.execute(
+            delete(Request)
+            .where(*in_month, ~exists().where(Product.request_id == Request.request_id))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        dropped += 1
+        logger.info(f"Dropped partitions for {month:%Y-%m}")
+    return dropped
@@ -0,0 +1,171 @@
+import time
+from concurrent.futures import as_completed
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.config import Logger, settings
+from app.image_cache import ImageCache
+from app.redis_client import get_redis
+from celery_worker import pipeline
+from celery_worker.transform import Variant
+
+logger = Logger.get_logger(__name__)
+
+# Per-stage counters of the two-stage pipeline (fetch_*, transform_*), cluster-wide
+STATS_KEY = "pipeline:stats"
+# Blobs parked between the stages: a sorted set of blob keys scored by expiry, and a hash of
+# their sizes with the running total under "total". Entries are dropped when a blob is taken
+# or once its expiry has passed, so the total cannot drift from what Redis actually holds.
+STAGED_KEY = "pipeline:staged"
+STAGED_SIZES_KEY = "pipeline:staged_sizes"
+
+# ARGV: op ("put", "take" or "size"), blob key, size, ttl. Expired entries are released
+# first, using the server clock. Returns the bytes parked afterwards.
+_STAGED = """
+local function release(member)
+    local size = tonumber(redis.call('HGET', KEYS[2], member))
+    if size then
+        redis.call('HDEL', KEYS[2], member)
+        redis.call('HINCRBY', KEYS[2], 'total', -size)
+    end
+    redis.call('ZREM', KEYS[1], member)
+end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+for _, member in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now)) do
+    release(member)
+end
+local op = ARGV[1]
+if op == 'put' then
+    local ttl = tonumber(ARGV[4])
+    release(ARGV[2])
+    redis.call('ZADD', KEYS[1], now + ttl, ARGV[2])
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+    redis.call('HINCRBY', KEYS[2], 'total', ARGV[3])
+    -- Both keys outlive the newest blob, after which every entry has expired anyway
+    redis.call('EXPIRE', KEYS[1], math.ceil(ttl) + 1)
+    redis.call('EXPIRE', KEYS[2], math.ceil(ttl) + 1)
+elseif op == 'take' then
+    release(ARGV[2])
+end
+return tonumber(redis.call('HGET', KEYS[2], 'total')) or 0
+"""
+
+_script = None
+
+
+def _staged(op: str, key: str = "", size: int = 0) -> int:
+    global _script
+    client = get_redis()
+    if _script is None or _script.registered_client is not client:
+        _script = client.register_script(_STAGED)
+    return int(_script(keys=[STAGED_KEY, STAGED_SIZES_KEY], args=[op, key, size, settings.fetch_blob_ttl]))
+
+
+def staged_bytes() -> int:
+    """Bytes currently parked between the stages."""
+    return _staged("size")
+
+
+def blob_key(image_id: str) -> str:
+    return f"pipeline:blob:{image_id}"
+
+
+def record(stage: str, images: int = 0, errors: int = 0, seconds: float = 0.0, nbytes: int = 0):
+    """Add one batch to `stage`'s counters."""
+    pipe = get_redis().pipeline()
+    pipe.hincrby(STATS_KEY, f"{stage}_images", images)
+    if errors:
+        pipe.hincrby(STATS_KEY, f"{stage}_errors", errors)
+    if nbytes:
+        pipe.hincrby(STATS_KEY, f"{stage}_bytes", nbytes)
+    pipe.hincrbyfloat(STATS_KEY, f"{stage}_seconds", seconds)
+    pipe.execute()
+
+
+def pipeline_stats() -> Dict[str, float]:
+    """Counters of both stages plus the bytes waiting between them."""
+    client = get_redis()
+    stats = {key.decode(): float(value) for key, value in client.hgetall(STATS_KEY).items()}
+    stats["staged_bytes"] = staged_bytes()
+    return stats
+
+
+def put_blob(image_id: str, content: bytes) -> str:
+    """Park downloaded bytes for the transform stage; they expire after FETCH_BLOB_TTL seconds."""
+    key = blob_key(image_id)
+    get_redis().set(key, content, ex=settings.fetch_blob_ttl)
+    _staged("put", key, len(content))
+    return key
+
+
+def take_blob(key: str) -> Optional[bytes]:
+    """Read and delete parked bytes; None once they have expired."""
+    pipe = get_redis().pipeline()
+    pipe.get(key)
+    pipe.delete(key)
+    content, _ = pipe.execute()
+    _staged("take", key)
+    return content
+
+
+def wait_for_room(max_sleep: float = 1.0) -> float:
+    """
+    Hold the fetch stage while FETCH_MAX_STAGED_BYTES are parked, so downloads cannot
+    outrun the transform workers and fill Redis. Gives up after FETCH_BLOB_TTL seconds,
+    by which time every blob parked when it started has expired. Returns the time waited.
+    """
+    limit = settings.fetch_max_staged_bytes
+    if not limit:
+        return 0.0
+    started = time.monotonic()
+    while staged_bytes() >= limit:
+        waited = time.monotonic() - started
+        if waited >= settings.fetch_blob_ttl:
+            logger.warning(f"Staged bytes still at the {limit} byte limit after {waited:.0f} s; fetching anyway")
+            return waited
+        time.sleep(max_sleep)
+    return time.monotonic() - started
+
+
+def fetch_staged(images: List[Dict], cache: Optional[ImageCache]) -> Iterator[Tuple[Dict, Dict]]:
+    """
+    Fetch stage: download `images` concurrently and park their bytes, yielding
+    `(image, handoff)` as each finishes. `handoff` holds `outputs` for cache hits,
+    `blob` and `validators` for downloaded bytes, or `error` and whether it is `transient`.
+    """
+    futures = {pipeline.submit_download(image, cache): image for image in images}
+    for future in as_completed(futures):
+        image = futures[future]
+        error = future.exception()
+        if error is not None:
+            yield image, {"error": str(error), "transient": pipeline.is_transient(error)}
+            continue
+        cached_outputs, content, validators = future.result()
+        if cached_outputs:
+            yield image, {"outputs": cached_outputs}
+        else:
+            wait_for_room()
+            yield image, {"blob": put_blob(image["image_id"], content), "validators": validators, "bytes": len(content)}
+
+
+def transform_staged(staged: List[Dict], transform: Callable[[bytes], List[Variant]], save: Callable[[Dict, Variant], str],
+                     cache: Optional[ImageCache]) -> Iterator[pipeline.ImageResult]:
+    """
+    Transform stage: turn the fetch stage's handoffs into `(image, outputs, error)` like
+    `pipeline.process_images`, one image at a time on the calling process (the stage's
+    pool is sized to the cores). Bytes that expired before this ran are fetched again.
+    """
+    for entry in staged:
+        image = {"image_id": entry["image_id"], "input_image_url": entry["input_image_url"]}
+        outputs, error = entry.get("outputs"), None
+        if "error" in entry:
+            error = (pipeline.TransientError if entry.get("transient") else RuntimeError)(entry["error"])
+        elif not outputs:
+            try:
+                content, validators = take_blob(entry["blob"]), entry.get("validators") or {}
+                if content is None:
+                    content, validators = pipeline.fetch(image["input_image_url"])
+                outputs = pipeline.transform_stage(image, content, validators, transform, save, cache)
+            except Exception as e:
+                error = e
+        yield image, outputs, error
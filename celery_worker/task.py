@@ -1,18 +1,36 @@
+import itertools
 import time
-import uuid
-import io
-import requests
-from io import BytesIO
-from PIL import Image
-import pandas as pd
-from sqlalchemy import update, func, text
+from datetime import datetime, timedelta
+from celery import current_task
+from celery.exceptions import MaxRetriesExceededError
+from redis.exceptions import RedisError
+from sqlalchemy import update, func
+from sqlalchemy.exc import DBAPIError
+from app.crud import ImageResultBuffer, as_hex, bulk_insert_products, claim_images, product_key
 from app.database import ConnectionManager
-from app.model import ImageStatus, ImageUrl, Product, Request
-from celery_worker.worker import celery_app
+from app.image_cache import ImageCache
+from app.log import SAMPLED
+from app.metrics import IMAGES_PROCESSED
+from app.storage import content_type_for, get_storage
+from app.model import ImageStatus, Product, Request, RequestStatus
+from app.partitions import add_months, ensure_partitions, month_start
+from app.progress import add_finished, claim_finalization, mark_finished, mark_reopened
+from app.redis_client import get_redis
+from app.schema import TransformSpec
+from celery_worker.export import CONTENT_TYPES, export_chunks, export_filename, iter_result_rows
+from celery_worker.pipeline import is_transient, process_images
+from celery_worker.recovery import (
+    claim_for_retry, iter_pending, reset_for_resume, retry_countdown, stalled_requests, stuck_images
+)
+from celery_worker.staging import fetch_staged, record as record_stage, take_blob, transform_staged
+from celery_worker.retention import archive_finished_requests, drop_expired_months, fail_expired_requests
+from celery_worker.transform import EncodeOptions, Variant, render_variants, scale_image
+from celery_worker.webhooks import KICK_KEY as WEBHOOK_KICK_KEY, deliver_due, enqueue as enqueue_webhooks
+from celery_worker.worker import BULK_COMPRESSION, FETCH_QUEUE, TRANSFORM_QUEUE, WEBHOOK_QUEUE, celery_app
 from app.config import settings, Logger
 
 
-logger = Logger.get_logger()
+logger = Logger.get_logger(__name__)
 
 @celery_app.task(name='add_numbers', queue="fast")
 def add(x, y):
@@ -27,194 +45,490 @@ def simulate_long_task(seconds):
 
 
 
-@celery_app.task(name='finalize_request', queue='image_process')
-def finalize_request(results, request_id):
+@celery_app.task(name='finalize_request', queue='image_process', ignore_result=True)
+def finalize_request(request_id):
     """
-    This task finalizes the request by checking that all tasks are complete,
-    querying the database for results, converting the results to a CSV file,
-    and sending it to the webhook URL as a file.
+    This task marks the request completed and hands its results over. It is published
+    once per completion by the request barrier; a redelivered copy finds the request
+    completed and does nothing.
+
+    With EXPORT_TARGET=storage the results file is streamed to the storage backend here.
+    Webhook calls (the results file for EXPORT_TARGET=webhook, the completion notice for
+    a callback URL given at upload) go to the outbox in the same transaction as the final
+    status and are sent by `deliver_webhooks` on the webhooks queue, so an image worker
+    never waits on a receiver.
     """
-    
-    print("ALL TASKS COMPLETED")
     try:
-        # Initialize database connection
-        with ConnectionManager(settings.database_url.unicode_string()) as db:
-            # Query to concatenate input and output URLs for each product using string_agg
-            query_result = (
-                db.query(
-                    Request.request_id,
-                    Product.product_id,
-                    Product.serial_number,
-                    Product.product_name,
-                    func.string_agg(ImageUrl.input_image_url, ', ').label('input_image_urls'),
-                    func.string_agg(ImageUrl.output_image_url, ', ').label('output_image_urls')
-                )
-                .join(Product, Request.request_id == Product.request_id)
-                .join(ImageUrl, Product.product_id == ImageUrl.product_id)
-                .filter(Request.request_id == request_id)
-                .group_by(Request.request_id, Product.product_id, Product.serial_number, Product.product_name)
-                .all()
-            )
+        with ConnectionManager() as db:
+            request = db.get(Request, request_id)
+            if request.status == RequestStatus.completed:
+                logger.info(f"Request {request_id} is already finalized")
+                return
+            results_url = _export_to_storage(db, request_id) if settings.export_target == "storage" else None
+            # Every image has reached a final state by now
+            finalized = db.execute(
+                update(Request)
+                .where(Request.request_id == request_id, Request.status != RequestStatus.completed)
+                .values(status=RequestStatus.completed)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not finalized:
+                db.rollback()
+                return
+            db.refresh(request)
+            queued = enqueue_webhooks(db, request, results_url)
+            db.commit()
+        try:
+            mark_finished(request_id)
+        except RedisError as e:
+            logger.warning(f"Could not publish completion of request {request_id}: {e}")
+        if queued:
+            kick_webhooks()
+
+    except Exception as e:
+        logger.error(f"Error in finalize_request for request_id {request_id}: {e}")
+        raise e
 
-        # Check if query_result is empty
-        if not query_result:
-            logger.warning(f"No data found for request_id: {request_id}")
+
+def _export_to_storage(db, request_id):
+    """
+    Stream the request's results out of the database into one file on the storage backend
+    and return its URL (None if the request has no rows).
+
+    Rows come from a server-side cursor `export_batch_size` at a time and are encoded
+    (CSV, JSON Lines or Parquet, optionally gzipped) and written as each batch is ready,
+    so memory stays flat however many products the request has.
+    """
+    fmt, gzip = settings.export_format, settings.export_gzip
+    rows = iter_result_rows(db, request_id, settings.export_batch_size)
+    first = next(rows, None)
+    if first is None:
+        logger.warning(f"No data found for request_id: {request_id}")
+        return None
+    chunks = export_chunks(itertools.chain([first], rows), fmt, gzip, settings.export_batch_size)
+    key = f"exports/{request_id}/{export_filename(fmt, gzip)}"
+    storage = get_storage()
+    with storage.open_write(key, "application/gzip" if gzip else CONTENT_TYPES[fmt]) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    logger.info(f"Results for request_id {request_id} exported to {storage.url(key)}")
+    return storage.url(key)
+
+
+def kick_webhooks():
+    """
+    Schedule a `deliver_webhooks` run WEBHOOK_BATCH_WINDOW seconds out, unless one is
+    already scheduled, so notices finishing close together go out in the same calls.
+    The beat drain picks up anything a lost kick leaves behind.
+    """
+    window = settings.webhook_batch_window
+    try:
+        if not get_redis().set(WEBHOOK_KICK_KEY, 1, nx=True, ex=max(1, int(window))):
             return
+    except RedisError as e:
+        logger.warning(f"Could not coalesce webhook delivery, scheduling anyway: {e}")
+    deliver_webhooks.apply_async(countdown=window, priority=9)
+
+
+@celery_app.task(name='deliver_webhooks', queue=WEBHOOK_QUEUE, ignore_result=True)
+def deliver_webhooks():
+    """Send every due outbox call; failures are rescheduled with backoff or dead-lettered."""
+    with ConnectionManager() as db:
+        delivered, failed = deliver_due(db)
+    if delivered or failed:
+        logger.info(f"Webhook outbox drained: {delivered} delivered, {failed} failed")
+
+
+@celery_app.task(name='maintain_partitions', queue='slow', ignore_result=True)
+def maintain_partitions():
+    """Create the monthly partitions for the current month and the next PARTITION_PREMAKE_MONTHS."""
+    this_month = month_start(datetime.now())
+    with ConnectionManager() as db:
+        created = ensure_partitions(db.connection(), this_month, add_months(this_month, settings.partition_premake_months))
+        db.commit()
+    if created:
+        logger.info(f"Created partitions: {', '.join(created)}")
+
+
+@celery_app.task(name='apply_retention', queue='slow', ignore_result=True)
+def apply_retention():
+    """
+    Archive requests older than RETENTION_DAYS to compressed files in the storage
+    backend, then drop the monthly partitions that hold only archived requests. Requests
+    still unfinished by then are marked failed first and archived with the rest.
+    """
+    if settings.retention_days <= 0:
+        return
+    cutoff = datetime.now() - timedelta(days=settings.retention_days)
+    with ConnectionManager() as db:
+        fail_expired_requests(db, cutoff)
+        archived = archive_finished_requests(db, get_storage(), cutoff, settings.retention_batch_size)
+        dropped = drop_expired_months(db, cutoff)
+    logger.info(f"Retention before {cutoff:%Y-%m-%d}: archived {archived} requests, dropped {dropped} months")
+
+
+@celery_app.task(name='sweep_stuck_images', queue='slow', ignore_result=True)
+def sweep_stuck_images():
+    """
+    Requeue images left 'processing' for longer than STUCK_IMAGE_TIMEOUT, e.g. by a
+    worker that was killed, and reopen their requests if they were finalized meanwhile.
+    """
+    requeued = 0
+    with ConnectionManager() as db:
+        for request_id, images in stuck_images(db, timedelta(seconds=settings.stuck_image_timeout), settings.sweep_batch_size).items():
+            request = db.get(Request, request_id)
+            _requeue_images(db, images, request.transform, request_id)
+            _reopen_request(db, request_id)
+            requeued += len(images)
+        overdue = stalled_requests(db, timedelta(seconds=settings.barrier_timeout), settings.sweep_batch_size)
+    if requeued:
+        logger.warning(f"Requeued {requeued} images stuck in processing for over {settings.stuck_image_timeout}s")
+    for request_id in overdue:
+        # E.g. a product task that failed before writing its rows, or counters lost with Redis
+        logger.warning(f"Request {request_id} made no progress for {settings.barrier_timeout}s; finalizing anyway.")
+        _finalize(request_id, force=True)
+
+
+@celery_app.task(name='resume_request', queue='slow', ignore_result=True)
+def resume_request(request_id, include_failed=False):
+    """
+    Process a request's unfinished images again (and with `include_failed`, its failed
+    ones), then deliver its results anew. Finished images are not touched.
+    """
+    with ConnectionManager() as db:
+        request = db.get(Request, request_id)
+        reset_failed = reset_for_resume(db, request, include_failed)
+        if reset_failed:
+            try:
+                add_finished(request_id, failed=-reset_failed)
+            except RedisError as e:
+                logger.warning(f"Could not update progress counters for request {request_id}: {e}")
+        task = fetch_images if settings.pipeline_mode == "staged" else process_image_chunk
+        resumed = 0
+        for images in iter_pending(db, request, settings.image_chunk_size):
+            task.apply_async(args=[images, request.transform, request_id])
+            resumed += len(images)
+        _reopen_request(db, request_id)
+    logger.info(f"Resumed request {request_id}: {resumed} images requeued, {reset_failed} of them previously failed")
+
+
+ENCODE_OPTIONS = EncodeOptions.from_settings()
+# Identifies the default transform in cache keys; derived from every setting that changes the output
+TRANSFORM_KEY = f"resize-{settings.resize_scale:g}-jpeg-{ENCODE_OPTIONS.key}"
+DEFAULT_VARIANT = "default"
+
+
+def resize(content):
+    """Decode and downscale one downloaded image into the single default JPEG variant. Runs on the transform pool."""
+    return [Variant(DEFAULT_VARIANT, scale_image(content, settings.resize_scale, ENCODE_OPTIONS, settings.resize_reducing_gap), "jpg")]
+
+
+def build_transform(transform_spec=None):
+    """
+    Return `(transform, transform_key)` for a request's transform spec.
+    Without a spec the default 50% JPEG resize is used.
+    """
+    if not transform_spec:
+        return resize, TRANSFORM_KEY
+    spec = TransformSpec.model_validate(transform_spec)
+
+    def transform(content):
+        return render_variants(
+            content, spec.sizes, spec.format, spec.quality, spec.strip_metadata,
+            ENCODE_OPTIONS, settings.resize_reducing_gap
+        )
+    return transform, f"{spec.key}-{ENCODE_OPTIONS.key}"
+
+
+def output_key(image_id, name, extension):
+    """Storage key of an image's output variant; cache hits are copied here too."""
+    if name == DEFAULT_VARIANT:
+        return f"outputs/{image_id}.{extension}"
+    return f"outputs/{image_id}_{name}.{extension}"
+
 
-        # Convert query results to a pandas DataFrame
-        data = []
-        for row in query_result:
-            data.append({
-                'Product ID': row.product_id,
-                'Serial Number': row.serial_number,
-                'Product Name': row.product_name,
-                'Input Image URLs': row.input_image_urls,
-                'Output Image URLs': row.output_image_urls,
-            })
-        df = pd.DataFrame(data)
-
-        # Convert DataFrame to CSV
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
-
-        # Prepare to send the CSV to the webhook URL
-        csv_buffer.seek(0)  # Move to the start of the stream
-        webhook_url = "http://127.0.0.1:8003/webhook"  # Replace with your actual webhook URL
-        files = {'file': ('results.csv', csv_buffer, 'text/csv')}
-
-        # Send POST request with the CSV file to the webhook URL
-        response = requests.post(webhook_url, files=files, data={'request_id': request_id})
-        response.raise_for_status()  # Raise an error for any unsuccessful status code
-
-        logger.info(f"Webhook sent successfully for request_id: {request_id}. Response: {response.status_code}")
+def save_output(image, variant):
+    """Save the processed image to the storage backend and return its URL"""
+    key = output_key(image["image_id"], variant.name, variant.extension)
+    return get_storage().put(key, variant.data, content_type_for(key))
 
+
+@celery_app.task(name='await_request_completion', queue='image_process', bind=True, ignore_result=True)
+def await_request_completion(self, request_id, expected_products):
+    """
+    Database fallback of the request barrier, for uploads that could not seal their
+    Redis counters. Re-checks until every product row exists and the request's
+    completed/failed counters account for all of its images, then hands over to
+    finalize_request.
+    """
+    with ConnectionManager() as db:
+        products = db.query(func.count(Product.product_id)).filter(Product.request_id == request_id).scalar()
+        request = db.get(Request, request_id)
+        unfinished = (request.total_images or 0) - request.completed_images - request.failed_images if request else 0
+
+    if products < expected_products or unfinished:
+        try:
+            raise self.retry(
+                countdown=settings.barrier_poll_interval,
+                max_retries=settings.barrier_timeout // max(1, settings.barrier_poll_interval)
+            )
+        except MaxRetriesExceededError:
+            logger.warning(
+                f"Request {request_id} still has {expected_products - products} missing products and "
+                f"{unfinished} unfinished images after {settings.barrier_timeout}s; finalizing anyway."
+            )
+
+    finalize_request.delay(request_id)
+
+
+def _finalize(request_id, force=False):
+    """
+    Publish finalize_request for a request the barrier reported done. With `force`, the
+    barrier is claimed first whatever its counters say; it is skipped if already taken.
+    """
+    if force:
+        try:
+            if not claim_finalization(request_id):
+                return
+        except RedisError as e:
+            logger.warning(f"Could not claim finalization of request {request_id}, finalizing anyway: {e}")
+    finalize_request.delay(request_id)
+
+
+def _process_image_rows(db, images, transform_spec=None, request_id=None, staged=None):
+    """
+    Download and transform already-persisted image rows, writing results and the
+    request's progress counters in micro-batches. With `staged` (the fetch stage's
+    handoffs) only the transform runs here.
+    Images that hit a transient error are handed out again on their own, after a
+    backoff, instead of failing them or the task. Rows that never get a result
+    (e.g. the task is interrupted) are marked failed.
+    """
+    transform, transform_key = build_transform(transform_spec)
+    cache = ImageCache(transform_key, output_key) if settings.image_cache_enabled else None
+    if staged is None:
+        # Downloads run concurrently and overlap with resizing; results
+        # arrive here in completion order on the task's own thread.
+        processed = process_images(images, transform, save_output, cache)
+    else:
+        processed = transform_staged(staged, transform, save_output, cache)
+    processed_by = current_task.name if current_task else "inline"
+    retry = []
+    with ImageResultBuffer(db, flush_size=settings.image_status_flush_size, request_id=request_id) as results:
+        try:
+            for image, outputs, error in processed:
+                image_id = image["image_id"]
+                if error is None:
+                    # The largest variant doubles as the primary output
+                    output_image_url = next(iter(outputs.values()))
+                    results.add(image_id, ImageStatus.completed, output_image_url, outputs if transform_spec else None)
+                    IMAGES_PROCESSED.labels(processed_by, "completed").inc()
+                    # Per-image, so only a sample of these reach the log (LOG_SAMPLE_RATE)
+                    logger.info("Image processed and saved at: %s", output_image_url, extra={**SAMPLED, "image_id": image_id})
+                elif is_transient(error):
+                    logger.warning(f"Transient error for image {image_id} from {image['input_image_url']}, will retry: {error}")
+                    retry.append(image)
+                else:
+                    # Handle any errors during image processing
+                    logger.error(f"Error processing image {image_id} from {image['input_image_url']}: {error}")
+                    results.add(image_id, ImageStatus.failed)
+                    IMAGES_PROCESSED.labels(processed_by, "failed").inc()
+        finally:
+            results.flush()
+            # Anything not flushed or up for retry must not stay 'processing'
+            unfinished = {image["image_id"] for image in images} - set(results.flushed_ids) - {image["image_id"] for image in retry}
+            for image_id in unfinished:
+                results.add(image_id, ImageStatus.failed)
+            IMAGES_PROCESSED.labels(processed_by, "failed").inc(len(unfinished))
+            results.flush()
+    if results.request_done:
+        _finalize(request_id)
+    if retry:
+        exhausted = _requeue_images(db, retry, transform_spec, request_id, _delivery_priority(current_task) if current_task else None)
+        IMAGES_PROCESSED.labels(processed_by, "failed").inc(exhausted)
+
+
+def _requeue_images(db, images, transform_spec, request_id, priority=None):
+    """
+    Hand `images` out again in their own tasks, each after the backoff for its attempt
+    count. Images that have used up IMAGE_MAX_ATTEMPTS are marked failed instead; their
+    number is returned.
+    """
+    by_id = {as_hex(image["image_id"]): image for image in images}
+    exhausted, by_attempt = [], {}
+    for image_id, attempts in claim_for_retry(db, by_id):
+        if attempts >= settings.image_max_attempts:
+            exhausted.append(image_id)
+        else:
+            image = by_id[image_id]
+            by_attempt.setdefault(attempts, []).append({"image_id": image_id, "input_image_url": image["input_image_url"]})
+    if exhausted:
+        logger.error(f"Giving up on {len(exhausted)} images of request {request_id} after {settings.image_max_attempts} attempts")
+        with ImageResultBuffer(db, flush_size=settings.image_status_flush_size, request_id=request_id) as results:
+            for image_id in exhausted:
+                results.add(image_id, ImageStatus.failed)
+        if results.request_done:
+            _finalize(request_id)
+    task = fetch_images if settings.pipeline_mode == "staged" else process_image_chunk
+    for attempts, batch in by_attempt.items():
+        for start in range(0, len(batch), settings.image_chunk_size):
+            task.apply_async(
+                args=[batch[start:start + settings.image_chunk_size], transform_spec, request_id],
+                countdown=retry_countdown(attempts), priority=priority,
+            )
+    return len(exhausted)
+
+
+def _reopen_request(db, request_id):
+    """
+    Make a finalized request wait for its images again: its barrier is opened anew and
+    delivers the results once the requeued images are done. Requests that were not
+    finalized yet are left to their barrier.
+    """
+    reopened = db.execute(
+        update(Request)
+        .where(Request.request_id == request_id, Request.status == RequestStatus.completed)
+        .values(status=RequestStatus.processing)
+    ).rowcount
+    db.commit()
+    if reopened:
+        try:
+            if mark_reopened(request_id):
+                _finalize(request_id)
+        except RedisError as e:
+            logger.warning(f"Could not reopen the barrier of request {request_id}, polling the database instead: {e}")
+            await_request_completion.apply_async(args=[request_id, 0], countdown=settings.barrier_poll_interval)
+
+
+def _delivery_priority(task):
+    """Broker priority the running task was published with, so follow-up work keeps its fair-scheduling slot."""
+    return (task.request.delivery_info or {}).get("priority")
+
+
+@celery_app.task(name='fetch_images', queue=FETCH_QUEUE, bind=True, ignore_result=True, compression=BULK_COMPRESSION)
+def fetch_images(self, images, transform_spec=None, request_id=None):
+    """
+    Fetch stage of PIPELINE_MODE=staged, meant for an I/O pool (`-P gevent`). Downloads
+    a chunk of persisted image rows, parks the bytes in Redis and hands the chunk to
+    transform_images. It does not touch the database, so hundreds can run per worker.
+    """
+    _, transform_key = build_transform(transform_spec)
+    cache = ImageCache(transform_key, output_key) if settings.image_cache_enabled else None
+    started = time.monotonic()
+    staged, errors, fetched_bytes = [], 0, 0
+    for image, handoff in fetch_staged(images, cache):
+        errors += "error" in handoff
+        fetched_bytes += handoff.pop("bytes", 0)
+        staged.append({"image_id": image["image_id"], "input_image_url": image["input_image_url"], **handoff})
+    record_stage("fetch", images=len(images), errors=errors, seconds=time.monotonic() - started, nbytes=fetched_bytes)
+    transform_images.apply_async(args=[staged, transform_spec, request_id], priority=_delivery_priority(self))
+
+
+@celery_app.task(name='transform_images', queue=TRANSFORM_QUEUE, ignore_result=True, compression=BULK_COMPRESSION)
+def transform_images(staged, transform_spec=None, request_id=None):
+    """
+    Transform stage of PIPELINE_MODE=staged, meant for a prefork pool sized to the
+    cores: decodes and resizes the bytes parked by fetch_images and records the results.
+    """
+    started = time.monotonic()
+    try:
+        with ConnectionManager() as db:
+            # A redelivered chunk only redoes the images that are not finished yet
+            claimed = claim_images(db, [entry["image_id"] for entry in staged])
+            db.commit()
+            for entry in staged:
+                if as_hex(entry["image_id"]) not in claimed and entry.get("blob"):
+                    take_blob(entry["blob"])
+            staged = [entry for entry in staged if as_hex(entry["image_id"]) in claimed]
+            _process_image_rows(db, staged, transform_spec, request_id, staged=staged)
     except Exception as e:
-        logger.error(f"Error in finalize_request for request_id {request_id}: {e}")
-        raise e
+        logger.error(f"Error transforming staged chunk of {len(staged)} images: {e}")
+        raise
+    finally:
+        record_stage("transform", images=len(staged), seconds=time.monotonic() - started)
 
 
-@celery_app.task(name='process_product', queue='image_process')
-def process_product(product_details):
-    """Process a row of a CSV implying processing a product and its images."""
+@celery_app.task(name='process_image_chunk', queue='image_process', ignore_result=True, compression=BULK_COMPRESSION)
+def process_image_chunk(images, transform_spec=None, request_id=None):
+    """
+    Process a chunk of image rows created at upload time, independent of which product they belong to.
+    Each entry carries `image_id` and `input_image_url`; `transform_spec` is the request's TransformSpec.
+    """
+    try:
+        with ConnectionManager() as db:
+            # Finished images (a redelivered or resumed chunk) are skipped
+            claimed = claim_images(db, [image["image_id"] for image in images])
+            db.commit()
+            images = [image for image in images if as_hex(image["image_id"]) in claimed]
+            _process_image_rows(db, images, transform_spec, request_id)
+    except Exception as e:
+        logger.error(f"Error processing image chunk of {len(images)} images: {e}")
+        raise
+
+
+@celery_app.task(name='process_product', queue='image_process', bind=True, ignore_result=True)
+def process_product(self, product_details):
+    """
+    Process a row of a CSV implying processing a product and its images. Database errors
+    are retried with backoff (the rows' ids are deterministic, so a retry finds what the
+    last attempt wrote); only a malformed row is reported back as a failure.
+    """
     try:
         request_id = product_details.get('request_id')
         serial_number = product_details.get('product_id')
         product_name = product_details.get('name')
         image_urls = product_details.get('images')
 
-        unique_product_id = uuid.uuid4().hex
-        new_product = Product(
-            product_id= unique_product_id,
-            request_id=request_id,
-            serial_number=serial_number,
-            product_name=product_name
-        )
-        save_product_to_database(new_product)
-        product_id= unique_product_id
+        # The same row always gets the same ids, so a redelivered task finds the rows it wrote before
+        product_id = product_key(request_id, serial_number, product_details.get('row'))
 
         logger.info(f"Processing product: {serial_number} - {product_name}")
 
-        if image_urls:
-            for image_url in image_urls:
-                logger.info(f"Processing image from URL: {image_url}")
-
-                # Properly handle session and add ImageUrl instance to the session
-                with ConnectionManager(settings.database_url.unicode_string()) as db:
-                    # Create ImageUrl instance and save to DB within the session context
-                    image_instance = ImageUrl(
-                        product_id=product_id,
-                        input_image_url=image_url,
-                        status=ImageStatus.pending
+        with ConnectionManager() as db:
+            request_created_at = product_details.get('request_created_at')
+            if request_created_at is None:
+                # Published before the partition key was part of the message
+                request_created_at = db.get(Request, request_id).created_at
+            elif isinstance(request_created_at, str):
+                request_created_at = datetime.fromisoformat(request_created_at)
+
+            # One round trip per table for the product and all of its image rows;
+            # images go straight to 'processing' since work on them starts now.
+            # On redelivery only the images not finished yet come back.
+            images = bulk_insert_products(db, [{
+                "product_id": product_id,
+                "request_id": request_id,
+                "request_created_at": request_created_at,
+                "serial_number": serial_number,
+                "product_name": product_name,
+                "images": image_urls,
+            }], image_status=ImageStatus.processing)[product_id]
+            db.commit()
+
+            if not image_urls:
+                logger.warning(f"No image URL provided for product: {serial_number}")
+
+            if settings.pipeline_mode == "staged":
+                # Rows are committed; the download and transform stages take it from here
+                staged = [{"image_id": image["image_id"], "input_image_url": image["input_image_url"]} for image in images]
+                if staged:
+                    fetch_images.apply_async(
+                        args=[staged, product_details.get('transform'), request_id], priority=_delivery_priority(self)
                     )
-                    db.add(image_instance)  # Add to session
-                    db.commit()  # Commit to save and bind the instance
-
-                    # Now the image_instance is bound to the session, you can access its ID
-                    image_id = image_instance.image_id
-
-                    # Process the image within the same task
-                    try:
-                        # Update status to 'processing'
-                        db.execute(
-                            text("UPDATE image_urls SET status = :status WHERE image_id = :image_id"),
-                            {"status": ImageStatus.processing.value, "image_id": image_id}
-                        )
-                        db.commit()
-
-                        # Retrieve the ImageUrl object by image_id
-                        image = db.query(ImageUrl).filter_by(image_id=image_id).one_or_none()
-                        if not image:
-                            logger.error(f"Image with ID {image_id} not found in database.")
-                            continue
-
-                        # Download the image
-                        response = requests.get(image.input_image_url)
-                        response.raise_for_status()
-
-                        # Open the image with PIL
-                        img = Image.open(BytesIO(response.content))
-
-                        # Resize the image by 50%
-                        img = img.resize((int(img.width * 0.5), int(img.height * 0.5)))
-
-                        # Save the processed image to an output path
-                        output_image_url = f"/path/to/output/directory/{image.image_id}.jpg"
-                        img.save(output_image_url)
-
-                        # Update image URL and status
-                        db.execute(
-                            text("UPDATE image_urls SET output_image_url = :output_image_url, status = :status WHERE image_id = :image_id"),
-                            {"output_image_url": output_image_url, "status": ImageStatus.completed.value, "image_id": image_id}
-                        )
-                        db.commit()
-
-                        logger.info(f"Image processed and saved at: {output_image_url}")
-
-                    except Exception as e:
-                        # Handle any errors during image processing
-                        logger.error(f"Error processing image {image_id}: {e}")
-                        db.execute(
-                            text("UPDATE image_urls SET status = :status WHERE image_id = :image_id"),
-                            {"status": ImageStatus.failed.value, "image_id": image_id}
-                        )
-                        db.commit()
+            else:
+                _process_image_rows(db, images, product_details.get('transform'), request_id)
 
-        else:
-            logger.warning(f"No image URL provided for product: {serial_number}")
-        
         return {
             'status': 'success',
             'message': f'Product {product_id} and its images processed successfully.'
         }
 
-    except Exception as e:
-        logger.error(f"Error processing product: {product_details} - {e}")
+    except DBAPIError as e:
+        logger.warning(f"Database error processing product {product_details.get('product_id')}, retrying: {e}")
+        raise self.retry(exc=e, countdown=retry_countdown(self.request.retries + 1), max_retries=settings.image_max_attempts)
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error(f"Invalid product: {product_details} - {e}")
         return {
             'status': 'failure',
             'message': str(e)
         }
-
-# Simulate saving product to a database
-def save_product_to_database(product):
-    """Simulate saving product to a database"""
-    with ConnectionManager(settings.database_url.unicode_string()) as db:
-        db.add(product)
-        db.commit()
-
-# Simulate saving image to a database
-def save_image_to_database(image):
-    """Save image instance to database"""
-    with ConnectionManager(settings.database_url.unicode_string()) as db:
-        db.add(image)
-        db.commit()
-
-def trigger_webhook(request_id, webhook_url):
-    if not webhook_url:
-        return
-
-    try:
-        response = requests.post(webhook_url, json={"request_id": request_id, "status": "completed"})
-        response.raise_for_status()
-        logger.info(f"Webhook triggered successfully for request {request_id} at {webhook_url}")
-    except Exception as e:
-        logger.error(f"Error triggering webhook for request {request_id}: {e}")
\ No newline at end of file
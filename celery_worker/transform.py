@@ -0,0 +1,189 @@
+from io import BytesIO
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+from app.config import settings
+from app.metrics import TRANSFORM_SECONDS
+
+ORIENTATION_TAG = 0x0112
+
+# EXIF orientation -> transpose that makes the image upright
+_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+class EncodeOptions(NamedTuple):
+    quality: int = 75
+    progressive: bool = True
+    optimize: bool = False
+
+    @classmethod
+    def from_settings(cls) -> "EncodeOptions":
+        return cls(
+            quality=settings.jpeg_quality,
+            progressive=settings.jpeg_progressive,
+            optimize=settings.jpeg_optimize,
+        )
+
+    @property
+    def key(self) -> str:
+        """Short fingerprint used in cache keys."""
+        return f"q{self.quality}{'p' if self.progressive else ''}{'o' if self.optimize else ''}"
+
+
+def draft(img: Image.Image, target: Tuple[int, int]) -> Image.Image:
+    """
+    For JPEGs, ask the decoder to downscale in the DCT domain before anything is decoded.
+
+    `draft` picks the largest 1/2, 1/4 or 1/8 scale that is still at least `target`
+    (in stored, pre-rotation pixels), so most of the full-resolution decode and the
+    memory it needs are skipped. Other formats are returned unchanged.
+    """
+    if img.format == "JPEG":
+        img.draft(None, target)
+    return img
+
+
+def orient(img: Image.Image, orientation: int) -> Image.Image:
+    """Apply the EXIF orientation so the output is upright without carrying the tag."""
+    method = _ORIENTATION_TRANSPOSE.get(orientation)
+    return img.transpose(method) if method is not None else img
+
+
+def to_jpeg_mode(img: Image.Image) -> Image.Image:
+    """Convert to a mode JPEG can store; transparency is flattened onto white."""
+    if img.mode in ("RGB", "L"):
+        return img
+    if img.mode == "P":
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+    if img.mode in ("RGBA", "LA", "PA"):
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def encode_jpeg(img: Image.Image, options: EncodeOptions) -> bytes:
+    buffer = BytesIO()
+    to_jpeg_mode(img).save(
+        buffer,
+        format="JPEG",
+        quality=options.quality,
+        progressive=options.progressive,
+        optimize=options.optimize,
+    )
+    return buffer.getvalue()
+
+
+def scale_image(content: bytes, scale: float, options: EncodeOptions, reducing_gap: float = 3.0) -> bytes:
+    """
+    Downscale `content` by `scale` and encode it as JPEG.
+
+    The JPEG decoder is drafted close to the target size first, then `reducing_gap`
+    lets Pillow shrink by an integer factor before the final Lanczos pass.
+    """
+    with TRANSFORM_SECONDS.labels("decode").time():
+        img = Image.open(BytesIO(content))
+        orientation = img.getexif().get(ORIENTATION_TAG, 1)
+        target = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = draft(img, target)
+        img.load()
+    with TRANSFORM_SECONDS.labels("resize").time():
+        if img.size != target:
+            img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+        img = orient(img, orientation)
+    with TRANSFORM_SECONDS.labels("encode").time():
+        return encode_jpeg(img, options)
+
+
+FORMAT_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "AVIF": "avif"}
+
+
+class Variant(NamedTuple):
+    name: str
+    data: bytes
+    extension: str
+
+
+def resolve_format(fmt: str) -> str:
+    """`fmt` if this Pillow build can encode it; AVIF falls back to WEBP when no encoder is present."""
+    Image.init()
+    if fmt in Image.SAVE:
+        return fmt
+    if fmt == "AVIF":
+        return "WEBP"
+    raise ValueError(f"Unsupported output format: {fmt}")
+
+
+def to_output_mode(img: Image.Image, fmt: str) -> Image.Image:
+    if fmt == "JPEG":
+        return to_jpeg_mode(img)
+    # WebP and AVIF keep alpha
+    if img.mode in ("RGB", "RGBA"):
+        return img
+    if img.mode in ("P", "LA", "PA"):
+        return img.convert("RGBA")
+    return img.convert("RGB")
+
+
+def encode(img: Image.Image, fmt: str, quality: int, options: EncodeOptions, metadata: Optional[Dict] = None) -> bytes:
+    params = {"quality": quality}
+    if fmt == "JPEG":
+        params.update(progressive=options.progressive, optimize=options.optimize)
+    if metadata:
+        params.update(metadata)
+    buffer = BytesIO()
+    to_output_mode(img, fmt).save(buffer, format=fmt, **params)
+    return buffer.getvalue()
+
+
+def fit(size: Tuple[int, int], longest_edge: int) -> Tuple[int, int]:
+    """Scale `size` so its longest edge is at most `longest_edge`, never upscaling."""
+    width, height = size
+    ratio = min(1.0, longest_edge / max(width, height))
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def render_variants(content: bytes, sizes: List[int], fmt: str, quality: int, strip_metadata: bool,
+                    options: EncodeOptions, reducing_gap: float = 3.0) -> List[Variant]:
+    """
+    Decode `content` once and produce one encoded variant per longest-edge size.
+
+    The decoder is drafted for the largest size; each smaller variant is resized from
+    the previous (larger) intermediate rather than from the source. Variants are
+    returned largest first and named by their size.
+    """
+    fmt = resolve_format(fmt)
+    img = Image.open(BytesIO(content))
+    exif = img.getexif()
+    orientation = exif.get(ORIENTATION_TAG, 1)
+    metadata = None
+    if not strip_metadata:
+        exif[ORIENTATION_TAG] = 1  # pixels are rotated upright below
+        metadata = {"exif": exif.tobytes()}
+        if img.info.get("icc_profile"):
+            metadata["icc_profile"] = img.info["icc_profile"]
+
+    source_size = img.size
+    with TRANSFORM_SECONDS.labels("decode").time():
+        current = draft(img, fit(source_size, max(sizes)))
+        current.load()
+    variants = []
+    for size in sorted(sizes, reverse=True):
+        target = fit(source_size, size)
+        with TRANSFORM_SECONDS.labels("resize").time():
+            if current.size != target:
+                current = current.resize(target, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+            upright = orient(current, orientation)
+        with TRANSFORM_SECONDS.labels("encode").time():
+            data = encode(upright, fmt, quality, options, metadata)
+        variants.append(Variant(str(size), data, FORMAT_EXTENSIONS[fmt]))
+    return variants
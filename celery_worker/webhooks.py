@@ -0,0 +1,230 @@
+import gzip
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from app.config import Logger, settings
+from app.metrics import WEBHOOK_SECONDS
+from app.model import DeliveryKind, DeliveryStatus, Request, WebhookDelivery
+from celery_worker.export import CONTENT_TYPES, export_chunks, export_filename, iter_result_rows, multipart_stream
+
+logger = Logger.get_logger(__name__)
+
+# Set while a deliver_webhooks run is scheduled, so completions close together share it
+KICK_KEY = "webhooks:kick"
+
+
+class PermanentDeliveryError(Exception):
+    """The receiver rejected the call in a way retrying cannot fix (4xx other than 408/429)."""
+
+
+_session_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+
+
+def get_webhook_session() -> requests.Session:
+    """
+    Per-process keep-alive session for webhook receivers, separate from the image download
+    pool so slow receivers cannot take connections from downloads. It does not retry by
+    itself: failed calls go back to the outbox with a backoff.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session_pid != os.getpid():
+            adapter = HTTPAdapter(
+                pool_connections=settings.http_pool_hosts,
+                pool_maxsize=settings.webhook_pool_maxsize,
+                max_retries=0,
+            )
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session_pid = os.getpid()
+    return _session
+
+
+def notice_payload(request: Request, results_url: Optional[str]) -> Dict:
+    return {
+        "request_id": request.request_id,
+        "status": "completed",
+        "total_images": request.total_images or 0,
+        "completed_images": request.completed_images,
+        "failed_images": request.failed_images,
+        "results_url": results_url,
+        "completed_at": datetime.now().isoformat(),
+    }
+
+
+def enqueue(db: Session, request: Request, results_url: Optional[str] = None) -> int:
+    """
+    Add the request's webhook calls to the outbox: the results file for EXPORT_TARGET=webhook
+    and a completion notice if the upload gave a callback URL. The caller commits, together
+    with the request's final status. Returns the number of calls added.
+    """
+    deliveries = []
+    if settings.export_target == "webhook" and settings.webhook_url:
+        deliveries.append(WebhookDelivery(request_id=request.request_id, kind=DeliveryKind.results, url=settings.webhook_url))
+    if request.callback_url:
+        deliveries.append(WebhookDelivery(
+            request_id=request.request_id, kind=DeliveryKind.notice, url=request.callback_url,
+            payload=notice_payload(request, results_url),
+        ))
+    for delivery in deliveries:
+        delivery.status = DeliveryStatus.pending
+        db.add(delivery)
+    return len(deliveries)
+
+
+def backoff(attempts: int) -> float:
+    """Seconds before the next try after `attempts` failed ones: jittered exponential backoff."""
+    ceiling = min(settings.webhook_retry_backoff * 2 ** max(0, attempts - 1), settings.webhook_retry_backoff_max)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def claim_due(db: Session, limit: int) -> List:
+    """
+    Claim up to `limit` due deliveries: count the attempt and push them out by WEBHOOK_LEASE,
+    so concurrent drainers skip them and they come due again if this worker dies.
+    """
+    due = (
+        select(WebhookDelivery.delivery_id)
+        .where(WebhookDelivery.status == DeliveryStatus.pending, WebhookDelivery.next_attempt_at <= func.now())
+        .order_by(WebhookDelivery.next_attempt_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    rows = db.execute(
+        update(WebhookDelivery)
+        .where(WebhookDelivery.delivery_id.in_(due.scalar_subquery()))
+        .values(
+            attempts=WebhookDelivery.attempts + 1,
+            next_attempt_at=func.now() + timedelta(seconds=settings.webhook_lease),
+        )
+        .returning(
+            WebhookDelivery.delivery_id, WebhookDelivery.request_id, WebhookDelivery.kind,
+            WebhookDelivery.url, WebhookDelivery.payload, WebhookDelivery.attempts,
+        )
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return rows
+
+
+def record_outcome(db: Session, deliveries: List, error: Optional[BaseException]):
+    """Mark `deliveries` delivered, or schedule their next try (dead-lettered once out of attempts)."""
+    ids = [delivery.delivery_id for delivery in deliveries]
+    if error is None:
+        db.execute(
+            update(WebhookDelivery).where(WebhookDelivery.delivery_id.in_(ids))
+            .values(status=DeliveryStatus.delivered, delivered_at=func.now(), last_error=None)
+            .execution_options(synchronize_session=False)
+        )
+    else:
+        for delivery in deliveries:
+            dead = isinstance(error, PermanentDeliveryError) or delivery.attempts >= settings.webhook_max_attempts
+            values = {"last_error": str(error)[:2000]}
+            if dead:
+                values["status"] = DeliveryStatus.dead
+                logger.error(f"Webhook {delivery.delivery_id} to {delivery.url} for request {delivery.request_id} "
+                             f"dead-lettered after {delivery.attempts} attempts: {error}")
+            else:
+                values["next_attempt_at"] = func.now() + timedelta(seconds=backoff(delivery.attempts))
+            db.execute(
+                update(WebhookDelivery).where(WebhookDelivery.delivery_id == delivery.delivery_id)
+                .values(**values).execution_options(synchronize_session=False)
+            )
+    db.commit()
+
+
+def _post(url: str, **kwargs) -> requests.Response:
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        response = get_webhook_session().post(
+            url, timeout=(settings.webhook_connect_timeout, settings.webhook_read_timeout), **kwargs
+        )
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise PermanentDeliveryError(f"{url} answered {response.status_code}")
+        response.raise_for_status()
+        outcome = "success"
+        return response
+    finally:
+        WEBHOOK_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+
+def post_results(db: Session, delivery) -> bool:
+    """
+    Stream the request's results file to the delivery's URL as multipart/form-data with
+    chunked transfer encoding, straight from a server-side cursor. False if there is nothing to send.
+    """
+    fmt, gzip_export = settings.export_format, settings.export_gzip
+    rows = iter_result_rows(db, delivery.request_id, settings.export_batch_size)
+    first = next(rows, None)
+    if first is None:
+        logger.warning(f"No data found for request_id: {delivery.request_id}")
+        return False
+    content_type = "application/gzip" if gzip_export else CONTENT_TYPES[fmt]
+    chunks = export_chunks(itertools.chain([first], rows), fmt, gzip_export, settings.export_batch_size)
+    multipart_type, body = multipart_stream(
+        {'request_id': delivery.request_id}, 'file', export_filename(fmt, gzip_export), content_type, chunks
+    )
+    _post(delivery.url, data=body, headers={'Content-Type': multipart_type})
+    return True
+
+
+def post_notices(url: str, deliveries: List):
+    """Send several completion notices for one receiver as a single JSON call."""
+    body = json.dumps({
+        "notifications": [{"delivery_id": delivery.delivery_id, **delivery.payload} for delivery in deliveries]
+    }).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if settings.webhook_gzip:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    _post(url, data=body, headers=headers)
+
+
+def deliver_due(db: Session) -> Tuple[int, int]:
+    """
+    Drain due deliveries in claims of WEBHOOK_BATCH_SIZE until none are left. Results
+    files go one per call; notices are grouped per URL. Returns (delivered, failed) calls.
+    """
+    delivered = failed = 0
+    while True:
+        claimed = claim_due(db, settings.webhook_batch_size)
+        if not claimed:
+            return delivered, failed
+        batches: Dict[str, List] = {}
+        for delivery in claimed:
+            if delivery.kind == DeliveryKind.results:
+                batches[f"results:{delivery.delivery_id}"] = [delivery]
+            else:
+                batches.setdefault(f"notice:{delivery.url}", []).append(delivery)
+        for deliveries in batches.values():
+            error = None
+            try:
+                if deliveries[0].kind == DeliveryKind.results:
+                    if post_results(db, deliveries[0]):
+                        logger.info(f"Results for request_id {deliveries[0].request_id} delivered to {deliveries[0].url}")
+                else:
+                    post_notices(deliveries[0].url, deliveries)
+            except Exception as e:
+                db.rollback()
+                logger.warning(f"Webhook to {deliveries[0].url} failed ({len(deliveries)} calls): {e}")
+                error = e
+            record_outcome(db, deliveries, error)
+            if error is None:
+                delivered += len(deliveries)
+            else:
+                failed += len(deliveries)
@@ -1,10 +1,237 @@
+import os
+import time
+
 from celery import Celery
-from app.config import settings
+from celery.schedules import crontab
+from celery.signals import (
+    before_task_publish, task_failure, task_postrun, task_prerun, worker_init, worker_process_init, worker_process_shutdown
+)
+from app.config import Logger, settings
+
+# Queues of the two-stage pipeline (PIPELINE_MODE=staged): downloads run on an I/O pool
+# (gevent/eventlet, high concurrency), transforms on a prefork pool sized to the cores
+FETCH_QUEUE = "image_fetch"
+TRANSFORM_QUEUE = "image_transform"
+# Outbox delivery to customer webhooks, on its own I/O-pool worker so no image worker waits on a receiver
+WEBHOOK_QUEUE = "webhooks"
+
+REDIS_URL = f"redis://{settings.redis_host}:{settings.redis_port}/{settings.redis_db}"
 
 celery_app = Celery(
     "task-worker",
-    broker=f"redis://127.0.0.1:6379/{settings.redis_db}",
-    backend=f"redis://127.0.0.1:6379/{settings.redis_db}",
+    broker=settings.celery_broker_url or REDIS_URL,
+    backend=settings.celery_result_backend or REDIS_URL,
     include=["celery_worker.task"],
     broker_connection_retry_on_startup=True,
 )
+
+# msgpack bodies; JSON is still accepted so messages published before a switch are consumed.
+# Tasks carrying image lists set `compression=BULK_COMPRESSION`; the rest are too small to gain from it
+celery_app.conf.task_serializer = settings.celery_serializer
+celery_app.conf.result_serializer = settings.celery_serializer
+celery_app.conf.accept_content = ["msgpack", "json"]
+BULK_COMPRESSION = None if settings.celery_bulk_compression == "none" else settings.celery_bulk_compression
+celery_app.conf.broker_pool_limit = settings.celery_broker_pool_limit
+celery_app.conf.redis_max_connections = settings.celery_backend_max_connections
+celery_app.conf.result_expires = settings.celery_result_expires
+
+# Queues of the tasks the API publishes by name (it does not import celery_worker.task);
+# they match the `queue` each task is declared with
+celery_app.conf.task_routes = {
+    "process_product": {"queue": "image_process"},
+    "process_image_chunk": {"queue": "image_process"},
+    "finalize_request": {"queue": "image_process"},
+    "await_request_completion": {"queue": "image_process"},
+    "fetch_images": {"queue": FETCH_QUEUE},
+    "resume_request": {"queue": "slow"},
+    "simulate_long_task_for_a_while": {"queue": "slow"},
+}
+
+# Priorities 0 (first) to 9 on the Redis broker, set per upload batch by app.admission.fair_priority.
+# One reserved message per process keeps a flood from one request out of idle workers' buffers,
+# and the CPU-aware autoscaler (`--autoscale=MAX,MIN`) sizes the pool from observed CPU vs I/O time.
+celery_app.conf.broker_transport_options = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
+    # Unacknowledged messages (running, or held for a countdown) go back to the queue after this
+    "visibility_timeout": settings.broker_visibility_timeout,
+}
+celery_app.conf.worker_prefetch_multiplier = settings.worker_prefetch_multiplier
+celery_app.conf.worker_autoscaler = "celery_worker.autoscale:CpuAwareAutoscaler"
+
+# Acknowledge after the task ran, so the messages of a worker node that dies mid-task are delivered
+# again; tasks are idempotent (rows are keyed by request, serial and URL, finished images skipped).
+# A pool child killed by its task (e.g. out of memory on one image) still acks, so a poison message
+# cannot loop: its images stay 'processing' until the sweeper requeues them, within IMAGE_MAX_ATTEMPTS
+celery_app.conf.task_acks_late = True
+celery_app.conf.task_reject_on_worker_lost = False
+
+celery_app.conf.beat_schedule = {
+    "maintain-partitions": {
+        "task": "maintain_partitions",
+        "schedule": crontab(minute=0, hour=settings.maintenance_hour),
+        "options": {"queue": "slow"},
+    },
+    "sweep-stuck-images": {
+        "task": "sweep_stuck_images",
+        "schedule": settings.sweep_interval,
+        "options": {"queue": "slow"},
+    },
+    "drain-webhook-outbox": {
+        "task": "deliver_webhooks",
+        "schedule": settings.webhook_drain_interval,
+        "options": {"queue": WEBHOOK_QUEUE, "priority": 9},
+    },
+    "apply-retention": {
+        "task": "apply_retention",
+        "schedule": crontab(minute=30, hour=settings.maintenance_hour),
+        "options": {"queue": "slow"},
+    },
+}
+
+
+@worker_process_init.connect
+def init_db_pool(**kwargs):
+    """Create this child's shared engine once, right after the prefork pool forks it."""
+    from app.database import init_worker_engine
+
+    queues = list(celery_app.amqp.queues.consume_from or ())
+    init_worker_engine(queues)
+
+
+@worker_process_shutdown.connect
+def close_db_pool(**kwargs):
+    """Release pooled connections before the child exits."""
+    from app.database import dispose_worker_engine
+
+    dispose_worker_engine()
+
+
+@worker_process_shutdown.connect
+def release_metrics(pid=None, **kwargs):
+    """Drop the exiting child's live metric files in multiprocess mode."""
+    from app.metrics import mark_process_dead
+
+    mark_process_dead(pid or os.getpid())
+
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    """
+    Serve /metrics from the worker's main process on WORKER_METRICS_PORT. With
+    PROMETHEUS_MULTIPROC_DIR set it merges the samples of every pool process.
+    """
+    if not settings.worker_metrics_port:
+        return
+    from prometheus_client import start_http_server
+    from app.metrics import scrape_registry
+
+    start_http_server(settings.worker_metrics_port, registry=scrape_registry())
+
+
+# Task run time by task name and final state; start marks are kept per task id in this process
+_task_started = {}
+
+
+@task_prerun.connect
+def mark_task_start(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def observe_task_time(task_id=None, task=None, state=None, **kwargs):
+    from app.metrics import TASK_SECONDS
+
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_SECONDS.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+
+# Log correlation: the publishing request's id travels in a message header and is bound,
+# with the task's own id and name, for as long as the task runs in this process
+LOG_REQUEST_HEADER = "log_request_id"
+_log_context = {}
+
+
+@before_task_publish.connect
+def attach_log_request_id(headers=None, **kwargs):
+    from app.log import request_id_var
+
+    request_id = request_id_var.get()
+    if request_id and headers is not None:
+        headers.setdefault(LOG_REQUEST_HEADER, request_id)
+
+
+@task_prerun.connect
+def bind_log_context(task_id=None, task=None, **kwargs):
+    from app.log import request_id_var, task_var
+
+    request_id = getattr(task.request, LOG_REQUEST_HEADER, None) or request_id_var.get()
+    _log_context[task_id] = (
+        request_id_var.set(request_id), task_var.set({"id": task_id, "name": task.name})
+    )
+
+
+@task_postrun.connect
+def unbind_log_context(task_id=None, **kwargs):
+    from app.log import request_id_var, task_var
+
+    tokens = _log_context.pop(task_id, None)
+    if tokens is not None:
+        request_id_var.reset(tokens[0])
+        task_var.reset(tokens[1])
+
+
+# On-demand profiling: a profiled upload marks the messages it publishes, and so on down the
+# pipeline; marked runs of PROFILE_TASKS are sampled and stored under the request id
+_profiles = {}
+
+
+@before_task_publish.connect
+def attach_profile_flag(headers=None, **kwargs):
+    from app.profiling import PROFILE_MESSAGE_HEADER, profile_requested
+
+    if profile_requested.get() and headers is not None:
+        headers.setdefault(PROFILE_MESSAGE_HEADER, True)
+
+
+@task_prerun.connect
+def start_task_profile(task_id=None, task=None, **kwargs):
+    from app.log import request_id_var
+    from app.profiling import PROFILE_MESSAGE_HEADER, ProfileRun, profile_requested
+
+    if not (getattr(task.request, PROFILE_MESSAGE_HEADER, False) or profile_requested.get()):
+        return
+    token = profile_requested.set(True)
+    run = None
+    # The request id is bound by bind_log_context, which runs first; it is unbound before postrun here
+    request_id = request_id_var.get()
+    if request_id and task.name in settings.profile_tasks:
+        run = ProfileRun(task.name).start()
+    _profiles[task_id] = (token, run, request_id)
+
+
+@task_postrun.connect
+def save_task_profile(task_id=None, **kwargs):
+    from redis.exceptions import RedisError
+    from app.profiling import profile_requested
+
+    profile = _profiles.pop(task_id, None)
+    if profile is None:
+        return
+    token, run, request_id = profile
+    profile_requested.reset(token)
+    if run is not None:
+        run.stop()
+        try:
+            run.save(request_id, task_id)
+        except RedisError as e:
+            Logger.get_logger(__name__).warning(f"Could not store the profile of task {task_id}: {e}")
+
+
+@task_failure.connect
+def count_task_failure(sender=None, **kwargs):
+    from app.metrics import TASK_FAILURES
+
+    TASK_FAILURES.labels(sender.name).inc()
@@ -1,40 +1,62 @@
-from fastapi import FastAPI, File, HTTPException, UploadFile
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, HTTPException, Response, UploadFile
+from app.concurrency import run_blocking, shutdown_executor
+from app.config import Logger
+from app.metrics import render as render_metrics
 from app.router import router
-from app.database import Base, engine
-from app.model import *
-app= FastAPI(title= "image processing app")
+from app.database import dispose_async_engine
+from app.events import close_hub
+from app.storage import get_storage
+
+logger = Logger.get_logger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    yield
+    await close_hub()
+    await dispose_async_engine()
+    shutdown_executor()
+
+
+app= FastAPI(title= "image processing app", lifespan=lifespan)
 app.include_router(router, prefix= "/v1")
 
-Base.metadata.create_all(engine)
+# The schema is managed by Alembic: run `alembic upgrade head` before starting the app
+
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    """Readiness probe: the app is imported and serving. Touches neither the database nor the broker."""
+    return {"status": "ready"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape: API metrics (all uvicorn workers in multiprocess mode), queue depth and images in flight."""
+    body, content_type = await run_blocking(render_metrics, True)
+    return Response(content=body, media_type=content_type)
 
 
-from pathlib import Path
-import shutil
+from pathlib import PurePath
 
-UPLOAD_DIRECTORY = Path("/files")
-UPLOAD_DIRECTORY.mkdir(parents=True, exist_ok=True)
 
 @app.post("/webhook")
 async def receive_file(file: UploadFile = File(...)):
     try:
-        # Print the file details
-        print(f"Received file: {file.filename}")
+        logger.info(f"Received file: {file.filename}")
         
-        file_location = UPLOAD_DIRECTORY / file.filename
+        key = f"webhooks/{PurePath(file.filename).name}"
         
-        # Print the file location where it will be saved
-        print(f"Saving file to: {file_location}")
+        logger.info(f"Saving file to: {key}")
         
-        # Save the uploaded file to the specified directory
-        with file_location.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Stream the upload into the storage backend in chunks, off the event loop
+        location = await run_blocking(get_storage().put_stream, key, file.file, file.content_type)
         
-        # Print success message
-        print(f"File successfully saved as: {file.filename}")
+        logger.info(f"File successfully saved as: {location}")
         
-        return {"filename": file.filename, "status": "success"}
+        return {"filename": file.filename, "location": location, "status": "success"}
     
     except Exception as e:
-        # Print the error details
-        print(f"Error saving file: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error saving file: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error saving file: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error saving file: {str(e)}")
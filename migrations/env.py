@@ -0,0 +1,55 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+from app.config import settings
+from app.database import Base
+from app.partitions import is_partition_name
+import app.model  # noqa: F401  registers the tables on Base.metadata
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+
+def include_name(name, type_, parent_names):
+    """Partitions are created at runtime and are not part of the ORM metadata."""
+    return not (type_ == "table" and is_partition_name(name))
+
+
+def include_object(object_, name, type_, reflected, compare_to):
+    """PostgreSQL adds one internal foreign key per referenced partition; only the parent's is modelled."""
+    return not (type_ == "foreign_key_constraint" and is_partition_name(object_.referred_table.name))
+
+
+def run_migrations_offline():
+    """Emit SQL to stdout instead of running it (`alembic upgrade head --sql`)."""
+    context.configure(
+        url=str(settings.database_url),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    engine = create_engine(str(settings.database_url), poolclass=pool.NullPool)
+    with engine.connect() as connection:
+        context.configure(
+            connection=connection, target_metadata=target_metadata, compare_type=True,
+            include_name=include_name, include_object=include_object,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+    engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,53 @@
+"""initial schema, as previously created by Base.metadata.create_all
+
+Databases created before migrations were introduced already have these tables:
+mark them with `alembic stamp 0001` and then run `alembic upgrade head`.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+STATUSES = ('pending', 'processing', 'completed', 'failed')
+
+
+def upgrade():
+    op.create_table(
+        'requests',
+        sa.Column('request_id', sa.String(), primary_key=True),
+        sa.Column('status', sa.Enum(*STATUSES, name='requeststatus')),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('updated_at', sa.DateTime()),
+        sa.Column('total_images', sa.Integer()),
+    )
+    op.create_table(
+        'products',
+        sa.Column('product_id', sa.String(), primary_key=True),
+        sa.Column('request_id', sa.String(), sa.ForeignKey('requests.request_id', name='products_request_id_fkey')),
+        sa.Column('serial_number', sa.Integer()),
+        sa.Column('product_name', sa.String()),
+    )
+    op.create_table(
+        'image_urls',
+        sa.Column('image_id', sa.String(), primary_key=True),
+        sa.Column('product_id', sa.String(), sa.ForeignKey('products.product_id', name='image_urls_product_id_fkey')),
+        sa.Column('input_image_url', sa.Text()),
+        sa.Column('output_image_url', sa.Text(), nullable=True),
+        sa.Column('status', sa.Enum(*STATUSES, name='imagestatus')),
+    )
+
+
+def downgrade():
+    op.drop_table('image_urls')
+    op.drop_table('products')
+    op.drop_table('requests')
+    sa.Enum(name='imagestatus').drop(op.get_bind(), checkfirst=True)
+    sa.Enum(name='requeststatus').drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,29 @@
+"""transform spec, output variants and progress counter columns
+
+IF NOT EXISTS keeps this safe on databases where the columns were added by hand.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE requests ADD COLUMN IF NOT EXISTS transform JSON")
+    op.execute("ALTER TABLE requests ADD COLUMN IF NOT EXISTS completed_images INTEGER NOT NULL DEFAULT 0")
+    op.execute("ALTER TABLE requests ADD COLUMN IF NOT EXISTS failed_images INTEGER NOT NULL DEFAULT 0")
+    op.execute("ALTER TABLE image_urls ADD COLUMN IF NOT EXISTS output_variants JSON")
+
+
+def downgrade():
+    op.drop_column('image_urls', 'output_variants')
+    op.drop_column('requests', 'failed_images')
+    op.drop_column('requests', 'completed_images')
+    op.drop_column('requests', 'transform')
@@ -0,0 +1,62 @@
+"""native UUID keys, image_urls.request_id and indexes for the status/export queries
+
+Converting the key columns rewrites all three tables under an exclusive lock;
+on large installations run it in a maintenance window.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+KEY_COLUMNS = [
+    ('requests', 'request_id'),
+    ('products', 'product_id'),
+    ('products', 'request_id'),
+    ('image_urls', 'image_id'),
+    ('image_urls', 'product_id'),
+]
+
+
+def upgrade():
+    # Foreign keys must be dropped while both sides change type
+    op.drop_constraint('image_urls_product_id_fkey', 'image_urls', type_='foreignkey')
+    op.drop_constraint('products_request_id_fkey', 'products', type_='foreignkey')
+    for table, column in KEY_COLUMNS:
+        op.alter_column(table, column, type_=postgresql.UUID(), postgresql_using=f'{column}::uuid')
+    op.create_foreign_key('products_request_id_fkey', 'products', 'requests', ['request_id'], ['request_id'])
+    op.create_foreign_key('image_urls_product_id_fkey', 'image_urls', 'products', ['product_id'], ['product_id'])
+
+    op.add_column('image_urls', sa.Column('request_id', postgresql.UUID(), nullable=True))
+    op.execute(
+        "UPDATE image_urls SET request_id = products.request_id "
+        "FROM products WHERE products.product_id = image_urls.product_id"
+    )
+    op.create_foreign_key('image_urls_request_id_fkey', 'image_urls', 'requests', ['request_id'], ['request_id'])
+
+    op.create_index('ix_products_request_id', 'products', ['request_id'])
+    op.create_index('ix_image_urls_product_id_status', 'image_urls', ['product_id', 'status'])
+    op.create_index('ix_image_urls_request_id_status', 'image_urls', ['request_id', 'status'])
+
+
+def downgrade():
+    op.drop_index('ix_image_urls_request_id_status', table_name='image_urls')
+    op.drop_index('ix_image_urls_product_id_status', table_name='image_urls')
+    op.drop_index('ix_products_request_id', table_name='products')
+    op.drop_constraint('image_urls_request_id_fkey', 'image_urls', type_='foreignkey')
+    op.drop_column('image_urls', 'request_id')
+
+    op.drop_constraint('image_urls_product_id_fkey', 'image_urls', type_='foreignkey')
+    op.drop_constraint('products_request_id_fkey', 'products', type_='foreignkey')
+    for table, column in KEY_COLUMNS:
+        op.alter_column(table, column, type_=sa.String(), postgresql_using=f'{column}::text')
+    op.create_foreign_key('products_request_id_fkey', 'products', 'requests', ['request_id'], ['request_id'])
+    op.create_foreign_key('image_urls_product_id_fkey', 'image_urls', 'products', ['product_id'], ['product_id'])
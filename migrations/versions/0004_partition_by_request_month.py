@@ -0,0 +1,155 @@
+"""partition products and image_urls by request month; request timestamps and archive marker
+
+products and image_urls are rebuilt as tables range-partitioned on the owning
+request's created_at (monthly partitions plus a DEFAULT one), so retention can drop
+whole months. Existing rows are copied into the new tables. Further partitions are
+created ahead of time by the maintain_partitions beat task.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+PREMADE_MONTHS = 3
+
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _rename_out(table, indexes, foreign_keys):
+    for name in foreign_keys:
+        op.drop_constraint(name, table, type_='foreignkey')
+    for name in indexes:
+        op.drop_index(name, table_name=table)
+    op.rename_table(table, f'{table}_unpartitioned')
+    op.execute(f'ALTER INDEX {table}_pkey RENAME TO {table}_unpartitioned_pkey')
+
+
+def upgrade():
+    op.execute("UPDATE requests SET created_at = now() WHERE created_at IS NULL")
+    op.alter_column('requests', 'created_at', nullable=False, server_default=sa.func.now())
+    op.add_column('requests', sa.Column('archived_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_requests_created_at', 'requests', ['created_at'])
+
+    _rename_out('image_urls', ['ix_image_urls_product_id_status', 'ix_image_urls_request_id_status'],
+                ['image_urls_product_id_fkey', 'image_urls_request_id_fkey'])
+    _rename_out('products', ['ix_products_request_id'], ['products_request_id_fkey'])
+
+    op.create_table(
+        'products',
+        sa.Column('product_id', postgresql.UUID(), nullable=False),
+        sa.Column('request_id', postgresql.UUID(), sa.ForeignKey('requests.request_id', name='products_request_id_fkey')),
+        sa.Column('request_created_at', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+        sa.Column('serial_number', sa.Integer()),
+        sa.Column('product_name', sa.String()),
+        sa.PrimaryKeyConstraint('product_id', 'request_created_at', name='products_pkey'),
+        postgresql_partition_by='RANGE (request_created_at)',
+    )
+    op.create_table(
+        'image_urls',
+        sa.Column('image_id', postgresql.UUID(), nullable=False),
+        sa.Column('product_id', postgresql.UUID()),
+        sa.Column('request_id', postgresql.UUID(), sa.ForeignKey('requests.request_id', name='image_urls_request_id_fkey')),
+        sa.Column('request_created_at', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+        sa.Column('input_image_url', sa.Text()),
+        sa.Column('output_image_url', sa.Text(), nullable=True),
+        sa.Column('output_variants', sa.JSON(), nullable=True),
+        sa.Column('status', postgresql.ENUM(name='imagestatus', create_type=False)),
+        sa.PrimaryKeyConstraint('image_id', 'request_created_at', name='image_urls_pkey'),
+        sa.ForeignKeyConstraint(
+            ['product_id', 'request_created_at'], ['products.product_id', 'products.request_created_at'],
+            name='image_urls_product_id_fkey'
+        ),
+        postgresql_partition_by='RANGE (request_created_at)',
+    )
+
+    oldest = op.get_bind().execute(sa.text("SELECT min(created_at) FROM requests")).scalar()
+    today = date.today().replace(day=1)
+    month = date(oldest.year, oldest.month, 1) if oldest else today
+    while month <= _add_months(today, PREMADE_MONTHS):
+        suffix = f'y{month.year}m{month.month:02d}'
+        bounds = f"FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+        op.execute(f'CREATE TABLE products_{suffix} PARTITION OF products FOR VALUES {bounds}')
+        op.execute(f'CREATE TABLE image_urls_{suffix} PARTITION OF image_urls FOR VALUES {bounds}')
+        month = _add_months(month, 1)
+    op.execute('CREATE TABLE products_default PARTITION OF products DEFAULT')
+    op.execute('CREATE TABLE image_urls_default PARTITION OF image_urls DEFAULT')
+
+    op.execute(
+        "INSERT INTO products (product_id, request_id, request_created_at, serial_number, product_name) "
+        "SELECT p.product_id, p.request_id, COALESCE(r.created_at, now()), p.serial_number, p.product_name "
+        "FROM products_unpartitioned p LEFT JOIN requests r ON r.request_id = p.request_id"
+    )
+    op.execute(
+        "INSERT INTO image_urls (image_id, product_id, request_id, request_created_at, input_image_url, "
+        "output_image_url, output_variants, status) "
+        "SELECT i.image_id, i.product_id, i.request_id, p.request_created_at, i.input_image_url, "
+        "i.output_image_url, i.output_variants, i.status "
+        "FROM image_urls_unpartitioned i JOIN products p ON p.product_id = i.product_id"
+    )
+    op.drop_table('image_urls_unpartitioned')
+    op.drop_table('products_unpartitioned')
+
+    # Indexes on the parent are created on every partition, present and future
+    op.create_index('ix_products_request_id', 'products', ['request_id'])
+    op.create_index('ix_image_urls_product_id_status', 'image_urls', ['product_id', 'status'])
+    op.create_index('ix_image_urls_request_id_status', 'image_urls', ['request_id', 'status'])
+
+
+def downgrade():
+    op.execute('ALTER TABLE image_urls RENAME TO image_urls_partitioned')
+    op.execute('ALTER TABLE products RENAME TO products_partitioned')
+    for name in ('ix_image_urls_product_id_status', 'ix_image_urls_request_id_status', 'ix_products_request_id'):
+        op.execute(f'DROP INDEX {name}')
+    op.execute('ALTER TABLE image_urls_partitioned DROP CONSTRAINT image_urls_product_id_fkey')
+    op.execute('ALTER TABLE image_urls_partitioned DROP CONSTRAINT image_urls_request_id_fkey')
+    op.execute('ALTER TABLE products_partitioned DROP CONSTRAINT products_request_id_fkey')
+    op.execute('ALTER TABLE image_urls_partitioned RENAME CONSTRAINT image_urls_pkey TO image_urls_partitioned_pkey')
+    op.execute('ALTER TABLE products_partitioned RENAME CONSTRAINT products_pkey TO products_partitioned_pkey')
+
+    op.create_table(
+        'products',
+        sa.Column('product_id', postgresql.UUID(), primary_key=True),
+        sa.Column('request_id', postgresql.UUID(), sa.ForeignKey('requests.request_id', name='products_request_id_fkey')),
+        sa.Column('serial_number', sa.Integer()),
+        sa.Column('product_name', sa.String()),
+    )
+    op.create_table(
+        'image_urls',
+        sa.Column('image_id', postgresql.UUID(), primary_key=True),
+        sa.Column('product_id', postgresql.UUID(), sa.ForeignKey('products.product_id', name='image_urls_product_id_fkey')),
+        sa.Column('input_image_url', sa.Text()),
+        sa.Column('output_image_url', sa.Text(), nullable=True),
+        sa.Column('status', postgresql.ENUM(name='imagestatus', create_type=False)),
+        sa.Column('output_variants', sa.JSON(), nullable=True),
+        sa.Column('request_id', postgresql.UUID(), sa.ForeignKey('requests.request_id', name='image_urls_request_id_fkey')),
+    )
+    op.execute(
+        "INSERT INTO products SELECT product_id, request_id, serial_number, product_name FROM products_partitioned"
+    )
+    op.execute(
+        "INSERT INTO image_urls SELECT image_id, product_id, input_image_url, output_image_url, status, "
+        "output_variants, request_id FROM image_urls_partitioned"
+    )
+    op.execute('DROP TABLE image_urls_partitioned')
+    op.execute('DROP TABLE products_partitioned')
+    op.create_index('ix_products_request_id', 'products', ['request_id'])
+    op.create_index('ix_image_urls_product_id_status', 'image_urls', ['product_id', 'status'])
+    op.create_index('ix_image_urls_request_id_status', 'image_urls', ['request_id', 'status'])
+
+    op.drop_index('ix_requests_created_at', table_name='requests')
+    op.drop_column('requests', 'archived_at')
+    op.alter_column('requests', 'created_at', nullable=True, server_default=None)
@@ -0,0 +1,30 @@
+"""image attempt counter and status timestamp for retries and the stuck-image sweeper
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('image_urls', sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('image_urls', sa.Column('updated_at', sa.DateTime(), nullable=False, server_default=sa.func.now()))
+    # Only rows in flight are indexed, so the sweeper's scan stays small however many rows are finished
+    op.create_index(
+        'ix_image_urls_processing_updated_at', 'image_urls', ['updated_at'],
+        postgresql_where=sa.text("status = 'processing'")
+    )
+
+
+def downgrade():
+    op.drop_index('ix_image_urls_processing_updated_at', table_name='image_urls')
+    op.drop_column('image_urls', 'updated_at')
+    op.drop_column('image_urls', 'attempts')
@@ -0,0 +1,45 @@
+"""webhook delivery outbox and per-request callback URL
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('requests', sa.Column('callback_url', sa.Text(), nullable=True))
+    op.create_table(
+        'webhook_deliveries',
+        sa.Column('delivery_id', sa.BigInteger(), primary_key=True, autoincrement=True),
+        sa.Column('request_id', postgresql.UUID(), nullable=False),
+        sa.Column('kind', sa.Enum('results', 'notice', name='deliverykind'), nullable=False),
+        sa.Column('url', sa.Text(), nullable=False),
+        sa.Column('payload', sa.JSON(), nullable=True),
+        sa.Column('status', sa.Enum('pending', 'delivered', 'dead', name='deliverystatus'), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('delivered_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index('ix_webhook_deliveries_request_id', 'webhook_deliveries', ['request_id'])
+    op.create_index(
+        'ix_webhook_deliveries_due', 'webhook_deliveries', ['next_attempt_at'],
+        postgresql_where=sa.text("status = 'pending'")
+    )
+
+
+def downgrade():
+    op.drop_table('webhook_deliveries')
+    op.execute('DROP TYPE deliverystatus')
+    op.execute('DROP TYPE deliverykind')
+    op.drop_column('requests', 'callback_url')
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+# Settings has required fields with no defaults; unit tests touch no database, broker or Redis server
+for name, value in {
+    "API_KEY": "test", "SECRET_KEY": "test",
+    "DB_DRIVER": "postgresql", "DB_HOST": "localhost", "DB_PORT": "5432",
+    "DB_USER": "test", "DB_PASSWORD": "test", "DB_NAME": "test",
+    "RABBITMQ_HOST": "localhost", "RABBITMQ_PORT": "5672", "RABBITMQ_USER": "test", "RABBITMQ_PASSWORD": "test",
+    "REDIS_HOST": "localhost", "REDIS_PORT": "6379", "REDIS_DB": "0",
+    "LOG_FILE": "",
+}.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """A fakeredis client installed as the process's Redis client."""
+    fakeredis = pytest.importorskip("fakeredis")
+    import app.redis_client as redis_client
+
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_client, "_client", client)
+    monkeypatch.setattr(redis_client, "_client_pid", os.getpid())
+    return client
+
+
+@pytest.fixture
+def db():
+    """A session on an in-memory SQLite database with the request, row and outbox tables."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    from app.model import ImageUrl, Product, Request, WebhookDelivery
+
+    # Range partitions and native UUIDs are PostgreSQL's; the queries under test do not depend on them
+    engine = create_engine("sqlite://")
+    for model in (Request, Product, ImageUrl, WebhookDelivery):
+        model.__table__.create(engine)
+    with Session(engine) as session:
+        yield session
@@ -0,0 +1,46 @@
+import pytest
+
+from app.admission import ACTIVE_KEY, admit, close, tenant_key, total_in_flight
+from app.config import settings
+from app.progress import add_finished, add_total, progress_key
+
+pytest.importorskip("lupa")
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(settings, "admission_max_inflight_per_tenant", 5)
+    monkeypatch.setattr(settings, "admission_max_inflight_total", 0)
+
+
+def test_admit_registers_until_the_tenant_limit(fake_redis):
+    assert admit("t", "r1") == (None, 0)
+    assert fake_redis.smembers(tenant_key("t")) == {b"r1"}
+    assert fake_redis.hget(progress_key("r1"), "open") == b"1"
+    add_total("r1", 5)
+
+    retry_after, pending = admit("t", "r2")
+    assert (retry_after, pending) == (settings.admission_retry_after, 5)
+    assert fake_redis.smembers(tenant_key("t")) == {b"r1"}
+    assert admit("other", "r3") == (None, 0)
+
+
+def test_drained_and_closed_requests_are_pruned(fake_redis):
+    admit("t", "r1")
+    add_total("r1", 5)
+    add_finished("r1", completed=5)
+    # Still open: the upload may dispatch more
+    assert admit("t", "r2") == (None, 0)
+    assert b"r1" in fake_redis.smembers(tenant_key("t"))
+
+    close("r1")
+    admit("t", "r3")
+    assert fake_redis.smembers(tenant_key("t")) == {b"r2", b"r3"}
+
+
+def test_total_in_flight_only_reads(fake_redis):
+    admit("t", "r1")
+    add_total("r1", 3)
+    fake_redis.sadd(ACTIVE_KEY, "expired")
+    assert total_in_flight() == 3
+    assert b"expired" in fake_redis.smembers(ACTIVE_KEY)
@@ -0,0 +1,66 @@
+from datetime import datetime
+
+from sqlalchemy import select
+
+from app.crud import ImageResultBuffer, bulk_insert_products, claim_images
+from app.model import ImageStatus, ImageUrl, Request
+from app.progress import add_total, get_progress, init_progress
+
+REQUEST_ID = "0123456789abcdef0123456789abcdef"
+CREATED_AT = datetime(2024, 6, 1)
+
+
+def insert(db, images):
+    product = {
+        "product_id": "fedcba9876543210fedcba9876543210", "request_id": REQUEST_ID, "request_created_at": CREATED_AT,
+        "serial_number": 1, "product_name": "p", "images": images,
+    }
+    rows = bulk_insert_products(db, [product])[product["product_id"]]
+    db.commit()
+    return rows
+
+
+def statuses(db):
+    return sorted(status.value for status in db.scalars(select(ImageUrl.status)))
+
+
+def test_redelivered_insert_returns_only_unfinished_images(db):
+    db.add(Request(request_id=REQUEST_ID, created_at=CREATED_AT, total_images=3))
+    db.commit()
+    first = insert(db, ["http://a/1.jpg", "http://a/2.jpg", "http://a/1.jpg"])
+    assert len({row["image_id"] for row in first}) == 3
+
+    with ImageResultBuffer(db) as results:
+        results.add(first[0]["image_id"], ImageStatus.completed, "/out/1.jpg")
+
+    again = insert(db, ["http://a/1.jpg", "http://a/2.jpg", "http://a/1.jpg"])
+    assert [row["image_id"] for row in again] == [row["image_id"] for row in first[1:]]
+    assert db.query(ImageUrl).count() == 3
+
+
+def test_result_buffer_counts_only_rows_it_moved(db, fake_redis):
+    db.add(Request(request_id=REQUEST_ID, created_at=CREATED_AT, total_images=3))
+    db.commit()
+    images = insert(db, ["http://a/1.jpg", "http://a/2.jpg", "http://a/3.jpg"])
+    init_progress(REQUEST_ID)
+    add_total(REQUEST_ID, 3)
+    assert claim_images(db, [image["image_id"] for image in images]) == {image["image_id"] for image in images}
+
+    with ImageResultBuffer(db, flush_size=2, request_id=REQUEST_ID) as results:
+        results.add(images[0]["image_id"], ImageStatus.completed, "/out/1.jpg")
+        results.add(images[1]["image_id"], ImageStatus.failed)
+        # A duplicate delivery of a finished image changes nothing
+        results.add(images[0]["image_id"], ImageStatus.failed)
+        assert results.flushed_ids == [images[0]["image_id"], images[1]["image_id"]]
+    assert statuses(db) == ["completed", "failed", "processing"]
+
+    request = db.get(Request, REQUEST_ID)
+    assert (request.completed_images, request.failed_images) == (1, 1)
+    progress = get_progress([REQUEST_ID])[REQUEST_ID]
+    assert (progress["completed"], progress["failed"]) == (1, 1)
+    assert not results.request_done
+
+    with ImageResultBuffer(db, request_id=REQUEST_ID) as results:
+        results.add(images[2]["image_id"], ImageStatus.completed, "/out/3.jpg")
+    db.refresh(request)
+    assert (request.completed_images, request.failed_images) == (2, 1)
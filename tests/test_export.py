@@ -0,0 +1,54 @@
+import csv
+import gzip
+import io
+import json
+from email.parser import BytesParser
+from email.policy import HTTP
+
+import pytest
+
+from celery_worker.export import EXPORT_COLUMNS, export_chunks, export_filename, multipart_stream
+
+ROWS = [
+    {
+        "Product ID": f"p{index}", "Serial Number": index, "Product Name": f"name, {index}",
+        "Input Image URLs": f"http://a/{index}.jpg", "Output Image URLs": f"/out/{index}.jpg",
+    }
+    for index in range(5)
+]
+
+
+def test_csv_is_streamed_per_batch():
+    chunks = list(export_chunks(iter(ROWS), "csv", batch_size=2))
+    assert len(chunks) == 3
+    rows = list(csv.DictReader(io.StringIO(b"".join(chunks).decode("utf-8"))))
+    assert [row["Product Name"] for row in rows] == [row["Product Name"] for row in ROWS]
+    assert list(rows[0]) == EXPORT_COLUMNS
+
+
+def test_jsonl_round_trips():
+    data = b"".join(export_chunks(iter(ROWS), "jsonl", batch_size=2))
+    assert [json.loads(line) for line in data.decode("utf-8").splitlines()] == ROWS
+
+
+def test_gzip_wraps_any_format():
+    plain = b"".join(export_chunks(iter(ROWS), "jsonl"))
+    assert gzip.decompress(b"".join(export_chunks(iter(ROWS), "jsonl", gzip=True))) == plain
+    assert export_filename("jsonl", True) == "results.jsonl.gz"
+
+
+def test_parquet_round_trips():
+    pq = pytest.importorskip("pyarrow.parquet")
+    data = b"".join(export_chunks(iter(ROWS), "parquet", batch_size=2))
+    table = pq.read_table(io.BytesIO(data))
+    assert table.num_rows == len(ROWS)
+    assert table.to_pylist() == ROWS
+
+
+def test_multipart_body_carries_fields_and_file():
+    content_type, body = multipart_stream({"request_id": "r1"}, "file", "results.csv", "text/csv", iter([b"a,b\r\n", b"1,2\r\n"]))
+    message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + b"".join(body))
+    parts = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+    assert parts["request_id"].get_content() == "r1"
+    assert parts["file"].get_filename() == "results.csv"
+    assert parts["file"].get_payload(decode=True) == b"a,b\r\n1,2\r\n"
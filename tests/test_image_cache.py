@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import app.storage as storage
+from app.config import settings
+from app.image_cache import BYTES_KEY, ENTRIES_KEY, LRU_KEY, ImageCache
+from celery_worker.pipeline import transform_stage
+from celery_worker.transform import Variant
+
+pytest.importorskip("lupa")
+
+
+def output_key(image_id, name, extension):
+    return f"outputs/{image_id}_{name}.{extension}"
+
+
+@pytest.fixture
+def cache(fake_redis, tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "_storage", storage.LocalStorage(str(tmp_path)))
+    monkeypatch.setattr(storage, "_storage_pid", os.getpid())
+    return ImageCache("t", output_key)
+
+
+def test_published_outputs_survive_eviction(cache, monkeypatch):
+    keys = cache.store_outputs("d1", [("small", b"x" * 10, "jpg")])
+    url = cache.publish({"image_id": "i1"}, keys)["small"]
+    assert open(url, "rb").read() == b"x" * 10
+
+    monkeypatch.setattr(settings, "image_cache_max_bytes", 0)
+    cache.evict()
+    assert not cache.storage.exists(keys["small"])
+    assert cache.lookup_content("d1") is None
+    assert open(url, "rb").read() == b"x" * 10
+
+
+def test_content_hit_is_published_per_image(cache):
+    keys = cache.store_outputs("d1", [("small", b"x" * 10, "jpg")])
+    assert cache.lookup_content("d1") == keys
+    first = cache.publish({"image_id": "i1"}, keys)["small"]
+    second = cache.publish({"image_id": "i2"}, keys)["small"]
+    assert first != second
+    assert open(second, "rb").read() == b"x" * 10
+
+
+def test_entry_is_accounted_once_and_fully_evicted(cache, fake_redis, monkeypatch):
+    cache.store_outputs("d1", [("small", b"x" * 10, "jpg")])
+    cache.store_outputs("d1", [("small", b"x" * 10, "jpg")])
+    assert int(fake_redis.get(BYTES_KEY)) == 10
+    assert fake_redis.zcard(LRU_KEY) == 1
+
+    monkeypatch.setattr(settings, "image_cache_max_bytes", 0)
+    cache.evict()
+    assert int(fake_redis.get(BYTES_KEY)) == 0
+    assert fake_redis.zcard(LRU_KEY) == 0
+    assert fake_redis.hlen(ENTRIES_KEY) == 0
+
+
+def test_publish_of_evicted_entry_is_a_miss(cache, monkeypatch):
+    keys = cache.store_outputs("d1", [("small", b"x" * 10, "jpg")])
+    monkeypatch.setattr(settings, "image_cache_max_bytes", 0)
+    cache.evict()
+    assert cache.publish({"image_id": "i1"}, keys) is None
+
+
+def test_transform_stage_retransforms_hit_evicted_before_publish(cache, monkeypatch):
+    keys = cache.store_outputs("d1", [("small", b"x" * 10, "jpg")])
+    # The entry is evicted between the lookup and the copy
+    monkeypatch.setattr(cache, "lookup_content", lambda digest: keys)
+    cache.storage.delete(keys["small"])
+    transformed = []
+
+    def transform(content):
+        transformed.append(content)
+        return [Variant("small", b"y" * 10, "jpg")]
+
+    image = {"image_id": "i1", "input_image_url": "http://example.com/a.jpg"}
+    outputs = transform_stage(image, b"source", {}, transform, None, cache)
+    assert transformed == [b"source"]
+    assert open(outputs["small"], "rb").read() == b"y" * 10
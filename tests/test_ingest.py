@@ -0,0 +1,105 @@
+import codecs
+import csv
+import io
+
+import pytest
+
+from app.ingest import CSVFormatError, RecordSplitter, parse_chunk
+
+
+def reader_rows(text):
+    return list(csv.reader(io.StringIO(text, newline="")))
+
+
+def split_records(text, final):
+    splitter = RecordSplitter()
+    return splitter.feed(text, final), splitter.pending
+
+
+def parse_in_chunks(data: bytes, size: int):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    splitter = RecordSplitter()
+    rows = []
+    for start in range(0, len(data), size):
+        rows.extend(parse_chunk(decoder, splitter, data[start:start + size], False))
+    rows.extend(parse_chunk(decoder, splitter, b"", True))
+    return rows, splitter.pending
+
+
+def test_splits_on_newlines():
+    records, remainder = split_records("a,b\n1,2\n3,4\n", False)
+    assert records == ["a,b\n", "1,2\n", "3,4\n"]
+    assert remainder == ""
+
+
+def test_keeps_unterminated_record_until_final():
+    assert split_records("a,b\n1,2", False) == (["a,b\n"], "1,2")
+    assert split_records("a,b\n1,2", True) == (["a,b\n", "1,2"], "")
+
+
+def test_quoted_newlines_stay_in_one_record():
+    text = 'a,b\n1,"first\nsecond"\n2,"x"\n'
+    records, remainder = split_records(text, False)
+    assert records == ["a,b\n", '1,"first\nsecond"\n', '2,"x"\n']
+    assert remainder == ""
+
+
+def test_open_quote_is_carried_over():
+    records, remainder = split_records('a,b\n1,"first\nsec', False)
+    assert records == ["a,b\n"]
+    assert remainder == '1,"first\nsec'
+
+
+def test_escaped_quotes():
+    text = 'a,b\n1,"say ""hi""\nthere"\n'
+    records, _ = split_records(text, True)
+    assert records == ["a,b\n", '1,"say ""hi""\nthere"\n']
+
+
+def test_crlf():
+    text = 'a,b\r\n1,"x\r\ny"\r\n2,z\r\n'
+    records, remainder = split_records(text, False)
+    assert records == ["a,b\r\n", '1,"x\r\ny"\r\n', "2,z\r\n"]
+    assert remainder == ""
+
+
+@pytest.mark.parametrize("separator", ["\u2028", "\u2029", "\x85", "\x0b", "\x0c", "\x1c", "\x1d", "\x1e"])
+def test_unicode_line_separators_are_field_content(separator):
+    text = f"a,b,c\n1,name{separator}x,u\n2,n,v\n"
+    records, remainder = split_records(text, True)
+    assert len(records) == 3 == len(reader_rows(text))
+    assert remainder == ""
+    # Not at EOF, the record is still complete and nothing is held back
+    records, remainder = split_records(text, False)
+    assert len(records) == 3
+    assert remainder == ""
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64])
+def test_chunked_parse_matches_csv_reader(size):
+    text = 'SerialNumber,ProductName,InputImageUrls\r\n1,"multi\nline",u1\r\n2,odd\u2028name,"u2,u3"\r\n3,"q ""x""",u4'
+    rows, remainder = parse_in_chunks(("\ufeff" + text).encode("utf-8"), size)
+    assert rows == reader_rows(text)
+    assert remainder == ""
+
+
+def test_quote_state_is_carried_across_chunks():
+    splitter = RecordSplitter()
+    assert splitter.feed('a,b\n1,"first\nsec', False) == ["a,b\n"]
+    assert (splitter.pending, splitter.quotes) == ('1,"first\nsec', 1)
+    assert splitter.feed('ond"\n2,', False) == ['1,"first\nsecond"\n']
+    assert (splitter.pending, splitter.quotes) == ("2,", 0)
+    assert splitter.feed('x\n', True) == ["2,x\n"]
+    assert (splitter.pending, splitter.quotes) == ("", 0)
+
+
+def test_oversized_record_is_rejected():
+    splitter = RecordSplitter(max_record_size=16)
+    assert splitter.feed("a,b\n1,2\n", False) == ["a,b\n", "1,2\n"]
+    with pytest.raises(CSVFormatError):
+        splitter.feed('3,"unbalanced\n4,more rows', False)
+
+
+def test_oversized_complete_record_is_rejected():
+    with pytest.raises(CSVFormatError):
+        RecordSplitter(max_record_size=8).feed("1,abcdefghij\n", False)
@@ -0,0 +1,16 @@
+from app.admission import ACTIVE_KEY
+from app.metrics import QueueCollector
+from app.progress import progress_key
+
+
+def test_scrape_reports_in_flight_without_pruning(fake_redis):
+    fake_redis.hset(progress_key("open"), mapping={"total": 5, "completed": 2, "failed": 0})
+    fake_redis.hset(progress_key("done"), mapping={"total": 3, "completed": 3, "failed": 0})
+    fake_redis.sadd(ACTIVE_KEY, "open", "done")
+    fake_redis.rpush("webhooks", "m1", "m2")
+
+    metrics = {family.name: family for family in QueueCollector().collect()}
+    assert metrics["images_in_flight"].samples[0].value == 3
+    depth = {sample.labels["queue"]: sample.value for sample in metrics["celery_queue_depth"].samples}
+    assert depth["webhooks"] == 2
+    assert fake_redis.smembers(ACTIVE_KEY) == {b"open", b"done"}
@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from app import progress
+
+# seal is a Lua script
+pytest.importorskip("lupa")
+
+REQUEST_ID = "r1"
+
+
+@pytest.fixture
+def request_of(fake_redis):
+    def start(images: int) -> str:
+        progress.init_progress(REQUEST_ID)
+        progress.add_total(REQUEST_ID, images)
+        return REQUEST_ID
+    return start
+
+
+def test_not_claimed_before_seal(request_of):
+    request_id = request_of(3)
+    assert progress.add_finished(request_id, completed=3) is False
+    assert progress.seal(request_id) is True
+    assert progress.seal(request_id) is False
+
+
+def test_last_finished_image_claims_a_sealed_request(request_of):
+    request_id = request_of(2)
+    assert progress.seal(request_id) is False
+    assert progress.add_finished(request_id, completed=1) is False
+    assert progress.add_finished(request_id, failed=1) is True
+    # A late or duplicate update does not finalize twice
+    assert progress.add_finished(request_id, completed=1) is False
+
+
+def test_empty_request_is_claimed_on_seal(request_of):
+    assert progress.seal(request_of(0)) is True
+
+
+def test_exactly_one_concurrent_finisher_claims(request_of):
+    images = 16
+    request_id = request_of(images)
+    progress.seal(request_id)
+    claims = []
+    barrier = threading.Barrier(images)
+
+    def finish():
+        barrier.wait()
+        claims.append(progress.add_finished(request_id, completed=1))
+
+    threads = [threading.Thread(target=finish) for _ in range(images)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert claims.count(True) == 1
+
+
+def test_claim_finalization_forces_the_claim_once(request_of):
+    request_id = request_of(5)
+    assert progress.claim_finalization(request_id) is True
+    assert progress.claim_finalization(request_id) is False
+    # Already claimed: completing the request does not claim it again
+    progress.seal(request_id)
+    assert progress.add_finished(request_id, completed=5) is False
+
+
+def test_reopened_request_can_be_finalized_again(request_of):
+    request_id = request_of(1)
+    progress.seal(request_id)
+    assert progress.add_finished(request_id, completed=1) is True
+    progress.mark_finished(request_id)
+
+    progress.add_total(request_id, 2)
+    assert progress.mark_reopened(request_id) is False
+    assert progress.get_snapshot(request_id)["finished"] is False
+    assert progress.add_finished(request_id, completed=1) is False
+    assert progress.add_finished(request_id, failed=1) is True
+
+
+def test_reopened_request_with_nothing_left_is_claimed_at_once(request_of):
+    request_id = request_of(1)
+    progress.seal(request_id)
+    assert progress.add_finished(request_id, completed=1) is True
+    assert progress.mark_reopened(request_id) is True
+
+
+def test_seal_does_not_recreate_missing_counters(request_of, fake_redis):
+    request_id = request_of(3)
+    fake_redis.delete(progress.progress_key(request_id))
+    assert progress.seal(request_id) is None
+    assert not fake_redis.exists(progress.progress_key(request_id))
+    # Images finishing afterwards recreate a partial hash, which never claims either
+    assert progress.add_finished(request_id, completed=3) is False
+    assert progress.seal(request_id) is None
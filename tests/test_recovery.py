@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.model import ImageStatus, ImageUrl, Product, Request
+from celery_worker.recovery import claim_for_retry, iter_pending, reset_for_resume, retry_countdown
+
+REQUEST_ID = "0123456789abcdef0123456789abcdef"
+PRODUCT_ID = "fedcba9876543210fedcba9876543210"
+CREATED_AT = datetime(2024, 6, 1)
+
+
+def test_retry_countdown_backs_off_within_the_visibility_timeout(monkeypatch):
+    assert settings.image_retry_backoff / 2 <= retry_countdown(1) <= settings.image_retry_backoff
+    assert 2 * settings.image_retry_backoff <= retry_countdown(3) <= 4 * settings.image_retry_backoff
+    monkeypatch.setattr(settings, "broker_visibility_timeout", 60)
+    assert retry_countdown(50) <= 30
+
+
+def add_images(db, *statuses):
+    request = Request(request_id=REQUEST_ID, created_at=CREATED_AT, total_images=len(statuses), failed_images=0)
+    db.add(request)
+    db.add(Product(product_id=PRODUCT_ID, request_id=REQUEST_ID, request_created_at=CREATED_AT))
+    ids = []
+    for index, status in enumerate(statuses):
+        image_id = f"{index:032x}"
+        db.add(ImageUrl(image_id=image_id, product_id=PRODUCT_ID, request_id=REQUEST_ID, request_created_at=CREATED_AT,
+                        input_image_url=f"http://a/{index}.jpg", status=status, attempts=1))
+        ids.append(image_id)
+    request.failed_images = statuses.count(ImageStatus.failed)
+    db.commit()
+    return request, ids
+
+
+def status_of(db):
+    return {row.image_id.replace("-", ""): (row.status, row.attempts)
+            for row in db.execute(select(ImageUrl.image_id, ImageUrl.status, ImageUrl.attempts))}
+
+
+def test_claim_for_retry_skips_finished_images(db):
+    _, ids = add_images(db, ImageStatus.processing, ImageStatus.completed)
+    assert claim_for_retry(db, ids) == [(ids[0], 2)]
+    assert status_of(db)[ids[1]] == (ImageStatus.completed, 1)
+
+
+def test_resume_resets_unfinished_and_optionally_failed_images(db):
+    request, ids = add_images(db, ImageStatus.processing, ImageStatus.failed, ImageStatus.completed)
+    assert reset_for_resume(db, request, include_failed=False) == 0
+    assert [image["image_id"] for batch in iter_pending(db, request, 10) for image in batch] == [ids[0]]
+
+    assert reset_for_resume(db, request, include_failed=True) == 1
+    db.refresh(request)
+    assert request.failed_images == 0
+    statuses = status_of(db)
+    assert statuses[ids[1]] == (ImageStatus.pending, 0)
+    assert statuses[ids[2]] == (ImageStatus.completed, 1)
+    assert sorted(image["image_id"] for batch in iter_pending(db, request, 1) for image in batch) == ids[:2]
@@ -0,0 +1,41 @@
+import gzip
+import json
+from datetime import datetime, timedelta
+
+from app.model import ImageStatus, ImageUrl, Product, Request, RequestStatus
+from app.storage import LocalStorage
+from celery_worker.retention import archive_finished_requests, archive_key, fail_expired_requests
+
+CUTOFF = datetime(2024, 6, 1)
+OLD = CUTOFF - timedelta(days=40)
+
+
+def add_request(db, request_id, status, created_at, image_status=ImageStatus.completed):
+    db.add(Request(request_id=request_id, status=status, created_at=created_at, total_images=1))
+    product_id = request_id.replace("0", "1", 1)
+    db.add(Product(product_id=product_id, request_id=request_id, request_created_at=created_at, serial_number=1))
+    db.add(ImageUrl(product_id=product_id, request_id=request_id, request_created_at=created_at,
+                    input_image_url="http://example.com/a.jpg", status=image_status))
+    db.commit()
+
+
+def test_unfinished_expired_requests_are_failed_and_archived(db, tmp_path):
+    stale = "00000000-0000-0000-0000-00000000000a"
+    done = "00000000-0000-0000-0000-00000000000b"
+    recent = "00000000-0000-0000-0000-00000000000c"
+    add_request(db, stale, RequestStatus.processing, OLD, image_status=ImageStatus.processing)
+    add_request(db, done, RequestStatus.completed, OLD)
+    add_request(db, recent, RequestStatus.processing, CUTOFF + timedelta(days=1))
+
+    assert fail_expired_requests(db, CUTOFF) == 1
+    assert db.get(Request, stale).status == RequestStatus.failed
+    assert db.get(Request, recent).status == RequestStatus.processing
+
+    storage = LocalStorage(str(tmp_path))
+    assert archive_finished_requests(db, storage, CUTOFF, limit=10) == 2
+    assert db.get(Request, recent).archived_at is None
+
+    with gzip.open(storage.url(archive_key(db.get(Request, stale))), "rt") as archive:
+        header, image = [json.loads(line) for line in archive]
+    assert header["status"] == "failed"
+    assert image["status"] == "processing"
@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+from app.config import settings
+from celery_worker import staging
+
+# The staged-bytes accounting is a Lua script
+pytest.importorskip("lupa")
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(settings, "fetch_blob_ttl", 60)
+    monkeypatch.setattr(settings, "fetch_max_staged_bytes", 100)
+
+
+def test_put_and_take_track_parked_bytes(fake_redis, limits):
+    first = staging.put_blob("a", b"x" * 30)
+    staging.put_blob("b", b"y" * 20)
+    assert staging.staged_bytes() == 50
+    assert staging.take_blob(first) == b"x" * 30
+    assert staging.staged_bytes() == 20
+    # Taking it again (or an expired blob) changes nothing
+    assert staging.take_blob(first) is None
+    assert staging.staged_bytes() == 20
+
+
+def test_putting_a_blob_again_replaces_its_size(fake_redis, limits):
+    staging.put_blob("a", b"x" * 30)
+    staging.put_blob("a", b"x" * 10)
+    assert staging.staged_bytes() == 10
+
+
+def test_expired_blobs_are_released(fake_redis, limits, monkeypatch):
+    monkeypatch.setattr(settings, "fetch_blob_ttl", 1)
+    staging.put_blob("a", b"x" * 30)
+    assert staging.staged_bytes() == 30
+    time.sleep(1.1)
+    assert staging.staged_bytes() == 0
+
+
+def test_wait_for_room_gives_up_after_the_blob_ttl(fake_redis, limits, monkeypatch):
+    staging.put_blob("a", b"x" * 100)
+    monkeypatch.setattr(settings, "fetch_blob_ttl", 0.2)
+    waited = staging.wait_for_room(max_sleep=0.05)
+    assert 0.2 <= waited < 1
+
+
+def test_wait_for_room_returns_at_once_below_the_limit(fake_redis, limits):
+    staging.put_blob("a", b"x" * 99)
+    assert staging.wait_for_room() < 0.01
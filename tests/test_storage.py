@@ -0,0 +1,58 @@
+import io
+import os
+
+import pytest
+
+from app.storage import LocalStorage, content_type_for
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path))
+
+
+def files(root):
+    return sorted(os.path.relpath(os.path.join(directory, name), root)
+                  for directory, _, names in os.walk(root) for name in names)
+
+
+def test_put_shards_by_file_name(storage, tmp_path):
+    url = storage.put("outputs/abcdef.jpg", b"data")
+    assert url == os.path.join(str(tmp_path), "outputs", "ab", "abcdef.jpg")
+    assert storage.exists("outputs/abcdef.jpg")
+    assert LocalStorage(str(tmp_path), "http://cdn.example/").url("outputs/abcdef.jpg") == "http://cdn.example/outputs/ab/abcdef.jpg"
+
+
+def test_copy_survives_deleting_the_source(storage):
+    storage.put("cache/source.jpg", b"data")
+    url = storage.copy("cache/source.jpg", "outputs/copy.jpg")
+    storage.delete("cache/source.jpg")
+    assert not storage.exists("cache/source.jpg")
+    assert open(url, "rb").read() == b"data"
+    # Deleting what is already gone is not an error
+    storage.delete("cache/source.jpg")
+
+
+def test_copy_of_missing_source_raises_file_not_found(storage, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        storage.copy("cache/missing.jpg", "outputs/copy.jpg")
+    assert not any(name.endswith(".tmp") for name in files(tmp_path))
+
+
+def test_failed_write_leaves_no_object(storage, tmp_path):
+    with pytest.raises(RuntimeError):
+        with storage.open_write("exports/results.csv") as writer:
+            writer.write(b"partial")
+            raise RuntimeError("export failed")
+    assert not storage.exists("exports/results.csv")
+    assert files(tmp_path) == []
+
+
+def test_put_stream_copies_in_chunks(storage):
+    url = storage.put_stream("exports/results.csv", io.BytesIO(b"x" * 10), chunk_size=3)
+    assert open(url, "rb").read() == b"x" * 10
+
+
+def test_content_type_by_extension():
+    assert content_type_for("a/b.jpg") == "image/jpeg"
+    assert content_type_for("a/b.webp") == "image/webp"
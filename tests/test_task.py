@@ -0,0 +1,35 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import celery_worker.task as task
+
+
+class _Unreachable:
+    def __enter__(self):
+        raise OperationalError("SELECT 1", {}, Exception("connection refused"))
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _NoDatabase:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+PRODUCT = {"request_id": "r1", "product_id": "p1", "name": "n", "images": ["http://example.com/a.jpg"], "row": 1}
+
+
+def test_process_product_raises_database_errors_for_retry(monkeypatch):
+    monkeypatch.setattr(task, "ConnectionManager", _Unreachable)
+    with pytest.raises(OperationalError):
+        task.process_product(dict(PRODUCT, request_created_at="2024-01-01T00:00:00"))
+
+
+def test_process_product_reports_invalid_rows(monkeypatch):
+    monkeypatch.setattr(task, "ConnectionManager", _NoDatabase)
+    result = task.process_product(dict(PRODUCT, request_created_at="not a date"))
+    assert result["status"] == "failure"
@@ -0,0 +1,59 @@
+from io import BytesIO
+
+from PIL import Image
+
+from celery_worker.transform import ORIENTATION_TAG, EncodeOptions, fit, render_variants, scale_image
+
+OPTIONS = EncodeOptions()
+
+
+def make_image(size, fmt="JPEG", mode="RGB", orientation=None) -> bytes:
+    img = Image.new(mode, size, (200, 30, 30, 128) if mode == "RGBA" else (200, 30, 30))
+    buffer = BytesIO()
+    params = {}
+    if orientation:
+        exif = Image.Exif()
+        exif[ORIENTATION_TAG] = orientation
+        params["exif"] = exif.tobytes()
+    img.save(buffer, format=fmt, **params)
+    return buffer.getvalue()
+
+
+def opened(variant):
+    return Image.open(BytesIO(variant.data))
+
+
+def test_fit_never_upscales():
+    assert fit((400, 200), 100) == (100, 50)
+    assert fit((400, 200), 1000) == (400, 200)
+
+
+def test_variants_are_largest_first_and_sized_by_longest_edge():
+    variants = render_variants(make_image((800, 400)), [100, 400, 2000], "JPEG", 80, True, OPTIONS)
+    assert [variant.name for variant in variants] == ["2000", "400", "100"]
+    assert [opened(variant).size for variant in variants] == [(800, 400), (400, 200), (100, 50)]
+    assert {variant.extension for variant in variants} == {"jpg"}
+
+
+def test_webp_keeps_alpha_and_jpeg_flattens_it():
+    source = make_image((64, 64), "PNG", "RGBA")
+    webp, = render_variants(source, [32], "WEBP", 80, True, OPTIONS)
+    assert webp.extension == "webp"
+    assert opened(webp).mode == "RGBA"
+    jpeg, = render_variants(source, [32], "JPEG", 80, True, OPTIONS)
+    assert opened(jpeg).mode == "RGB"
+
+
+def test_exif_orientation_is_applied():
+    # Orientation 6: stored landscape, displayed rotated a quarter turn
+    source = make_image((200, 100), orientation=6)
+    kept, = render_variants(source, [100], "JPEG", 80, False, OPTIONS)
+    assert opened(kept).size == (50, 100)
+    assert opened(kept).getexif().get(ORIENTATION_TAG) == 1
+    stripped, = render_variants(source, [100], "JPEG", 80, True, OPTIONS)
+    assert opened(stripped).size == (50, 100)
+    assert ORIENTATION_TAG not in opened(stripped).getexif()
+
+
+def test_scale_image_halves():
+    assert Image.open(BytesIO(scale_image(make_image((300, 200)), 0.5, OPTIONS))).size == (150, 100)
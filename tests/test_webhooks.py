@@ -0,0 +1,72 @@
+from collections import namedtuple
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+import celery_worker.webhooks as webhooks
+from app.config import settings
+from app.model import DeliveryKind, DeliveryStatus, WebhookDelivery
+
+Claimed = namedtuple("Claimed", "delivery_id request_id kind url payload attempts")
+
+
+def test_backoff_doubles_up_to_the_cap():
+    assert settings.webhook_retry_backoff / 2 <= webhooks.backoff(1) <= settings.webhook_retry_backoff
+    assert 2 * settings.webhook_retry_backoff <= webhooks.backoff(3) <= 4 * settings.webhook_retry_backoff
+    assert settings.webhook_retry_backoff_max / 2 <= webhooks.backoff(50) <= settings.webhook_retry_backoff_max
+
+
+def add_delivery(db, attempts):
+    # Set explicitly: SQLite only autoincrements INTEGER keys, not BIGINT ones
+    delivery = WebhookDelivery(
+        delivery_id=1, request_id="0123456789abcdef0123456789abcdef", kind=DeliveryKind.notice, url="http://hook.example/",
+        payload={}, status=DeliveryStatus.pending, attempts=attempts, next_attempt_at=datetime(2024, 1, 1),
+    )
+    db.add(delivery)
+    db.commit()
+    return delivery
+
+
+@pytest.mark.parametrize("error, attempts, status", [
+    (None, 1, DeliveryStatus.delivered),
+    (ConnectionError("refused"), 1, DeliveryStatus.pending),
+    (ConnectionError("refused"), settings.webhook_max_attempts, DeliveryStatus.dead),
+    (webhooks.PermanentDeliveryError("answered 404"), 1, DeliveryStatus.dead),
+])
+def test_record_outcome(db, error, attempts, status):
+    delivery = add_delivery(db, attempts)
+    claimed = Claimed(delivery.delivery_id, delivery.request_id, delivery.kind, delivery.url, {}, attempts)
+    webhooks.record_outcome(db, [claimed], error)
+    # next_attempt_at is computed by PostgreSQL date arithmetic, which SQLite does not do
+    row = db.execute(
+        select(WebhookDelivery.status, WebhookDelivery.last_error).where(WebhookDelivery.delivery_id == claimed.delivery_id)
+    ).one()
+    assert row.status == status
+    assert row.last_error == (str(error) if error else None)
+
+
+def test_deliver_due_groups_notices_per_url(db, monkeypatch):
+    claims = [[
+        Claimed(1, "r1", DeliveryKind.notice, "http://a/", {"request_id": "r1"}, 1),
+        Claimed(2, "r2", DeliveryKind.results, "http://results/", None, 1),
+        Claimed(3, "r3", DeliveryKind.notice, "http://a/", {"request_id": "r3"}, 1),
+        Claimed(4, "r4", DeliveryKind.notice, "http://b/", {"request_id": "r4"}, 1),
+    ], []]
+    posted, outcomes = [], []
+
+    def post_notices(url, deliveries):
+        posted.append((url, [delivery.delivery_id for delivery in deliveries]))
+        if url == "http://b/":
+            raise ConnectionError("refused")
+
+    monkeypatch.setattr(webhooks, "claim_due", lambda db, limit: claims.pop(0))
+    monkeypatch.setattr(webhooks, "post_notices", post_notices)
+    monkeypatch.setattr(webhooks, "post_results", lambda db, delivery: posted.append((delivery.url, [delivery.delivery_id])) or True)
+    monkeypatch.setattr(webhooks, "record_outcome", lambda db, deliveries, error: outcomes.append(
+        ([delivery.delivery_id for delivery in deliveries], error is None)
+    ))
+
+    assert webhooks.deliver_due(db) == (3, 1)
+    assert posted == [("http://a/", [1, 3]), ("http://results/", [2]), ("http://b/", [4])]
+    assert outcomes == [([1, 3], True), ([2], True), ([4], False)]